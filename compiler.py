@@ -1,3 +1,7 @@
+import re
+import struct
+from debuginfo import DebugInfo, debugInfoPath
+
 RegisterToId = {
     "R0" : 0x00,
     "R1" : 0x01,
@@ -50,138 +54,427 @@ MnemonicToOpcode = {
     "HALT" : (0xFF, )
 }
 
+OpcodeToArguments = {entry[0] : entry[1:] for entry in MnemonicToOpcode.values()}
+
+MOV = 0x00
+PUSH = 0x30
+POP = 0x31
+JMP = 0x40
+JMPR = 0x41
+CALR = 0x43
+RET = 0x44
+HALT = 0xFF
+PROGRAM_COUNTER = RegisterToId["PC"]
+STACK_POINTER = RegisterToId["SP"]
+
 WORD_SIZE = 1 << 8
 
-class DecodeRegisterEx(Exception):
-    pass
+OBJECT_MAGIC = b"VMO2"
+objectHeader = struct.Struct("<4sHHH")   # magic, code length, labels count, relocations count
+symbolHeader = struct.Struct("<HH")      # address or operand offset, name length
+
+class ObjectFile:
+    def __init__(self, code, labels, relocations, lines=None):
+        self.code = code
+        self.labels = labels
+        self.relocations = relocations
+        self.lines = [0] * len(code) if lines is None else lines
+
+    @staticmethod
+    def __packSymbol(address, name):
+        name = name.encode()
+        return symbolHeader.pack(address, len(name)) + name
+
+    def toBytes(self):
+        try:
+            code = bytes(self.code)
+        except ValueError:
+            raise Exception("Object code contains values which don't fit in a byte") from None
+        chunks = [objectHeader.pack(OBJECT_MAGIC, len(code), len(self.labels),
+            len(self.relocations)), code, struct.pack("<{0}H".format(len(code)), *self.lines)]
+        chunks.extend(self.__packSymbol(address, name) for name, address in self.labels.items())
+        chunks.extend(self.__packSymbol(offset, name) for offset, name in self.relocations)
+        return b"".join(chunks)
+
+def readObject(buffer):
+    magic, codeLength, labelsCount, relocationsCount = objectHeader.unpack_from(buffer, 0)
+    if magic != OBJECT_MAGIC:
+        raise Exception("Not an object file")
+    offset = objectHeader.size + codeLength
+    code = list(buffer[objectHeader.size : offset])
+    if len(buffer) < offset + 2 * codeLength:
+        raise Exception("Object file is truncated")
+    lines = list(struct.unpack_from("<{0}H".format(codeLength), buffer, offset))
+    offset += 2 * codeLength
+    symbols = []
+    for _ in range(labelsCount + relocationsCount):
+        address, length = symbolHeader.unpack_from(buffer, offset)
+        offset += symbolHeader.size
+        symbols.append((address, bytes(buffer[offset : offset + length]).decode()))
+        offset += length
+    if offset > len(buffer) or len(code) != codeLength:
+        raise Exception("Object file is truncated")
+    return ObjectFile(code, {name : address for address, name in symbols[:labelsCount]},
+        symbols[labelsCount:], lines)
+
+tokenPattern = re.compile(r"[^\s,]+")
+numberPattern = re.compile(r"([+-]?)(?:(\d+)|(?:0[xX])?([0-9a-fA-F]+))")
 
 class Compiler:
     def __init__(self):
         self.binary = list()
         self.labels = dict()
+        self.lines = list()
+        self.fixups = list()
+        self.argumentTypeToDecoderMapping = self._getArgumentTypeToDecoderMapping()
+
+    def _getArgumentTypeToDecoderMapping(self):
+        return {
+            "R" : self.__decodeRegisterId,
+            "I" : self.__decodeImmValue,
+            "A" : self.__decodeLabelOrAddress }
 
     @staticmethod
-    def __decodeRegisterId(registerName):
-        try:
-            return RegisterToId[registerName]
-        except KeyError as e:
-            raise DecodeRegisterEx("Unknown register name: " + registerName) from None
+    def __fail(lineIndex, message):
+        raise Exception("Compilation failed at line {0} due to error:\n\t{1}"
+            .format(lineIndex + 1, message))
 
     @staticmethod
-    def __tokenize(source):
-        sourcePreprocessed = source.replace(',','')
-        tokens = sourcePreprocessed.split()
-        for token in tokens:
-            yield token
+    def __decodeNumber(token):
+        match = numberPattern.fullmatch(token)
+        if match is None:
+            return None
+        sign, decimal, hexadecimal = match.groups()
+        value = int(decimal) if decimal is not None else int(hexadecimal, 16)
+        return -value if sign == "-" else value
 
-    def __decodeLabelOrAddress(self, labelOrAddress, isSecondPass = False):
-        try:
-            result = int(labelOrAddress)
-            return result
-        except Exception as e:
-            pass
-        try:
-            result = int(labelOrAddress, 16)
-            return result
-        except Exception as e:
-            pass  
-        try:
-            address = self.labels[labelOrAddress];
-            return address
-        except KeyError as e:
-            if isSecondPass:
-                raise Exception("Unknown label: " + labelOrAddress)
-            return labelOrAddress #this is left for second compiler pass
-
-    def __decodeImmValue(self, value):
-        try:
-            result = int(value)
-            return result
-        except Exception as e:
-            pass
-        try:
-            result = int(value, 16)
-            return result
-        except Exception as e:
-            pass
-        raise Exception("Couldn't decode immediate value of: " + value)
-
-    def __handleInstruction(self, tokenizer):
-        result = []
-        mnemonic = next(tokenizer)
-        if mnemonic[-1] == ":":
-            self.labels[mnemonic.replace(":","")] = len(self.binary)
-        else:
-            try:
-                opcode = MnemonicToOpcode[mnemonic][0]
-                result.append(opcode)
-                if len(MnemonicToOpcode[mnemonic]) == 1:
-                    return result
-                for argumentType in MnemonicToOpcode[mnemonic][1:]:
-                    if argumentType == "I":
-                        result.append(self.__decodeImmValue(next(tokenizer)))
-                    elif argumentType == "R":
-                        registerId = self.__decodeRegisterId(next(tokenizer))
-                        result.append(registerId)
-                    elif argumentType == "A":
-                        address = self.__calculateRelativeJump(len(self.binary), 
-                            self.__decodeLabelOrAddress(next(tokenizer)))
-                        result.append(address)
-                    else:
-                        raise Exception("Internal compiler error. LUT wrong!") # pragma: no cover
-
-            except KeyError as e:
-                raise Exception("Unknown mnemocnic: " + mnemonic) from None
-            except StopIteration as e:
-                raise Exception("Not enough arguments for mnemonic: " + mnemonic) from None
-            except DecodeRegisterEx as e:
-                raise Exception(e) from None        
-        return result
+    def __decodeRegisterId(self, token, address, lineIndex):
+        registerId = RegisterToId.get(token)
+        if registerId is None:
+            self.__fail(lineIndex, "Unknown register name: " + token)
+        return registerId
 
-    @staticmethod
-    def __removeComments(line):
-        return line.rsplit(';')[0]
+    def __decodeImmValue(self, token, address, lineIndex):
+        value = self.__decodeNumber(token)
+        if value is None:
+            self.__fail(lineIndex, "Couldn't decode immediate value of: " + token)
+        return value
+
+    def __decodeLabelOrAddress(self, token, address, lineIndex):
+        target = self.__decodeNumber(token)
+        if target is None:
+            target = self.labels.get(token)
+        if target is None:
+            self.fixups.append((len(self.binary), token, lineIndex))
+            return 0x00
+        return self.__calculateRelativeJump(address, target)
 
-    def compile(self, source):
+    def __handleInstruction(self, tokens, lineIndex):
+        mnemonic = tokens[0]
+        encoding = MnemonicToOpcode.get(mnemonic)
+        if encoding is None:
+            self.__fail(lineIndex, "Unknown mnemocnic: " + mnemonic)
+        address = len(self.binary)
+        self.binary.append(encoding[0])
+        for index, argumentType in enumerate(encoding[1:], 1):
+            if index >= len(tokens):
+                self.__fail(lineIndex, "Not enough arguments for mnemonic: " + mnemonic)
+            decoder = self.argumentTypeToDecoderMapping[argumentType]
+            self.binary.append(decoder(tokens[index], address, lineIndex))
+        self.lines.extend([lineIndex + 1] * (len(self.binary) - address))
+
+    def __assemble(self, source):
         self.binary = []
+        self.labels = {}
+        self.lines = []
+        self.fixups = []
+        starts = []
         for lineIndex, line in enumerate(source.splitlines()):
-            line = self.__removeComments(line)
-            if len(line) == 0:
-                continue
-            tokenizer = self.__tokenize(line)
-            try:
-                result = self.__handleInstruction(tokenizer)
-                self.binary.extend(result)
-            except Exception as e:
-                raise Exception("Compilation failed at line {0} due to error:\n\t{1}"
-                    .format(lineIndex + 1, e)) from None
+            tokens = tokenPattern.findall(line.partition(";")[0])
+            if tokens and tokens[0][-1] == ":":
+                self.labels[tokens[0].replace(":", "")] = len(self.binary)
+                tokens = tokens[1:]
+            if tokens:
+                starts.append(len(self.binary))
+                self.__handleInstruction(tokens, lineIndex)
+        return starts
+
+    def compile(self, source, optimize=False):
+        starts = self.__assemble(source)
         self.__resolveForwardLabels()
+        if optimize:
+            self.__optimize(starts)
         return self.binary
 
+    def compileObject(self, source):
+        self.__assemble(source)
+        relocations = []
+        self.__resolveForwardLabels(relocations)
+        return ObjectFile(self.binary, self.labels, relocations, self.lines)
+
+    def debugInfo(self, fileName):
+        return DebugInfo([fileName], bytes(len(self.lines)), self.lines, self.labels)
+
+    def __resolveForwardLabels(self, relocations=None):
+        for index, label, lineIndex in self.fixups:
+            target = self.labels.get(label)
+            if target is not None:
+                self.binary[index] = self.__calculateRelativeJump(index, target)
+            elif relocations is not None:
+                relocations.append((index, label))
+            else:
+                self.__fail(lineIndex, "Unknown label: " + label)
+
     @staticmethod
     def __calculateRelativeJump(current, desired):
-        if isinstance(desired, str):
-            return desired
         if desired < current:
             return (desired - current - 2) % WORD_SIZE
         else:
             return (desired - current - 1) % WORD_SIZE
 
-    def __resolveForwardLabels(self):
-        for idx, element in enumerate(self.binary):
-            try:
-                if type(element) is str and not element.isdigit():
-                    self.binary[idx] = self.__calculateRelativeJump(idx, 
-                        self.__decodeLabelOrAddress(element, True))
-            except Exception as e:
-                raise e
+    # instruction: [address, opcode, operands, absolute jump target or None]
+    def __splitInstructions(self, starts):
+        instructions = []
+        for index, address in enumerate(starts):
+            end = starts[index + 1] if index + 1 < len(starts) else len(self.binary)
+            opcode = self.binary[address]
+            operands = self.binary[address + 1 : end]
+            target = None
+            if OpcodeToArguments[opcode] == ("A",):
+                target = (address + 2 + operands.pop()) % WORD_SIZE
+            instructions.append([address, opcode, operands, target])
+        return instructions
+
+    @staticmethod
+    def __isRelocatable(instructions):
+        for address, opcode, operands, target in instructions:
+            if opcode in (JMPR, CALR):
+                return False
+            if any(kind == "R" and operand == PROGRAM_COUNTER
+                    for kind, operand in zip(OpcodeToArguments[opcode], operands)):
+                return False
+        return True
+
+    @staticmethod
+    def __threadJumps(instructions):
+        byAddress = {instruction[0] : instruction for instruction in instructions}
+        changed = False
+        for instruction in instructions:
+            visited = set()
+            target = instruction[3]
+            while (target in byAddress and byAddress[target][1] == JMP
+                    and target not in visited):
+                visited.add(target)
+                target = byAddress[target][3]
+            if target != instruction[3]:
+                instruction[3] = target
+                changed = True
+        return changed
+
+    @staticmethod
+    def __entries(instructions):
+        entries = {instruction[3] for instruction in instructions}
+        if instructions:
+            entries.add(instructions[0][0])
+        return entries
+
+    def __removeRedundant(self, instructions):
+        entries = self.__entries(instructions)
+        kept = []
+        reachable = True
+        index = 0
+        while index < len(instructions):
+            instruction = instructions[index]
+            address, opcode, operands, target = instruction
+            following = instructions[index + 1] if index + 1 < len(instructions) else None
+            index += 1
+            if address in entries:
+                reachable = True
+            if not reachable:
+                continue
+            if opcode == MOV and operands[0] == operands[1]:
+                continue
+            if opcode == JMP and following is not None and target == following[0]:
+                continue
+            if (opcode == PUSH and operands[0] != STACK_POINTER and following is not None
+                    and following[0] not in entries and following[1:3] == [POP, operands]):
+                index += 1
+                continue
+            kept.append(instruction)
+            reachable = opcode not in (JMP, RET, HALT)
+        self.__retarget(instructions, kept)
+        return kept
+
+    @staticmethod
+    def __retarget(instructions, kept):
+        addresses = {instruction[0] for instruction in kept}
+        following = {}
+        address = None
+        for instruction in reversed(instructions):
+            if instruction[0] in addresses:
+                address = instruction[0]
+            following[instruction[0]] = address
+        for instruction in kept:
+            target = instruction[3]
+            if target in following and target not in addresses and following[target] is not None:
+                instruction[3] = following[target]
+
+    def __optimize(self, starts):
+        instructions = self.__splitInstructions(starts)
+        end = len(self.binary)
+        targets = {instruction[0] for instruction in instructions}
+        if any(target is not None and target < end and target not in targets
+                for address, opcode, operands, target in instructions):
+            return
+        self.__threadJumps(instructions)
+        if self.__isRelocatable(instructions):
+            while True:
+                optimized = self.__removeRedundant(instructions)
+                threaded = self.__threadJumps(optimized)
+                if len(optimized) == len(instructions) and not threaded:
+                    break
+                instructions = optimized
+        self.__relocate(instructions, end)
+
+    def __relocate(self, instructions, end):
+        relocation = {}
+        binary = []
+        lines = []
+        for address, opcode, operands, target in instructions:
+            relocation[address] = len(binary)
+            binary.append(opcode)
+            binary.extend(operands)
+            if target is not None:
+                binary.append(None)
+            lines.extend([self.lines[address]] * (len(binary) - relocation[address]))
+        saved = end - len(binary)
+        def relocate(address):
+            while address < end and address not in relocation:
+                address += 1
+            return relocation.get(address, address - saved)
+        for address, opcode, operands, target in instructions:
+            if target is not None:
+                start = relocation[address]
+                binary[start + 1] = (relocate(target) - start - 2) % WORD_SIZE
+        self.labels = {name : relocate(address) for name, address in self.labels.items()}
+        self.binary = binary
+        self.lines = lines
 
 import sys
 import array
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+BUILD_MANIFEST = ".vmbuild.json"
+
+def findSources(patterns):
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            sources.extend(sorted(glob.glob(os.path.join(pattern, "*.asm"))))
+        else:
+            sources.extend(sorted(glob.glob(pattern, recursive=True)))
+    unique = []
+    seen = set()
+    for source in sources:
+        if source not in seen:
+            seen.add(source)
+            unique.append(source)
+    return unique
+
+def binaryPath(source):
+    return os.path.splitext(source)[0] + ".bin"
+
+def isBuilt(output):
+    return os.path.exists(output) and os.path.exists(debugInfoPath(output))
+
+def assembleFile(job):
+    source, optimize, knownHash = job
+    output = binaryPath(source)
+    result = {"source" : source, "output" : output, "state" : "failed", "size" : None,
+        "hash" : None, "error" : None}
+    try:
+        with open(source, 'rb') as sourceFile:
+            data = sourceFile.read()
+        result["hash"] = hashlib.sha256(data).hexdigest()
+        if result["hash"] == knownHash and isBuilt(output):
+            result.update(state="skipped", size=os.path.getsize(output))
+            return result
+        compiler = Compiler()
+        binary = compiler.compile(data.decode(), optimize)
+        with open(output, 'wb') as outputFile:
+            outputFile.write(array.array('B', binary))
+        compiler.debugInfo(source).save(debugInfoPath(output))
+        result.update(state="compiled", size=len(binary))
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def loadManifest(path):
+    try:
+        with open(path, 'r') as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
+
+def saveManifest(path, manifest):
+    with open(path, 'w') as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+
+def assembleBatch(sources, manifest, optimize=False, workers=None, chunksize=16):
+    results = {}
+    jobs = []
+    mtimes = {}
+    for source in sources:
+        try:
+            mtimes[source] = os.stat(source).st_mtime_ns
+        except OSError:
+            results[source] = assembleFile((source, optimize, None))
+            continue
+        entry = manifest.get(source)
+        if entry is None or entry["optimize"] != optimize:
+            jobs.append((source, optimize, None))
+        elif entry["mtime"] == mtimes[source] and isBuilt(binaryPath(source)):
+            results[source] = {"source" : source, "output" : binaryPath(source),
+                "state" : "skipped", "size" : entry["size"], "hash" : entry["hash"], "error" : None}
+        else:
+            jobs.append((source, optimize, entry["hash"]))
+    if workers == 1 or len(jobs) <= 1:
+        assembled = [assembleFile(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            assembled = list(executor.map(assembleFile, jobs, chunksize=chunksize))
+    for result in assembled:
+        source = result["source"]
+        results[source] = result
+        if result["state"] == "failed":
+            manifest.pop(source, None)
+        else:
+            manifest[source] = {"mtime" : mtimes[source], "hash" : result["hash"],
+                "size" : result["size"], "optimize" : optimize}
+    return [results[source] for source in sources]
+
+def summarize(results):
+    summary = {state : 0 for state in ("compiled", "skipped", "failed")}
+    for result in results:
+        summary[result["state"]] += 1
+    summary["files"] = results
+    return summary
+
 def help():  # pragma: no cover
-    helpText = ("Usage: compiler.py source.asm output.bin\n"
+    helpText = ("Usage: compiler.py source.asm output.bin [-O]\n"
+                "       compiler.py -b inputs... [-w workers] [-m manifest] [-O]\n"
                 "\t source.asm - filename with source code\n"
-                "\t output.bin - compiled program filename\n")
+                "\t output.bin - compiled program filename, relocatable object file for .o extension,\n"
+                "\t              source lines and labels are written next to it with .dbg extension\n"
+                "\t -O - remove redundant and unreachable instructions, thread jumps\n"
+                "\t -b inputs - assemble directories or globs of .asm files into .bin files next to them\n"
+                "\t -w workers - number of worker processes for -b (default: CPU count)\n"
+                "\t -m manifest - file keeping sources state between -b builds (default: "
+                + BUILD_MANIFEST + ")\n")
     print(helpText)
 
 def readSource():  # pragma: no cover
@@ -194,18 +487,49 @@ def readSource():  # pragma: no cover
 def writeOutput(data):  # pragma: no cover
     try:
         output = open(sys.argv[2], 'wb')
-        output.write(array.array('B', data))
+        output.write(data.toBytes() if isinstance(data, ObjectFile) else array.array('B', data))
     except FileNotFoundError as e:
         raise Exception ("Couldn't create " + sys.argv[1] + " file") 
 
 
+def batchMain(arguments):  # pragma: no cover
+    options = {"-w" : None, "-m" : BUILD_MANIFEST}
+    for option in options:
+        if option in arguments:
+            index = arguments.index(option)
+            options[option] = arguments[index + 1]
+            del arguments[index : index + 2]
+    optimize = "-O" in arguments
+    patterns = [argument for argument in arguments if argument != "-O"]
+    if not patterns:
+        help()
+        return
+    manifest = loadManifest(options["-m"])
+    workers = None if options["-w"] is None else int(options["-w"])
+    results = assembleBatch(findSources(patterns), manifest, optimize, workers)
+    saveManifest(options["-m"], manifest)
+    summary = summarize(results)
+    print(json.dumps(summary, indent=1))
+    if summary["failed"]:
+        sys.exit(1)
+
 def main():  # pragma: no cover
-    if len(sys.argv) != 3:
+    if sys.argv[1:2] == ["-b"]:
+        batchMain(sys.argv[2:])
+        return
+    if len(sys.argv) not in (3, 4) or sys.argv[3:] not in ([], ["-O"]):
         help()
         return
     compiler = Compiler()
-    binary = compiler.compile(readSource())
+    if sys.argv[2].endswith(".o"):
+        objectFile = compiler.compileObject(readSource())
+        writeOutput(objectFile)
+        print("Size of object code: " + str(len(objectFile.code)) + " bytes, "
+            + str(len(objectFile.relocations)) + " relocations.")
+        return
+    binary = compiler.compile(readSource(), optimize="-O" in sys.argv)
     writeOutput(binary)
+    compiler.debugInfo(sys.argv[1]).save(debugInfoPath(sys.argv[2]))
     print("Size of binary: " + str(len(binary)) + " bytes. " 
         + str(WORD_SIZE - len(binary)) + " bytes free left.")
 
@@ -0,0 +1,100 @@
+import array
+import os
+import struct
+
+DEBUG_INFO_MAGIC = b"VMD1"
+debugInfoHeader = struct.Struct("<4sHHH")   # magic, addresses count, files count, labels count
+nameHeader = struct.Struct("<HH")           # address (0 for files), name length
+
+def debugInfoPath(binaryPath):
+    return os.path.splitext(binaryPath)[0] + ".dbg"
+
+class DebugInfo:
+    def __init__(self, files, fileIndexes, lines, labels):
+        if len(files) > 0xFF:
+            raise Exception("Debug info can't describe more than 255 source files")
+        self.files = list(files)
+        self.fileIndexes = array.array('B', fileIndexes)
+        self.lines = array.array('H', lines)
+        self.labels = dict(labels)
+        self.labelAt = {}
+        for name, address in sorted(self.labels.items(), key=lambda label: (label[1], label[0])):
+            self.labelAt.setdefault(address, name)
+        self.symbols = []
+        symbol = None
+        for address in range(len(self.lines)):
+            symbol = self.labelAt.get(address, symbol)
+            self.symbols.append(symbol)
+        self.addresses = {}
+        for address in reversed(range(len(self.lines))):
+            if self.lines[address]:
+                self.addresses[self.location(address)] = address
+
+    def location(self, address):
+        if address >= len(self.lines) or not self.lines[address]:
+            return None
+        return (self.files[self.fileIndexes[address]], self.lines[address])
+
+    def symbol(self, address):
+        return self.symbols[address] if address < len(self.symbols) else None
+
+    def describe(self, address):
+        location = self.location(address)
+        symbol = self.symbol(address)
+        parts = []
+        if location is not None:
+            parts.append("{0}:{1}".format(*location))
+        if symbol is not None:
+            parts.append(symbol if self.labels[symbol] == address
+                else "{0}+0x{1:02X}".format(symbol, address - self.labels[symbol]))
+        return " ".join(parts)
+
+    def address(self, name):
+        if name in self.labels:
+            return self.labels[name]
+        fileName, separator, line = name.rpartition(":")
+        if separator and line.isdigit():
+            for candidate in self.files:
+                if candidate == fileName or os.path.basename(candidate) == fileName:
+                    address = self.addresses.get((candidate, int(line)))
+                    if address is not None:
+                        return address
+        raise Exception("No code at " + name)
+
+    def toBytes(self):
+        chunks = [debugInfoHeader.pack(DEBUG_INFO_MAGIC, len(self.lines), len(self.files),
+            len(self.labels))]
+        names = [(0, name) for name in self.files]
+        names.extend((address, name) for name, address in self.labels.items())
+        for address, name in names:
+            name = name.encode()
+            chunks.append(nameHeader.pack(address, len(name)) + name)
+        chunks.append(self.fileIndexes.tobytes())
+        chunks.append(struct.pack("<{0}H".format(len(self.lines)), *self.lines))
+        return b"".join(chunks)
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            output.write(self.toBytes())
+
+def readDebugInfo(buffer):
+    magic, size, filesCount, labelsCount = debugInfoHeader.unpack_from(buffer, 0)
+    if magic != DEBUG_INFO_MAGIC:
+        raise Exception("Not a debug info file")
+    offset = debugInfoHeader.size
+    names = []
+    for _ in range(filesCount + labelsCount):
+        address, length = nameHeader.unpack_from(buffer, offset)
+        offset += nameHeader.size
+        names.append((address, bytes(buffer[offset : offset + length]).decode()))
+        offset += length
+    if len(buffer) < offset + 3 * size:
+        raise Exception("Debug info file is truncated")
+    fileIndexes = bytes(buffer[offset : offset + size])
+    lines = struct.unpack_from("<{0}H".format(size), buffer, offset + size)
+    return DebugInfo([name for address, name in names[:filesCount]], fileIndexes, lines,
+        {name : address for address, name in names[filesCount:]})
+
+def loadDebugInfo(path):
+    with open(path, 'rb') as source:
+        return readDebugInfo(source.read())
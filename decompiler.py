@@ -36,6 +36,8 @@ opcodeToMnemonic = {
     0xFF : ("HALT", )
 }
 
+jumpOpcodes = (0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x40, 0x42)
+
 generalRegisterIdToName = {
     0x00 : "R0",
     0x01 : "R1",
@@ -55,8 +57,13 @@ class Decompiler:
     def __init__(self):
         self.binary = ""
 
-    def load(self, binaryStream):
+    def load(self, binaryStream, debugInfo=None):
         self.binary = binaryStream
+        self.debugInfo = debugInfo
+        self.labels = {}
+        if debugInfo is not None:
+            for name, address in sorted(debugInfo.labels.items()):
+                self.labels.setdefault(address, []).append(name)
         self.source = ""
 
     def run(self):
@@ -64,6 +71,7 @@ class Decompiler:
         while index < len(self.binary):
             currentByte = self.binary[index]
             index = self._decode(index)
+        self._decodeLabels(index)
 
     def getDecompiled(self):
         return(self.source[0:-1])
@@ -78,6 +86,19 @@ class Decompiler:
         constantValue = "0x{0:02X}".format(self.binary[index])
         self._appendToEndOfASource(constantValue)
 
+    def _decodeJumpTarget(self, index):
+        target = (index + 1 + self.binary[index]) % 256
+        label = self.debugInfo.labelAt.get(target) if self.debugInfo is not None else None
+        if label is None:
+            self._decodeConstant(index)
+        else:
+            self._appendToEndOfASource(label)
+
+    def _decodeLabels(self, index):
+        for name in self.labels.get(index, ()):
+            self._appendToEndOfASource(name + ":")
+            self._appendNewLineToSource()
+
     def _decodeRegister(self, index):
         try :
             byte = self.binary[index]
@@ -98,6 +119,8 @@ class Decompiler:
                     continue
                 if operand == "R":
                     self._decodeRegister(index+operIndex)
+                elif operand == "I" and opcode in jumpOpcodes:
+                    self._decodeJumpTarget(index+operIndex)
                 elif operand == "I":
                     self._decodeConstant(index+operIndex)
                 else:
@@ -111,25 +134,31 @@ class Decompiler:
             raise Exception("Decompilation failed! " + error)
 
     def _decode(self,index):
+        self._decodeLabels(index)
         opcode = self.binary[index]
         newIndex = index + self._decodeOperands(opcode, index)
         return newIndex;
 
+import os
 import sys
-import array
+from debuginfo import debugInfoPath, loadDebugInfo
 def help():  # pragma: no cover
     helpText = ("Usage: decompiler.py source.bin output.asm\n"
-                "\t source.bin - program filename \n"
+                "\t source.bin - program filename, labels are taken from source.dbg when it exists\n"
                 "\t output.asm - decompiled source code\n")
     print(helpText)
 
 def readSource():  # pragma: no cover
     try:
         source = open(sys.argv[1], 'rb')
-        return array.array('B', source.read()).tostring()
+        return source.read()
     except FileNotFoundError as e:
         raise Exception ("Source file " + sys.argv[1] + " not found")
 
+def readDebugInfo():  # pragma: no cover
+    path = debugInfoPath(sys.argv[1])
+    return loadDebugInfo(path) if os.path.exists(path) else None
+
 def writeOutput(sourceCode):  # pragma: no cover
     try:
         output = open(sys.argv[2], 'w')
@@ -142,7 +171,7 @@ def main():  # pragma: no cover
         help()
         return
     decompiler = Decompiler()
-    decompiler.load(readSource())
+    decompiler.load(readSource(), readDebugInfo())
     decompiler.run()
     writeOutput(decompiler.getDecompiled())
 
@@ -0,0 +1,43 @@
+import sys
+import json
+from vm.fleet import Job, runFleet
+
+def help():  # pragma: no cover
+    helpText = ("Usage: fleet.py [-w workers] jobs...\n"
+                "\t jobs - program.bin files to run without input or\n"
+                "\t        .jsonl files with one {\"program\": ..., \"input\": ...} job per line\n"
+                "\t -w workers - number of worker processes (default: CPU count)\n"
+                "Results are printed as JSON lines in jobs order.\n")
+    print(helpText)
+
+def readJobs(arguments):  # pragma: no cover
+    for argument in arguments:
+        if not argument.endswith(".jsonl"):
+            yield Job(argument)
+            continue
+        try:
+            jobs = open(argument, 'r')
+        except FileNotFoundError as e:
+            raise Exception ("Jobs file " + argument + " not found")
+        for line in jobs:
+            if line.strip():
+                job = json.loads(line)
+                yield Job(job["program"], job.get("input", ''))
+
+def main():  # pragma: no cover
+    arguments = sys.argv[1:]
+    workers = None
+    if arguments[:1] == ["-w"]:
+        workers = int(arguments[1])
+        arguments = arguments[2:]
+    if len(arguments) == 0:
+        help()
+        return
+    for result in runFleet(list(readJobs(arguments)), workers):
+        print(json.dumps(result), flush=True)
+
+if __name__ == '__main__':  # pragma: no cover
+    try:
+        main()
+    except Exception as e:
+        print(e)
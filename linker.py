@@ -0,0 +1,125 @@
+import hashlib
+import os
+import tempfile
+from compiler import Compiler, readObject, OBJECT_MAGIC, WORD_SIZE
+from debuginfo import DebugInfo, debugInfoPath
+
+class Linker:
+    def __init__(self):
+        self.binary = list()
+        self.labels = dict()
+        self.localLabels = dict()
+        self.lines = list()
+        self.fileIndexes = list()
+
+    def link(self, objects):
+        self.binary = []
+        self.lines = []
+        self.fileIndexes = []
+        definitions = {}
+        bases = []
+        for fileIndex, objectFile in enumerate(objects):
+            base = len(self.binary)
+            for name, address in objectFile.labels.items():
+                definitions.setdefault(name, []).append((fileIndex, base + address))
+            self.binary.extend(objectFile.code)
+            self.lines.extend(objectFile.lines)
+            self.fileIndexes.extend([fileIndex] * len(objectFile.code))
+            bases.append(base)
+        for base, objectFile in zip(bases, objects):
+            for offset, label in objectFile.relocations:
+                targets = definitions.get(label)
+                if targets is None:
+                    raise Exception("Unknown label: " + label)
+                if len(targets) > 1:
+                    raise Exception("Label {0} is defined more than once".format(label))
+                index = base + offset
+                self.binary[index] = (targets[0][1] - index - 1) % WORD_SIZE
+        self.labels = {name : targets[0][1] for name, targets in definitions.items()
+            if len(targets) == 1}
+        self.localLabels = {name : targets for name, targets in definitions.items()
+            if len(targets) > 1}
+        return self.binary
+
+    def debugInfo(self, fileNames):
+        labels = dict(self.labels)
+        for name, targets in self.localLabels.items():
+            for fileIndex, address in targets:
+                labels["{0}:{1}".format(fileNames[fileIndex], name)] = address
+        return DebugInfo(fileNames, self.fileIndexes, self.lines, labels)
+
+class ObjectCache:
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source):
+        return hashlib.sha256(OBJECT_MAGIC + source.encode()).hexdigest()
+
+    def path(self, source):
+        return os.path.join(self.directory, self.key(source) + ".o")
+
+    def compile(self, source):
+        path = self.path(source)
+        if os.path.exists(path):
+            self.hits += 1
+            with open(path, 'rb') as cached:
+                return readObject(cached.read())
+        self.misses += 1
+        objectFile = Compiler().compileObject(source)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'wb') as output:
+            output.write(objectFile.toBytes())
+        os.replace(temporary, path)
+        return objectFile
+
+import sys
+import array
+def help():  # pragma: no cover
+    helpText = ("Usage: linker.py output.bin inputs... [-c cache]\n"
+                "\t output.bin - linked program filename, source lines and labels are written to output.dbg\n"
+                "\t inputs - assembly sources or .o object files, first one is placed at address 0x00\n"
+                "\t -c cache - object files cache directory, .vmcache by default\n")
+    print(helpText)
+
+def readInput(path, cache):  # pragma: no cover
+    try:
+        if path.endswith(".o"):
+            with open(path, 'rb') as source:
+                return readObject(source.read())
+        with open(path, 'r') as source:
+            return cache.compile(source.read())
+    except FileNotFoundError:
+        raise Exception ("Input file " + path + " not found")
+    except Exception as e:
+        raise Exception ("{0}: {1}".format(path, e))
+
+def main():  # pragma: no cover
+    arguments = sys.argv[1:]
+    cacheDirectory = ".vmcache"
+    if "-c" in arguments:
+        index = arguments.index("-c")
+        cacheDirectory = arguments[index + 1]
+        del arguments[index : index + 2]
+    if len(arguments) < 2:
+        help()
+        return
+    cache = ObjectCache(cacheDirectory)
+    objects = [readInput(path, cache) for path in arguments[1:]]
+    linker = Linker()
+    binary = linker.link(objects)
+    with open(arguments[0], 'wb') as output:
+        output.write(array.array('B', binary))
+    linker.debugInfo(arguments[1:]).save(debugInfoPath(arguments[0]))
+    print("Size of binary: " + str(len(binary)) + " bytes. "
+        + str(WORD_SIZE - len(binary)) + " bytes free left. "
+        + str(cache.hits) + " of " + str(cache.hits + cache.misses) + " sources taken from cache.")
+
+if __name__ == '__main__':  # pragma: no cover
+    try:
+        main()
+    except Exception as e:
+        print(e)
@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+from compiler import assembleBatch, findSources, summarize, loadManifest, saveManifest
+
+class BatchCompilerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def __writeSource(self, name, source):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as output:
+            output.write(source)
+        return path
+
+    def test_IfDirectoryAndGlobsAreExpanded(self):
+        first = self.__writeSource("a.asm", "HALT\n")
+        second = self.__writeSource("b.asm", "HALT\n")
+        self.__writeSource("c.txt", "HALT\n")
+        self.assertEqual(findSources([self.directory.name]), [first, second])
+        self.assertEqual(findSources([os.path.join(self.directory.name, "b*.asm"), second]), [second])
+
+    def test_IfFilesAreAssembledAndReported(self):
+        good = self.__writeSource("good.asm", "SET R0, 0x01\nHALT\n")
+        bad = self.__writeSource("bad.asm", "JMP nowhere\n")
+        manifest = {}
+        results = assembleBatch([good, bad], manifest, workers=2)
+        self.assertEqual([result["state"] for result in results], ["compiled", "failed"])
+        self.assertEqual(results[0]["size"], 4)
+        self.assertIn("Unknown label: nowhere", results[1]["error"])
+        with open(os.path.join(self.directory.name, "good.bin"), 'rb') as binary:
+            self.assertEqual(binary.read(), bytes([0x01, 0x00, 0x01, 0xFF]))
+        self.assertEqual(list(manifest), [good])
+        summary = summarize(results)
+        self.assertEqual((summary["compiled"], summary["skipped"], summary["failed"]), (1, 0, 1))
+
+    def test_IfUnchangedFilesAreSkipped(self):
+        source = self.__writeSource("prog.asm", "HALT\n")
+        path = os.path.join(self.directory.name, "manifest.json")
+        manifest = {}
+        assembleBatch([source], manifest, workers=1)
+        saveManifest(path, manifest)
+        manifest = loadManifest(path)
+        self.assertEqual(assembleBatch([source], manifest, workers=1)[0]["state"], "skipped")
+        os.utime(source, ns=(0, 0))
+        self.assertEqual(assembleBatch([source], manifest, workers=1)[0]["state"], "skipped")
+        self.assertEqual(manifest[source]["mtime"], 0)
+        self.assertEqual(assembleBatch([source], manifest, optimize=True, workers=1)[0]["state"],
+            "compiled")
+        self.__writeSource("prog.asm", "SET R0, 0x01\nHALT\n")
+        result = assembleBatch([source], manifest, optimize=True, workers=1)[0]
+        self.assertEqual((result["state"], result["size"]), ("compiled", 4))
+
+    def test_IfMissingOutputIsRebuilt(self):
+        source = self.__writeSource("prog.asm", "HALT\n")
+        manifest = {}
+        assembleBatch([source], manifest, workers=1)
+        os.remove(os.path.join(self.directory.name, "prog.bin"))
+        self.assertEqual(assembleBatch([source], manifest, workers=1)[0]["state"], "compiled")
+
+    def test_IfMissingSourceIsReportedAsFailure(self):
+        missing = os.path.join(self.directory.name, "missing.asm")
+        result = assembleBatch([missing], {}, workers=1)[0]
+        self.assertEqual(result["state"], "failed")
+        self.assertIsNotNone(result["error"])
+        self.assertEqual(loadManifest(os.path.join(self.directory.name, "none.json")), {})
+
+if __name__ == '__main__':
+    unittest.main()
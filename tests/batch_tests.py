@@ -0,0 +1,94 @@
+import unittest
+import contextlib
+import random
+from io import StringIO
+from compiler import Compiler
+from vm.batch import BatchCpu
+from vm.cpu import Cpu
+from vm.terminal import Terminal
+from tests.cpu_tests import TerminalFake
+
+class BatchCpuTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.compiler = Compiler()
+
+    def __runOnCpu(self, program, registers):
+        cpu = Cpu([0x00] * 256, TerminalFake(), strict=True)
+        for name, value in registers.items():
+            cpu.registers[name] = value
+        try:
+            with contextlib.redirect_stdout(StringIO()):
+                cpu.run(program)
+        except Exception as e:
+            return cpu, str(e)
+        return cpu, None
+
+    def test_IfItHasSameSemanticsAsCpuForDivergentPrograms(self):
+        program = self.compiler.compile(
+            "SET R7, 1\n"
+            "SET R6, 0\n"
+            "loop:\n"
+            "ADD R2, R1\n"
+            "MUL R3, R2\n"
+            "SHL R4\n"
+            "SUB R5, R1\n"
+            "PUSH FR\n"
+            "STOR R5, R4\n"
+            "SUB R0, R7\n"
+            "CMP R0, R6\n"
+            "JNZ loop\n"
+            "CMP R2, R1\n"
+            "JBE end\n"
+            "CALL function\n"
+            "end:\n"
+            "HALT\n"
+            "function:\n"
+            "XOR R4, R2\n"
+            "POP R6\n"
+            "PUSH R6\n"
+            "RET\n")
+        random.seed(0x1337)
+        inputs = [{"R0" : random.randrange(1, 9), "R1" : random.randrange(256),
+            "R2" : random.randrange(256), "R4" : random.randrange(256)} for _ in range(64)]
+        batch = BatchCpu(len(inputs))
+        for name in ("R0", "R1", "R2", "R4"):
+            batch.registers[name] = [values[name] for values in inputs]
+        batch.run(program)
+        for instance, values in enumerate(inputs):
+            cpu, error = self.__runOnCpu(program, values)
+            self.assertEqual(batch.errors.get(instance), error)
+            for name in cpu.available_registers:
+                self.assertEqual(batch.registers[name][instance], cpu.registers[name])
+            self.assertEqual(batch.ram[instance].tolist(), cpu.ram)
+
+    def test_IfFaultStopsOnlyFaultingInstance(self):
+        program = [0x13, 0x00, 0x01, 0xFF]
+        batch = BatchCpu(2)
+        batch.registers["R0"] = 0x06
+        batch.registers["R1"] = [0x02, 0x00]
+        batch.run(program)
+        self.assertEqual(batch.registers["R0"].tolist(), [0x03, 0x06])
+        self.assertEqual(batch.errors, {1 : "Division by 0 error"})
+
+    def test_IfMemoryAccessOutsideAddressSpaceFaults(self):
+        program = [0x02, 0x01, 0x00, 0xFF]
+        batch = BatchCpu(2)
+        batch.registers["R0"] = [0xFF, 0x100]
+        batch.ram[0, 0xFF] = 0xAB
+        batch.run(program)
+        self.assertEqual(batch.registers["R1"].tolist(), [0xAB, 0x00])
+        self.assertIn(1, batch.errors)
+
+    def test_IfUnknownRegisterFaults(self):
+        batch = BatchCpu(1)
+        batch.run([0x00, 0x00, 0xAA])
+        self.assertEqual(batch.errors, {0 : "Unknown register 170"})
+
+    def test_IfEachInstanceWritesToItsOwnTerminal(self):
+        terminals = [Terminal(), Terminal()]
+        program = [0x51, 0x02, 0x00, 0xFF]
+        batch = BatchCpu(2, terminals=terminals)
+        batch.registers["R0"] = [65, 66]
+        batch.run(program)
+        self.assertEqual([terminal.writebuffer for terminal in terminals], ["A", "B"])
@@ -1,5 +1,7 @@
 import unittest
 from compiler import Compiler
+from vm.cpu import Cpu
+from vm.terminal import ScriptedTerminal
 
 class CpuTests(unittest.TestCase):
     def __init__(self, parameters):
@@ -89,3 +91,120 @@ class CpuTests(unittest.TestCase):
     def test_IfItThrowsExceptionWhenImmValueCantBeDecoded(self):
         sourceCode = ("SET R1, trolololo\n")
         self.assertRaises(Exception, self.compiler.compile, sourceCode)  
+
+    def test_IfLabelAndInstructionCanShareLine(self):
+        sourceCode = ("start: SET R0, 0x01\n"
+            "JMP start\n")
+        binary = self.compiler.compile(sourceCode)
+        self.assertEquals(binary, [0x01, 0x00, 0x01, 0x40, 0xFB])
+
+    def test_IfUnknownLabelErrorPointsAtLineOfUse(self):
+        sourceCode = ("SET R0, 0x01\n"
+            "JMP notExistingLabel\n")
+        with self.assertRaisesRegex(Exception, "line 2.*\n.*Unknown label: notExistingLabel"):
+            self.compiler.compile(sourceCode)
+
+    def test_IfOnlyForwardJumpsAreFixedUp(self):
+        sourceCode = ("start:\n"
+            "JZ start\n"
+            "JNZ end\n"
+            "JC 0x00\n"
+            "end:\n")
+        binary = self.compiler.compile(sourceCode)
+        self.assertEquals(binary, [0x21, 0xFF, 0x22, 0x02, 0x23, 0xFA])
+        self.assertEquals(self.compiler.fixups, [(0x03, "end", 2)])
+
+    def test_IfLabelsDoNotLeakBetweenCompilations(self):
+        self.compiler.compile("end:\nHALT\n")
+        binary = self.compiler.compile("JMP end\nHALT\nend:\n")
+        self.assertEquals(binary, [0x40, 0x01, 0xFF])
+
+class OptimizerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.compiler = Compiler()
+
+    def __run(self, binary):
+        terminal = ScriptedTerminal()
+        cpu = Cpu([0x00] * 256, terminal)
+        cpu.run(binary)
+        return dict(cpu.registers, PC=None), terminal.output, cpu.instructionsCount
+
+    def test_IfRedundantMovIsRemovedAndLabelsAreMoved(self):
+        sourceCode = ("MOV R1, R1\n"
+            "start:\n"
+            "MOV R0, R0\n"
+            "SET R0, 0x01\n"
+            "JMP start\n")
+        binary = self.compiler.compile(sourceCode, optimize=True)
+        self.assertEquals(binary, [0x01, 0x00, 0x01, 0x40, 0xFB])
+        self.assertEquals(self.compiler.labels, {"start" : 0x00})
+
+    def test_IfJumpToRemovedInstructionLandsOnNextOne(self):
+        sourceCode = ("JMP skip\n"
+            "SET R0, 0x01\n"
+            "skip:\n"
+            "MOV R1, R1\n"
+            "SET R0, 0x05\n"
+            "HALT\n")
+        binary = self.compiler.compile(sourceCode, optimize=True)
+        self.assertEquals(binary, [0x01, 0x00, 0x05, 0xFF])
+        self.assertEquals(self.__run(binary)[0]["R0"], 0x05)
+
+    def test_IfPushAndPopOfSameRegisterAreCollapsed(self):
+        binary = self.compiler.compile("PUSH R0\nPOP R0\nPUSH R0\nPOP R1\nHALT\n", optimize=True)
+        self.assertEquals(binary, [0x30, 0x00, 0x31, 0x01, 0xFF])
+
+    def test_IfPopBeingJumpTargetIsKept(self):
+        sourceCode = ("PUSH R0\n"
+            "back:\n"
+            "POP R0\n"
+            "JZ back\n")
+        binary = self.compiler.compile(sourceCode, optimize=True)
+        self.assertEquals(binary, [0x30, 0x00, 0x31, 0x00, 0x21, 0xFC])
+
+    def test_IfJumpsToUnconditionalJumpsAreThreaded(self):
+        sourceCode = ("JZ first\n"
+            "CALL second\n"
+            "HALT\n"
+            "first:\n"
+            "JMP second\n"
+            "second:\n"
+            "JMP end\n"
+            "SET R0, 0x01\n"
+            "end:\n"
+            "RET\n")
+        binary = self.compiler.compile(sourceCode, optimize=True)
+        self.assertEquals(binary, [0x21, 0x03, 0x42, 0x01, 0xFF, 0x44])
+
+    def test_IfUnreachableCodeIsDropped(self):
+        sourceCode = ("SET R0, 0x01\n"
+            "JMP end\n"
+            "SET R0, 0x02\n"
+            "RET\n"
+            "end:\n"
+            "HALT\n"
+            "SET R0, 0x03\n")
+        binary = self.compiler.compile(sourceCode, optimize=True)
+        self.assertEquals(binary, [0x01, 0x00, 0x01, 0xFF])
+
+    def test_IfCodeWithComputedJumpsIsNotMoved(self):
+        sourceCode = ("SET R1, 0x06\n"
+            "MOV R0, R0\n"
+            "JMPR R1\n"
+            "HALT\n"
+            "SET R0, 0x01\n")
+        self.assertEquals(self.compiler.compile(sourceCode, optimize=True),
+            Compiler().compile(sourceCode))
+
+    def test_IfOptimizedProgramBehavesTheSame(self):
+        with open("examples/printInt.asm") as source:
+            sourceCode = source.read() + ("MOV R3, R3\n"
+                "PUSH R3\n"
+                "POP R3\n"
+                "HALT\n"
+                "SET R3, 0x01\n")
+        binary = Compiler().compile(sourceCode)
+        optimized = self.compiler.compile(sourceCode, optimize=True)
+        self.assertLess(len(optimized), len(binary))
+        self.assertEqual(self.__run(optimized), self.__run(binary))
@@ -1,14 +1,31 @@
 import unittest
-from vm.cpu import Cpu
+import asyncio
+import contextlib
+import mmap
+import tempfile
+from io import StringIO
+from vm.cpu import Cpu, Stop
 from vm.port import Port
+from vm.jit import BlockCompiler
+from vm.terminal import ScriptedTerminal
+from compiler import Compiler
 from unittest.mock import Mock
 
 class TerminalFake:
     def __init__(self):
-        self.controlPort = Port(None, None)
+        self.controlPort = Port(None, None, status=True)
         self.dataInPort  = Port(None, None)
         self.dataOutPort = Port(None, None)
 
+def runCoroutine(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
 class CpuTests(unittest.TestCase):
     def __init__(self, parameters):
         unittest.TestCase.__init__(self, parameters)
@@ -35,6 +52,202 @@ class CpuTests(unittest.TestCase):
     def test_IfCpuProgamCounterHaveCorrectValueAtBoot(self):
         self.assertEquals(self.cpu.registers["PC"], 0x00)
 
+    def test_IfRegistersViewIsBackedByRegisterFile(self):
+        self.cpu.registers["R3"] = 0xAB
+        self.assertEqual(self.cpu.registerFile[0x03], 0xAB)
+        self.cpu.registerFile[0xFD] = 0x02
+        self.assertEqual(self.cpu.registers["FR"], 0x02)
+        self.assertEqual(set(self.cpu.registers), self.cpu.available_registers)
+
+    def test_IfUnknownRegisterNameRaisesKeyError(self):
+        self.assertRaises(KeyError, self.cpu.registers.__getitem__, "R8")
+
+    def test_IfCpuHasNoInstanceDictionary(self):
+        self.assertFalse(hasattr(self.cpu, "__dict__"))
+
+    def test_IfExecutedInstructionsAreCounted(self):
+        program = [0x01, 0x00, 0x05, 0x01, 0x01, 0x01, 0x01, 0x02, 0x00,
+                   0x11, 0x00, 0x01, 0x10, 0x03, 0x01, 0x20, 0x00, 0x02,
+                   0x22, 0xF5, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.instructionsCount, 24)
+        self.cpu.run([0xFF])
+        self.assertEqual(self.cpu.instructionsCount, 1)
+
+    def test_IfSnapshotRestoresFullMachineState(self):
+        program = [0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF]
+        self.cpu.run(program)
+        blob = self.cpu.snapshot()
+        cpu = Cpu([0x00] * 256, TerminalFake())
+        cpu.restore(blob)
+        self.assertEqual(dict(cpu.registers), dict(self.cpu.registers))
+        self.assertEqual(cpu.ram, self.cpu.ram)
+        self.assertEqual(list(cpu.rom), list(self.cpu.rom))
+        self.assertEqual(cpu.instructionsCount, 3)
+        self.assertFalse(cpu.running)
+
+    def test_IfSnapshotKeepsValuesOutsideOfByteRange(self):
+        self.cpu.registers["R0"] = -0xFF
+        self.ram[0x10] = 0x100
+        cpu = Cpu([0x00] * 256, TerminalFake())
+        cpu.restore(self.cpu.snapshot())
+        self.assertEqual(cpu.registers["R0"], -0xFF)
+        self.assertEqual(cpu.ram[0x10], 0x100)
+
+    def test_IfSnapshotIsRestoredIntoByteMemory(self):
+        program = [0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF]
+        self.cpu.run(program)
+        ram = bytearray(256)
+        Cpu(ram, TerminalFake()).restore(self.cpu.snapshot())
+        self.assertEqual(list(ram), self.ram)
+        self.ram[0x10] = 0x100
+        self.assertRaises(Exception, Cpu(ram, TerminalFake()).restore, self.cpu.snapshot())
+        self.assertEqual(len(ram), 256)
+
+    def test_IfRestoreRejectsInvalidData(self):
+        self.assertRaises(Exception, self.cpu.restore, b"NOPE" + bytes(64))
+        other = Cpu([0x00] * 16, TerminalFake())
+        self.assertRaises(Exception, other.restore, self.cpu.snapshot())
+
+    def test_IfRestoredCpuResumesExecution(self):
+        program = [0x01, 0x00, 0x01, 0xFF, 0x01, 0x01, 0x02, 0xFF]
+        self.cpu.run(program)
+        cpu = Cpu([0x00] * 256, TerminalFake())
+        cpu.restore(self.cpu.snapshot())
+        cpu.resume()
+        self.assertEqual(cpu.registers["R0"], 0x01)
+        self.assertEqual(cpu.registers["R1"], 0x02)
+        self.assertEqual(cpu.registers["PC"], 0x08)
+
+    def test_IfCloneIsIndependentCopy(self):
+        program = [0x01, 0x00, 0x01, 0xFF, 0x30, 0x00, 0xFF]
+        self.cpu.run(program)
+        clone = self.cpu.clone()
+        clone.resume()
+        self.assertEqual(clone.registers["SP"], 0xFE)
+        self.assertEqual(clone.ram[0xFE], 0x01)
+        self.assertEqual(self.cpu.registers["SP"], 0xFF)
+        self.assertEqual(self.cpu.ram[0xFE], 0x00)
+
+    def test_IfItRunsProgramsFromBuffers(self):
+        program = bytes([0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF])
+        for rom in (program, bytearray(program), memoryview(program)):
+            self.cpu.registers["SP"] = 0xFF
+            self.cpu.run(rom)
+            self.assertEqual(self.cpu.registers["R0"], 0xAB)
+            self.assertEqual(self.cpu.ram[0xFE], 0xAB)
+
+    def test_IfItRunsMemoryMappedProgram(self):
+        with tempfile.TemporaryFile() as binary:
+            binary.write(bytes([0x01, 0x00, 0xAB, 0xFF]) + b"\x00" * 0xFF)
+            binary.flush()
+            rom = mmap.mmap(binary.fileno(), 0, access=mmap.ACCESS_READ)
+            self.cpu.run(rom)
+            self.assertIs(self.cpu.rom, rom)
+            rom.close()
+        self.assertEqual(self.cpu.registers["R0"], 0xAB)
+
+    def test_IfItUsesBytearrayRam(self):
+        cpu = Cpu(bytearray(256), self.terminal, self.cpu.debug, self.cpu.jit)
+        cpu.registers["R1"] = 0x10
+        cpu.run([0x01, 0x00, 0xAB, 0x03, 0x01, 0x00, 0x02, 0x02, 0x01, 0xFF])
+        self.assertEqual(cpu.ram[0x10], 0xAB)
+        self.assertEqual(cpu.registers["R2"], 0xAB)
+        clone = cpu.clone()
+        clone.ram[0x10] = 0x00
+        self.assertEqual(cpu.ram[0x10], 0xAB)
+
+    def test_IfStepExecutesSingleInstruction(self):
+        self.cpu.load([0x01, 0x00, 0x01, 0x01, 0x01, 0x02, 0xFF])
+        self.assertEqual(self.cpu.step(), 1)
+        self.assertEqual(self.cpu.registers["R0"], 0x01)
+        self.assertEqual(self.cpu.registers["R1"], 0x00)
+        self.assertEqual(self.cpu.registers["PC"], 0x03)
+        self.assertEqual(self.cpu.instructionsCount, 1)
+        self.assertEqual(self.cpu.step(5), 2)
+        self.assertFalse(self.cpu.running)
+        self.assertEqual(self.cpu.step(), 0)
+
+    def test_IfRunForStopsAfterBudgetWithStatePreserved(self):
+        program = [0x01, 0x00, 0x05, 0x01, 0x01, 0x01, 0x01, 0x02, 0x00,
+                   0x11, 0x00, 0x01, 0x10, 0x03, 0x01, 0x20, 0x00, 0x02,
+                   0x22, 0xF5, 0xFF]
+        self.cpu.load(program)
+        self.assertEqual(self.cpu.runFor(5), 5)
+        self.assertEqual(self.cpu.registers["R0"], 0x04)
+        self.assertEqual(self.cpu.registers["R3"], 0x01)
+        self.assertEqual(self.cpu.registers["PC"], 0x0F)
+        self.assertEqual(self.cpu.runFor(10), 10)
+        self.assertEqual(self.cpu.registers["R0"], 0x02)
+        self.assertEqual(self.cpu.registers["R3"], 0x03)
+        self.assertEqual(self.cpu.registers["PC"], 0x09)
+        self.assertTrue(self.cpu.running)
+        self.assertEqual(self.cpu.runFor(100), 9)
+        self.assertEqual(self.cpu.registers["R0"], 0x00)
+        self.assertEqual(self.cpu.registers["R3"], 0x05)
+        self.assertEqual(self.cpu.instructionsCount, 24)
+        self.assertEqual(self.cpu.runFor(100), 0)
+
+    def test_IfExampleProgramGivesTheSameResultInEveryMode(self):
+        with open("examples/printInt.asm") as source:
+            program = Compiler().compile(source.read())
+        terminal = ScriptedTerminal()
+        cpu = Cpu([0x00] * 256, terminal, self.cpu.debug, self.cpu.jit)
+        with contextlib.redirect_stdout(StringIO()):
+            cpu.run(program)
+        self.assertEqual(terminal.output, "1337\n")
+        self.assertEqual(cpu.instructionsCount, 46)
+        self.assertEqual(cpu.registers["SP"], 0xFF)
+
+    def test_IfJumpIntoTheMiddleOfInstructionPairExecutesOnlySecondOne(self):
+        program = [0x40, 0x03, 0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R0"], 0x00)
+        self.assertEqual(self.cpu.registers["SP"], 0xFE)
+        self.assertEqual(self.cpu.instructionsCount, 3)
+        self.cpu.registers["SP"] = 0xFF
+        self.cpu.run(program[2:])
+        self.assertEqual(self.cpu.ram[0xFE], 0xAB)
+        self.assertEqual(self.cpu.instructionsCount, 3)
+
+    def test_IfBudgetEndingInsideInstructionPairIsExact(self):
+        self.cpu.load([0x01, 0x00, 0x05, 0x01, 0x01, 0x03, 0x20, 0x00, 0x01, 0x21, 0x00, 0xFF])
+        self.assertEqual(self.cpu.runFor(1), 1)
+        self.assertEqual(self.cpu.runFor(2), 2)
+        self.assertEqual(self.cpu.registers["PC"], 0x09)
+        self.assertEqual(self.cpu.runFor(3), 2)
+        self.assertFalse(self.cpu.running)
+
+    def __asyncCpu(self, read=None, write=None):
+        terminal = TerminalFake()
+        terminal.dataInPort = Port(read, None)
+        terminal.dataOutPort = Port(None, write)
+        return Cpu([0x00] * 256, terminal, self.cpu.debug, self.cpu.jit)
+
+    def test_IfRunAsyncSuspendsOnAsynchronousPorts(self):
+        async def main():
+            queue = asyncio.Queue()
+            reader = self.__asyncCpu(read=queue.get)
+            writer = self.__asyncCpu(write=queue.put)
+            await asyncio.gather(
+                reader.runAsync([0x50, 0x01, 0x00, 0x50, 0x01, 0x01, 0xFF]),
+                writer.runAsync([0x01, 0x00, 0x41, 0x51, 0x02, 0x00,
+                                 0x01, 0x00, 0x42, 0x51, 0x02, 0x00, 0xFF], quantum=1))
+            return reader
+        with contextlib.redirect_stdout(StringIO()):
+            reader = runCoroutine(main())
+        self.assertEqual(reader.registers["R0"], 0x41)
+        self.assertEqual(reader.registers["R1"], 0x42)
+        self.assertEqual(reader.registers["PC"], 0x07)
+        self.assertEqual(reader.instructionsCount, 3)
+        self.assertFalse(reader.running)
+
+    def test_IfAsynchronousPortRaisesInSynchronousRun(self):
+        async def read():
+            return 0x41
+        cpu = self.__asyncCpu(read=read)
+        self.assertRaises(Exception, cpu.run, [0x50, 0x01, 0x00, 0xFF])
+
     def test_IfSourceRegisterDecodingThrowsException(self):
         program = [0x00,0x00,0xAA]
         self.assertRaises(Exception, self.cpu.run, program)
@@ -44,10 +257,152 @@ class CpuTests(unittest.TestCase):
         self.assertRaises(Exception, self.cpu.run, program)
 
     def test_IfMemoryAddressingThrowExceptionForStrageAddressSpaceAccess(self):
+        self.cpu.strict = True
         self.cpu.registers["R0"] = -0xFF
         program = [0x02, 0x01, 0x00, 0xFF]
         self.assertRaises(Exception, self.cpu.run, program)
 
+    def test_IfResetRestoresPowerOnStateInPlace(self):
+        self.ram[0x10] = 0x42
+        cpu = Cpu(self.ram, self.terminal, self.cpu.debug, self.cpu.jit)
+        registerFile = cpu.registerFile
+        program = bytes([0x01, 0x00, 0xAB, 0x30, 0x00, 0x01, 0xFD, 0x02, 0xFF])
+        with contextlib.redirect_stdout(StringIO()):
+            cpu.run(program)
+            cpu.reset()
+            self.assertEqual(self.ram[0xFE], 0x00)
+            self.assertEqual(self.ram[0x10], 0x42)
+            self.assertEqual(dict(cpu.registers), {"R0" : 0, "R1" : 0, "R2" : 0, "R3" : 0,
+                "R4" : 0, "R5" : 0, "R6" : 0, "R7" : 0, "FR" : 0, "SP" : 0xFF, "PC" : 0})
+            self.assertIs(cpu.registerFile, registerFile)
+            self.assertIs(cpu.ram, self.ram)
+            self.assertEqual(cpu.instructionsCount, 0)
+            self.assertFalse(cpu.running)
+            cpu.load(program)
+            cpu.resume()
+        self.assertEqual(cpu.registers["FR"], 0x02)
+        self.assertEqual(cpu.instructionsCount, 4)
+
+    def test_IfReloadedProgramIsNotPaddedAgain(self):
+        program = bytes([0x01, 0x00, 0xAB, 0xFF])
+        self.cpu.load(program)
+        rom = self.cpu.rom
+        self.cpu.load(program)
+        self.assertIs(self.cpu.rom, rom)
+        self.cpu.load(bytes([0x01, 0x00, 0xCD, 0xFF]))
+        self.assertIsNot(self.cpu.rom, rom)
+
+    def test_IfBreakpointStopsBeforeInstruction(self):
+        program = [0x01, 0x00, 0x01, 0x01, 0x01, 0x02, 0x01, 0x02, 0x03, 0xFF]
+        self.cpu.addBreakpoint(0x03)
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("breakpoint", 0x03, 0x03, None))
+        self.assertFalse(self.cpu.running)
+        self.assertEqual(self.cpu.registers["R0"], 0x01)
+        self.assertEqual(self.cpu.registers["R1"], 0x00)
+        self.assertEqual(self.cpu.registers["PC"], 0x03)
+        self.assertEqual(self.cpu.instructionsCount, 1)
+        self.cpu.resume()
+        self.assertIsNone(self.cpu.stopReason)
+        self.assertEqual(self.cpu.registers["R2"], 0x03)
+        self.assertEqual(self.cpu.instructionsCount, 4)
+
+    def test_IfBreakpointInLoopStopsOnEveryIteration(self):
+        program = [0x01, 0x00, 0x03, 0x01, 0x01, 0x01,
+                   0x11, 0x00, 0x01, 0x20, 0x00, 0x02, 0x22, 0xF8, 0xFF]
+        self.cpu.addBreakpoint(0x06)
+        self.cpu.run(program)
+        stops = 0
+        while self.cpu.running is False and self.cpu.stopReason is not None:
+            stops += 1
+            self.cpu.resume()
+        self.assertEqual(stops, 3)
+        self.cpu.removeBreakpoint(0x06)
+        self.cpu.run(program)
+        self.assertIsNone(self.cpu.stopReason)
+
+    def test_IfMachineCanBeSteppedFromBreakpoint(self):
+        program = [0x01, 0x00, 0x03, 0x01, 0x01, 0x01,
+                   0x11, 0x00, 0x01, 0x20, 0x00, 0x02, 0x22, 0xF8, 0xFF]
+        self.cpu.addBreakpoint(0x06)
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("breakpoint", 0x06, 0x06, None))
+        self.assertEqual(self.cpu.step(), 1)
+        self.assertIsNone(self.cpu.stopReason)
+        self.assertTrue(self.cpu.running)
+        self.assertEqual(self.cpu.registers["PC"], 0x09)
+        self.assertEqual(self.cpu.registers["R0"], 0x02)
+        self.assertEqual(self.cpu.runFor(100), 2)
+        self.assertEqual(self.cpu.stopReason, Stop("breakpoint", 0x06, 0x06, None))
+        self.cpu.clearBreakpoints()
+        self.assertEqual(self.cpu.runFor(100), 7)
+        self.assertFalse(self.cpu.running)
+        self.assertEqual(self.cpu.step(), 0)
+
+    def test_IfRegisterWatchpointStopsAfterChange(self):
+        program = [0x01, 0x00, 0x01, 0x01, 0x01, 0x00, 0x01, 0x01, 0x02, 0x01, 0x02, 0x03, 0xFF]
+        self.cpu.watchRegister("R1")
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("register", 0x06, "R1", 0x02))
+        self.assertEqual(self.cpu.registers["PC"], 0x09)
+        self.cpu.unwatchRegister("R1")
+        self.cpu.resume()
+        self.assertEqual(self.cpu.registers["R2"], 0x03)
+        self.assertRaises(Exception, self.cpu.watchRegister, "R8")
+
+    def test_IfMemoryWatchpointsStopOnAccess(self):
+        program = [0x01, 0x00, 0xAB, 0x01, 0x01, 0x10, 0x03, 0x01, 0x00,
+                   0x02, 0x02, 0x01, 0x30, 0x00, 0x31, 0x03, 0xFF]
+        self.cpu.watchMemory(0x10)
+        self.cpu.watchMemory(0xFE, read=True, write=False)
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("write", 0x06, 0x10, 0xAB))
+        self.cpu.resume()
+        self.assertEqual(self.cpu.stopReason, Stop("read", 0x0E, 0xFE, 0xAB))
+        self.assertEqual(self.cpu.registers["R3"], 0xAB)
+        self.cpu.clearBreakpoints()
+        self.cpu.watchMemory(0x10, read=True)
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("write", 0x06, 0x10, 0xAB))
+        self.cpu.resume()
+        self.assertEqual(self.cpu.stopReason, Stop("read", 0x09, 0x10, 0xAB))
+        self.cpu.unwatchMemory(0x10)
+        self.cpu.resume()
+        self.assertIsNone(self.cpu.stopReason)
+        self.assertFalse(self.cpu.running)
+
+    def test_IfCallAndReturnAreWatchedAsStackAccess(self):
+        program = [0x42, 0x01, 0xFF, 0x44]
+        self.cpu.watchMemory(0xFE, read=True)
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.stopReason, Stop("write", 0x00, 0xFE, 0x02))
+        self.cpu.resume()
+        self.assertEqual(self.cpu.stopReason, Stop("read", 0x03, 0xFE, 0x02))
+
+    def test_IfFastMemoryAccessWrapsAddressAround(self):
+        self.ram[0x01] = 0xAB
+        self.cpu.registers["R0"] = -0xFF
+        self.cpu.registers["R2"] = 0x1FE
+        self.cpu.run([0x02, 0x01, 0x00, 0x03, 0x02, 0x01, 0xFF])
+        self.assertEqual(self.cpu.registers["R1"], 0xAB)
+        self.assertEqual(self.ram[0xFE], 0xAB)
+
+    def test_IfSmallMemoryIsAlwaysChecked(self):
+        cpu = Cpu([0x00] * 0x10, self.terminal, self.cpu.debug, self.cpu.jit)
+        cpu.registers["R0"] = 0x10
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, cpu.run, [0x02, 0x01, 0x00, 0xFF])
+
+    def test_IfStrictModeCanBeSwitchedForLoadedProgram(self):
+        program = [0x02, 0x01, 0x00, 0xFF]
+        self.cpu.registers["R0"] = 0x100
+        self.cpu.run(program)
+        self.cpu.strict = True
+        self.assertTrue(self.cpu.clone().strict)
+        self.cpu.registers["R0"] = 0x100
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, self.cpu.run, program)
+
     def test_MOV_instructionHandling(self):
         self.cpu.registers["R0"] = 0xAB
         program = [0x00, 0x01, 0x00, 0xFF]
@@ -221,6 +576,39 @@ class CpuTests(unittest.TestCase):
         self.cpu.run(program)
         self.assertEquals(self.cpu.registers["FR"] & 0x02, 0x02)    
 
+    def test_IfFlagRegisterOperandSeesExactFlags(self):
+        program = [0x01, 0xFD, 0x80, 0x01, 0x01, 0x03, 0x12, 0xFD, 0x01, 0x00, 0x02, 0xFD,
+                   0x20, 0x01, 0x01, 0x30, 0xFD, 0x31, 0x03, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R2"], 0x80)
+        self.assertEqual(self.cpu.registers["R3"], 0x81)
+        self.assertEqual(self.cpu.registers["FR"], 0x81)
+        for opcode, destination, source, expectedR2, expectedFR in (
+                (0x10, 0xFD, 0x01, 0x09, 0x08), (0x10, 0x02, 0xFD, 0x0E, 0x05),
+                (0x11, 0xFD, 0x01, 0x09, 0x02), (0x11, 0x02, 0xFD, 0x04, 0x05),
+                (0x12, 0xFD, 0x01, 0x09, 0x0F), (0x12, 0x02, 0xFD, 0x2D, 0x05),
+                (0x13, 0xFD, 0x01, 0x09, 0x01), (0x13, 0x02, 0xFD, 0x01, 0x05),
+                (0x20, 0xFD, 0x01, 0x09, 0x04), (0x20, 0x02, 0xFD, 0x09, 0x04)):
+            self.cpu.registers["R2"] = 0x09
+            self.cpu.run([0x01, 0x01, 0x03, 0x01, 0xFD, 0x07, opcode, destination, source, 0xFF])
+            self.assertEqual(self.cpu.registers["R2"], expectedR2)
+            self.assertEqual(self.cpu.registers["FR"], expectedFR)
+
+    def test_IfFlagsOfValuesOutsideOfByteAreExact(self):
+        self.cpu.registers["R0"] = 0x12C
+        self.cpu.run([0x20, 0x00, 0x01, 0xFF])
+        self.assertEqual(self.cpu.registers["FR"], 0x00)
+        self.cpu.run([0x10, 0x01, 0x00, 0xFF])
+        self.assertEqual(self.cpu.registers["FR"], 0x02)
+
+    def test_IfDeviceSeesFlagsWhenPortIsWritten(self):
+        program = [0x01, 0x00, 0xFF, 0x01, 0x01, 0x01, 0x10, 0x00, 0x01, 0x51, 0x02, 0x00, 0xFF]
+        flags = []
+        self.cpu.terminal.dataOutPort.write = Mock(side_effect=lambda value:
+            flags.append(self.cpu.registers["FR"]))
+        self.cpu.run(program)
+        self.assertEqual(flags, [0x02])
+
     def test_JZ_instructionHandling(self):
         program = [0x20, 0x00, 0x01, 0x21, 0x01, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
         self.cpu.registers["R0"] = 0x1
@@ -343,4 +731,208 @@ class CpuTests(unittest.TestCase):
 
     def test_OUT_instructionHandlingRaisesWhenNoDeviceAvailable(self):
         program = [0x51, 0x99, 0x00, 0xFF]
-        self.assertRaises(Exception, self.cpu.run, program)
\ No newline at end of file
+        self.assertRaises(Exception, self.cpu.run, program)
+
+class PredecodedCpuTests(CpuTests):
+    def __init__(self, parameters):
+        CpuTests.__init__(self, parameters)
+        self.cpu = Cpu(self.ram, self.terminal)
+
+    def test_IfFailureInsideInstructionPairLeavesPreciseState(self):
+        for program, expectedPc, expectedCount in (
+                ([0x30, 0x00, 0x42, 0x00, 0xFF], 0x02, 0),
+                ([0x01, 0x00, 0x01, 0x30, 0x00, 0xFF], 0x05, 1)):
+            self.cpu.registers["SP"] = 0x00
+            with contextlib.redirect_stdout(StringIO()):
+                self.assertRaises(Exception, self.cpu.run, program)
+            self.assertEqual(self.cpu.registers["PC"], expectedPc)
+            self.assertEqual(self.cpu.instructionsCount, expectedCount)
+        self.cpu.registers["SP"] = 0x01
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, self.cpu.run, [0x30, 0x00, 0x42, 0x00, 0xFF])
+        self.assertEqual(self.cpu.registers["PC"], 0x04)
+        self.assertEqual(self.cpu.instructionsCount, 1)
+
+    def test_IfFailingReadInsidePollLoopLeavesPreciseState(self):
+        self.cpu.terminal.dataInPort.read = Mock(side_effect=Exception("Device failure"))
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, self.cpu.run,
+                [0x50, 0x01, 0x00, 0x20, 0x00, 0x02, 0x21, 0xF8, 0xFF])
+        self.assertEqual(self.cpu.registers["PC"], 0x03)
+        self.assertEqual(self.cpu.instructionsCount, 0)
+
+    def test_IfPollLoopParksCpuUntilDeviceStateChanges(self):
+        program = [0x50, 0x00, 0x00, 0x20, 0x00, 0x02, 0x21, 0xF8, 0x50, 0x01, 0x01, 0xFF]
+        self.cpu.terminal.controlPort.read = Mock(return_value=0x00)
+        self.cpu.terminal.dataInPort.read = Mock(return_value=0x41)
+        self.cpu.load(program)
+        self.assertEqual(self.cpu.runFor(100), 6)
+        self.assertTrue(self.cpu.idle)
+        self.assertTrue(self.cpu.running)
+        self.assertEqual(self.cpu.registers["PC"], 0x00)
+        self.assertEqual(self.cpu.skippedCycles, 94)
+        self.cpu.terminal.controlPort.read.return_value = 0x01
+        self.assertEqual(self.cpu.runFor(100), 5)
+        self.assertFalse(self.cpu.idle)
+        self.assertFalse(self.cpu.running)
+        self.assertEqual(self.cpu.registers["R1"], 0x41)
+        self.assertEqual(self.cpu.skippedCycles, 94)
+
+    def test_IfPollLoopReceivingNewValuesIsNotParked(self):
+        program = [0x01, 0x01, 0x78, 0x50, 0x01, 0x00, 0x20, 0x00, 0x01, 0x22, 0xF8, 0xFF]
+        self.cpu.terminal.dataInPort.read = Mock(side_effect=[ord(character)
+            for character in "a" * 300 + "x"])
+        self.cpu.load(program)
+        self.assertEqual(self.cpu.runFor(1000), 1 + 3 * 301 + 1)
+        self.assertFalse(self.cpu.running)
+        self.assertFalse(self.cpu.idle)
+        self.assertEqual(self.cpu.skippedCycles, 0)
+
+    def test_IfBlockingRunWaitsForParkedPollLoop(self):
+        program = [0x50, 0x00, 0x00, 0x20, 0x00, 0x02, 0x21, 0xF8, 0xFF]
+        self.cpu.terminal.controlPort.read = Mock(side_effect=[0x00, 0x00, 0x01])
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.instructionsCount, 10)
+        self.assertEqual(self.cpu.registers["R0"], 0x01)
+        self.assertFalse(self.cpu.idle)
+
+    def test_IfPollLoopIsNotParkedWhenFlagsDoNotDependOnPort(self):
+        program = [0x50, 0x00, 0x00, 0x20, 0x01, 0x02, 0x21, 0xF8, 0xFF]
+        self.cpu.terminal.controlPort.read = Mock(return_value=0x00)
+        self.cpu.load(program)
+        self.assertEqual(self.cpu.runFor(30), 30)
+        self.assertFalse(self.cpu.idle)
+        self.assertEqual(self.cpu.skippedCycles, 0)
+
+    def test_IfFastLoopIsUsedAgainWhenBreakpointsAreRemoved(self):
+        program = [0x50, 0x00, 0x00, 0x20, 0x00, 0x02, 0x21, 0xF8, 0xFF]
+        self.cpu.terminal.controlPort.read = Mock(return_value=0x00)
+        self.cpu.addBreakpoint(0x08)
+        self.cpu.load(program)
+        self.cpu.runFor(10)
+        self.assertFalse(self.cpu.idle)
+        self.cpu.clearBreakpoints()
+        self.cpu.runFor(10)
+        self.assertTrue(self.cpu.idle)
+
+    def test_IfFastLoopDoesNotTraceExecution(self):
+        out = StringIO()
+        with contextlib.redirect_stdout(out):
+            self.cpu.run([0x01, 0x00, 0xAB, 0xFF])
+        self.assertEqual(out.getvalue(), "")
+
+    def test_IfTracedLoopIsSelectedWhenDebugIsTurnedOn(self):
+        self.cpu.debug = True
+        out = StringIO()
+        with contextlib.redirect_stdout(out):
+            self.cpu.run([0x01, 0x00, 0xAB, 0xFF])
+        self.assertEqual(out.getvalue().splitlines(), [
+            "PC:0x00 [DEBUG] Executing instruction: 0x01",
+            "PC:0x00 [DEBUG] Setting register R0, with 0xAB",
+            "PC:0x03 [DEBUG] Executing instruction: 0xFF"])
+
+    def test_IfDecodedRomIsInvalidatedOnReload(self):
+        self.cpu.run([0x01, 0x00, 0xAB, 0xFF])
+        self.assertEqual(self.cpu.registers["R0"], 0xAB)
+        self.cpu.run([0x01, 0x00, 0xCD, 0xFF])
+        self.assertEqual(self.cpu.registers["R0"], 0xCD)
+
+    def test_IfDecodedRomIsInvalidatedWhenProgramIsModifiedInPlace(self):
+        program = [0x01, 0x00, 0xAB, 0xFF]
+        self.cpu.run(program)
+        program[2] = 0xCD
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R0"], 0xCD)
+
+    def test_IfJumpIntoTheMiddleOfInstructionIsDecodedFromThatAddress(self):
+        program = [0x40, 0x01, 0x01, 0x01, 0x00, 0xAB, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R0"], 0xAB)
+
+
+class CompiledCpuTests(CpuTests):
+    def __init__(self, parameters):
+        CpuTests.__init__(self, parameters)
+        self.cpu = Cpu(self.ram, self.terminal, jit=True)
+
+    def test_IfLoopIsExecutedInsideSingleBlock(self):
+        program = [0x01, 0x00, 0x05, 0x01, 0x01, 0x01, 0x01, 0x02, 0x00,
+                   0x11, 0x00, 0x01, 0x10, 0x03, 0x01, 0x20, 0x00, 0x02,
+                   0x22, 0xF5, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R0"], 0x00)
+        self.assertEqual(self.cpu.registers["R3"], 0x05)
+        self.assertEqual(self.cpu.registers["FR"], 0x01)
+        self.assertEqual(self.cpu.registers["PC"], 0x15)
+
+    def test_IfRegistersAreWrittenBackBeforeOUT(self):
+        program = [0x01, 0x00, 0x12, 0x51, 0x02, 0x00, 0xFF]
+        registers = []
+        self.cpu.terminal.dataOutPort.write = Mock(side_effect=lambda value:
+            registers.append(self.cpu.registers["R0"]))
+        self.cpu.run(program)
+        self.assertEqual(registers, [0x12])
+
+    def test_IfWriteToProgramCounterEndsBlock(self):
+        program = [0x01, 0xFF, 0x06, 0x01, 0x00, 0xAB, 0xFF]
+        self.cpu.run(program)
+        self.assertEqual(self.cpu.registers["R0"], 0x00)
+        self.assertEqual(self.cpu.registers["PC"], 0x07)
+
+    def test_IfRegistersAreWrittenBackWhenBlockRaises(self):
+        program = [0x01, 0x00, 0x12, 0x13, 0x00, 0x01, 0xFF]
+        self.assertRaises(Exception, self.cpu.run, program)
+        self.assertEqual(self.cpu.registers["R0"], 0x12)
+
+    def test_IfFailureInsideBlockLeavesPreciseState(self):
+        for program, stackPointer in (([0x30, 0x00, 0x42, 0x00, 0xFF], 0x00),
+                ([0x01, 0x00, 0x01, 0x30, 0x00, 0xFF], 0x00),
+                ([0x30, 0x00, 0x42, 0x00, 0xFF], 0x01),
+                ([0x01, 0x01, 0x01, 0x01, 0x00, 0x03, 0x11, 0x00, 0x01, 0x13, 0x02, 0x00,
+                  0x40, 0xF8, 0xFF], 0xFF),
+                ([0x01, 0x00, 0x01, 0x55], 0xFF)):
+            expected = Cpu([0x00] * 0x10, self.terminal)
+            compiled = Cpu([0x00] * 0x10, self.terminal, jit=True)
+            for cpu in (expected, compiled):
+                cpu.registers["SP"] = stackPointer
+                with contextlib.redirect_stdout(StringIO()):
+                    self.assertRaises(Exception, cpu.run, program)
+            self.assertEqual(compiled.registers["PC"], expected.registers["PC"])
+            self.assertEqual(compiled.instructionsCount, expected.instructionsCount)
+
+    def test_IfRunningPastEndOfProgramLeavesPreciseState(self):
+        program = [0x01, 0x00, 0x01] * 85
+        expected = Cpu([0x00] * 0x10, self.terminal)
+        compiled = Cpu([0x00] * 0x10, self.terminal, jit=True)
+        for cpu in (expected, compiled):
+            with contextlib.redirect_stdout(StringIO()), self.assertRaises(Exception) as context:
+                cpu.run(program)
+            self.assertIs(type(context.exception), Exception)
+        self.assertEqual(compiled.registers["PC"], expected.registers["PC"])
+        self.assertEqual(compiled.instructionsCount, expected.instructionsCount)
+
+    def test_IfOverwrittenFlagsAreNotComputed(self):
+        program = [0x01, 0x00, 0xFF, 0x10, 0x00, 0x00, 0x11, 0x01, 0x00, 0x20, 0x00, 0x01,
+                   0x21, 0x00, 0xFF]
+        self.cpu.load(program)
+        source = BlockCompiler(self.cpu, self.cpu.rom).translate(0x00).source
+        self.assertEqual(source.count("fr &="), 1)
+        self.assertIn("fr &= ~0x03", source)
+        self.cpu.resume()
+        self.assertEqual(self.cpu.registers["FR"], 0x02)
+
+    def test_IfFlagsAreExactWhenBlockStopsBeforeOverwrite(self):
+        for program in ([0x01, 0x00, 0xFF, 0x10, 0x00, 0x00, 0x02, 0x01, 0x00, 0x20, 0x00, 0x00, 0xFF],
+                        [0x01, 0x00, 0xFF, 0x10, 0x00, 0x00, 0x00, 0x01, 0xFD, 0x20, 0x00, 0x00, 0xFF],
+                        [0x01, 0x00, 0xFF, 0x19, 0x00, 0x11, 0x00, 0x00, 0x00, 0x02, 0xFD, 0x20, 0x00, 0x02, 0xFF]):
+            expected = Cpu([0x00] * 0x10, self.terminal)
+            compiled = Cpu([0x00] * 0x10, self.terminal, jit=True)
+            with contextlib.redirect_stdout(StringIO()):
+                try:
+                    expected.run(program)
+                except Exception:
+                    self.assertRaises(Exception, compiled.run, program)
+                else:
+                    compiled.run(program)
+            for name in ("R0", "R1", "R2", "FR"):
+                self.assertEqual(compiled.registers[name], expected.registers[name])
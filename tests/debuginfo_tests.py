@@ -0,0 +1,157 @@
+import unittest
+import os
+import tempfile
+from compiler import Compiler
+from debuginfo import DebugInfo, readDebugInfo, loadDebugInfo, debugInfoPath
+from decompiler import Decompiler
+from linker import Linker
+from vm.cpu import Cpu, BREAKPOINT
+from vm.profiler import Profiler, CallGraphProfiler
+from vm.terminal import ScriptedTerminal
+from vm.trace import TraceRecorder, formatTrace
+
+class DebugInfoTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        with open("examples/printInt.asm") as source:
+            self.source = source.read()
+        self.compiler = Compiler()
+        self.program = self.compiler.compile(self.source)
+        self.debugInfo = self.compiler.debugInfo("printInt.asm")
+        self.terminal = ScriptedTerminal()
+        self.cpu = Cpu([0x00] * 256, self.terminal)
+
+    def test_IfEveryCodeByteIsMappedToSourceLine(self):
+        self.assertEqual(len(self.debugInfo.lines), len(self.program))
+        self.assertEqual(list(self.debugInfo.lines[:6]), [2, 2, 6, 6, 7, 7])
+        self.assertEqual(self.debugInfo.location(0x05), ("printInt.asm", 7))
+        self.assertEqual(self.debugInfo.location(0xF0), None)
+        self.assertEqual(self.debugInfo.labels, self.compiler.labels)
+
+    def test_IfAddressesAreAttributedToNearestLabel(self):
+        self.assertEqual(self.debugInfo.symbol(0x00), None)
+        self.assertEqual(self.debugInfo.symbol(0x02), "printdigit")
+        self.assertEqual(self.debugInfo.symbol(0x11), "printdigit")
+        self.assertEqual(self.debugInfo.describe(0x05), "printInt.asm:7 printdigit+0x03")
+        self.assertEqual(self.debugInfo.describe(0x12), "printInt.asm:15 flushterminal")
+
+    def test_IfLabelsAndLinesAreResolvedToAddresses(self):
+        self.assertEqual(self.debugInfo.address("main"), 0x19)
+        self.assertEqual(self.debugInfo.address("printInt.asm:20"), 0x19)
+        self.assertEqual(self.debugInfo.address("printInt.asm:8"), 0x06)
+        self.assertRaises(Exception, self.debugInfo.address, "printInt.asm:19")
+        self.assertRaises(Exception, self.debugInfo.address, "missing")
+
+    def test_IfDebugInfoSurvivesSerialization(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = debugInfoPath(os.path.join(directory, "printInt.bin"))
+            self.debugInfo.save(path)
+            loaded = loadDebugInfo(path)
+        self.assertEqual(loaded.files, ["printInt.asm"])
+        self.assertEqual(loaded.lines, self.debugInfo.lines)
+        self.assertEqual(loaded.fileIndexes, self.debugInfo.fileIndexes)
+        self.assertEqual(loaded.labels, self.debugInfo.labels)
+        self.assertRaises(Exception, readDebugInfo, b"NOPE" + bytes(6))
+        self.assertRaises(Exception, readDebugInfo, self.debugInfo.toBytes()[:-1])
+
+    def test_IfOptimizedProgramKeepsSourceLines(self):
+        compiler = Compiler()
+        binary = compiler.compile("start:\nMOV R0, R0\nSET R1, 1\nJMP end\nend:\nHALT\n",
+            optimize=True)
+        debugInfo = compiler.debugInfo("optimized.asm")
+        self.assertEqual(binary, [0x01, 0x01, 0x01, 0xFF])
+        self.assertEqual(list(debugInfo.lines), [3, 3, 3, 6])
+        self.assertEqual(debugInfo.labels, {"start" : 0x00, "end" : 0x03})
+
+    def test_IfLinkerMergesDebugInfoOfObjects(self):
+        split = self.source.index("main:")
+        linker = Linker()
+        binary = linker.link([self.compiler.compileObject(self.source[:split]),
+            self.compiler.compileObject(self.source[split:])])
+        debugInfo = linker.debugInfo(["library.asm", "main.asm"])
+        self.assertEqual(binary, self.program)
+        self.assertEqual(debugInfo.location(0x05), ("library.asm", 7))
+        self.assertEqual(debugInfo.location(0x19), ("main.asm", 2))
+        self.assertEqual(debugInfo.symbol(0x1A), "main")
+
+    def test_IfBreakpointsCanBeSetOnLabelsAndLines(self):
+        self.assertRaises(Exception, self.cpu.addBreakpoint, "flushterminal")
+        self.cpu.debugInfo = self.debugInfo
+        self.cpu.addBreakpoint("flushterminal")
+        self.cpu.run(self.program)
+        self.assertEqual(self.cpu.stopReason.reason, BREAKPOINT)
+        self.assertEqual(self.debugInfo.location(self.cpu.stopReason.pc), ("printInt.asm", 15))
+        self.cpu.removeBreakpoint("flushterminal")
+        self.cpu.addBreakpoint("printInt.asm:33")
+        self.cpu.resume()
+        self.assertEqual(self.cpu.stopReason.pc, 0x37)
+        self.cpu.resume()
+        self.assertEqual(self.terminal.output, "1337\n")
+
+    def test_IfProfilerAttributesHotSpotsToSourceLines(self):
+        profiler = Profiler()
+        self.cpu.debugInfo = self.debugInfo
+        self.cpu.profiler = profiler
+        self.cpu.run(self.program)
+        self.assertEqual(profiler.sourceLines()[0], (4, ("printInt.asm", 6)))
+        self.assertEqual(profiler.symbols(), {"printdigit" : 28, "flushterminal" : 3, "main" : 14})
+        results = profiler.results()
+        self.assertEqual(results["lines"]["printInt.asm:2"], 1)
+        self.assertIn("0x02    POP                4    8.70%  printInt.asm:6 printdigit",
+            profiler.report())
+        self.assertIn("printInt.asm:6", profiler.report().split("Line")[1])
+
+    def test_IfProfilerDropsDebugInfoOfPreviousCpu(self):
+        profiler = Profiler()
+        self.cpu.debugInfo = self.debugInfo
+        self.cpu.profiler = profiler
+        self.cpu.run(self.program)
+        cpu = Cpu([0x00] * 256, ScriptedTerminal())
+        cpu.profiler = profiler
+        cpu.run(self.program)
+        self.assertIsNone(profiler.debugInfo)
+        self.assertEqual(profiler.sourceLines(), [])
+        self.assertEqual(profiler.symbols(), {})
+        self.assertNotIn("lines", profiler.results())
+        callGraph = CallGraphProfiler({"start" : 0x00})
+        self.cpu.profiler = callGraph
+        self.cpu.run(self.program)
+        self.assertEqual(callGraph.name(0x02), "printdigit")
+        cpu.profiler = callGraph
+        cpu.run(self.program)
+        self.assertEqual(callGraph.name(0x02), "0x02")
+        self.assertEqual(callGraph.name(0x00), "start")
+
+    def test_IfCallGraphProfilerTakesSymbolsFromDebugInfo(self):
+        profiler = CallGraphProfiler(self.debugInfo)
+        self.assertEqual(profiler.name(0x12), "flushterminal")
+        self.cpu.debugInfo = self.debugInfo
+        self.cpu.profiler = CallGraphProfiler()
+        self.cpu.run(self.program)
+        self.assertIn("0x00;printdigit 28", self.cpu.profiler.collapsed())
+
+    def test_IfDecompilerUsesLabels(self):
+        decompiler = Decompiler()
+        decompiler.load(bytes(self.program), self.debugInfo)
+        decompiler.run()
+        source = decompiler.getDecompiled()
+        self.assertEqual(source.splitlines()[:2], ["JMP main", "printdigit:"])
+        self.assertIn("CALL flushterminal", source)
+        self.assertEqual(Compiler().compile(source), self.program)
+        debugInfo = DebugInfo(["aliases.asm"], bytes(3), [1, 1, 1], {"b" : 0x00, "a" : 0x00})
+        decompiler.load(bytes([0x40, 0xFE, 0xFF]), debugInfo)
+        decompiler.run()
+        self.assertEqual(decompiler.getDecompiled().splitlines(), ["a:", "b:", "JMP a", "HALT"])
+
+    def test_IfTraceIsAnnotatedWithSourceLines(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.run(self.program)
+        lines = formatTrace(self.cpu.tracer.records()[:2], self.debugInfo)
+        self.assertEqual(lines[0], "PC:0x00 [DEBUG] Executing instruction: 0x40 printInt.asm:2")
+        self.assertIn("Executing instruction: 0x01 printInt.asm:20 main", lines[2])
+
+    def test_IfTooManyFilesAreRejected(self):
+        self.assertRaises(Exception, DebugInfo, ["file"] * 256, b"", [], {})
+
+if __name__ == '__main__':
+    unittest.main()
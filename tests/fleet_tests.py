@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+from compiler import Compiler
+from vm.fleet import FleetWorker, Job, runFleet
+
+class FleetTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def __writeProgram(self, name, source):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as output:
+            output.write(bytes(Compiler().compile(source)))
+        return path
+
+    def test_IfWorkerCapturesOutputAndState(self):
+        echo = self.__writeProgram("echo.bin",
+            "IN 0x01, R0\n"
+            "OUT 0x02, R0\n"
+            "HALT\n")
+        result = FleetWorker().run(Job(echo, "A"))
+        self.assertEqual(result["state"], "halted")
+        self.assertEqual(result["output"], "A")
+        self.assertEqual(result["registers"]["R0"], 65)
+        self.assertEqual(result["instructions"], 3)
+
+    def test_IfWorkerResetsMachineBetweenJobs(self):
+        worker = FleetWorker()
+        store = self.__writeProgram("store.bin",
+            "SET R0, 0x10\n"
+            "SET R1, 0x00\n"
+            "PUSH R0\n"
+            "LOAD R2, R1\n"
+            "HALT\n")
+        worker.run(Job(store))
+        worker.cpu.registers["R2"] = 0x99
+        result = worker.run(Job(store))
+        self.assertEqual(result["registers"]["SP"], 0xFE)
+        self.assertEqual(result["registers"]["R2"], 0xFF)
+
+    def test_IfFailuresAreReportedInResults(self):
+        worker = FleetWorker()
+        reading = self.__writeProgram("read.bin", "IN 0x01, R0\n")
+        self.assertEqual(worker.run(Job(reading))["error"], "Terminal input exhausted")
+        missing = os.path.join(self.directory.name, "missing.bin")
+        self.assertEqual(worker.run(Job(missing))["state"], "failed")
+
+    def test_IfFleetReturnsResultsInJobsOrder(self):
+        programs = [self.__writeProgram("set{0}.bin".format(value),
+            "SET R0, {0}\nHALT\n".format(value)) for value in range(8)]
+        results = list(runFleet([Job(program) for program in programs], workers=2, chunksize=1))
+        self.assertEqual([result["registers"]["R0"] for result in results], list(range(8)))
@@ -0,0 +1,86 @@
+import unittest
+import os
+import tempfile
+from compiler import Compiler, readObject
+from linker import Linker, ObjectCache
+from vm.cpu import Cpu
+from vm.terminal import ScriptedTerminal
+
+class LinkerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        with open("examples/printInt.asm") as source:
+            self.source = source.read()
+        split = self.source.index("main:")
+        self.library = self.source[:split]
+        self.main = self.source[split:]
+        self.compiler = Compiler()
+        self.linker = Linker()
+
+    def test_IfObjectKeepsExportedLabelsAndRelocations(self):
+        objectFile = self.compiler.compileObject(self.library)
+        self.assertEqual(objectFile.labels, {"printdigit" : 0x02, "flushterminal" : 0x12})
+        self.assertEqual(objectFile.relocations, [(0x01, "main")])
+        objectFile = self.compiler.compileObject(self.main)
+        self.assertEqual(objectFile.labels, {"main" : 0x00})
+        self.assertEqual([label for offset, label in objectFile.relocations],
+            ["printdigit"] * 4 + ["flushterminal"])
+
+    def test_IfObjectFileSurvivesSerialization(self):
+        objectFile = self.compiler.compileObject(self.main)
+        loaded = readObject(objectFile.toBytes())
+        self.assertEqual(loaded.code, objectFile.code)
+        self.assertEqual(loaded.labels, objectFile.labels)
+        self.assertEqual(loaded.relocations, objectFile.relocations)
+        self.assertEqual(loaded.lines, objectFile.lines)
+        self.assertRaises(Exception, readObject, b"NOPE" + bytes(6))
+        self.assertRaises(Exception, self.compiler.compileObject("SET R0, 0x100\n").toBytes)
+
+    def test_IfLinkedProgramIsSameAsAssembledAtOnce(self):
+        binary = self.linker.link([self.compiler.compileObject(self.library),
+            self.compiler.compileObject(self.main)])
+        self.assertEqual(binary, Compiler().compile(self.source))
+        self.assertEqual(self.linker.labels, {"printdigit" : 0x02, "flushterminal" : 0x12,
+            "main" : 0x19})
+        terminal = ScriptedTerminal()
+        Cpu([0x00] * 256, terminal).run(binary)
+        self.assertEqual(terminal.output, "1337\n")
+
+    def test_IfBackwardReferenceBetweenObjectsIsResolved(self):
+        binary = self.linker.link([self.compiler.compileObject("JMP start\nfunction:\nRET\n"),
+            self.compiler.compileObject("start:\nCALL function\nHALT\n")])
+        self.assertEqual(binary, Compiler().compile("JMP start\nfunction:\nRET\nstart:\nCALL function\nHALT\n"))
+
+    def test_IfLinkingErrorsAreReported(self):
+        objectFile = self.compiler.compileObject("start:\nJMP missing\n")
+        self.assertRaises(Exception, self.linker.link, [objectFile])
+        with self.assertRaisesRegex(Exception, "Label missing is defined more than once"):
+            self.linker.link([objectFile, self.compiler.compileObject("missing:\nHALT\n"),
+                self.compiler.compileObject("missing:\nRET\n")])
+
+    def test_IfLocalLabelsOfObjectsDoNotCollide(self):
+        library = "{0}:\nloop:\nSUB R0, R1\nCMP R0, R2\nJNZ loop\nRET\n"
+        binary = self.linker.link([
+            self.compiler.compileObject("CALL first\nCALL second\nHALT\n"),
+            self.compiler.compileObject(library.format("first")),
+            self.compiler.compileObject(library.format("second"))])
+        self.assertEqual(binary, Compiler().compile("CALL first\nCALL second\nHALT\n"
+            + library.format("first") + library.format("second").replace("loop", "again")))
+        self.assertEqual(self.linker.labels, {"first" : 0x05, "second" : 0x0E})
+        self.assertEqual(self.linker.localLabels, {"loop" : [(1, 0x05), (2, 0x0E)]})
+        debugInfo = self.linker.debugInfo(["main.asm", "first.asm", "second.asm"])
+        self.assertEqual(debugInfo.address("second.asm:loop"), 0x0E)
+
+    def test_IfObjectsAreCachedBySourceHash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ObjectCache(directory)
+            first = cache.compile(self.library)
+            second = cache.compile(self.library)
+            cache.compile(self.main)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(second.code, first.code)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertTrue(os.path.exists(cache.path(self.main)))
+
+if __name__ == '__main__':
+    unittest.main()
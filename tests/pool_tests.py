@@ -0,0 +1,64 @@
+import unittest
+from compiler import Compiler
+from vm.pool import CpuPool
+
+class CpuPoolTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.pool = CpuPool(size=1)
+        with open("examples/printInt.asm") as source:
+            self.program = bytes(Compiler().compile(source.read()))
+
+    def test_IfReleasedInstanceIsHandedOutAgain(self):
+        with self.pool.instance(self.program) as cpu:
+            cpu.resume()
+            self.assertEqual(cpu.terminal.output, "1337\n")
+        with self.pool.instance(self.program) as again:
+            self.assertIs(again, cpu)
+            again.resume()
+            self.assertEqual(again.terminal.output, "1337\n")
+        self.assertEqual(self.pool.created, 1)
+
+    def test_IfReleasedInstanceIsInPowerOnState(self):
+        cpu = self.pool.acquire([0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF])
+        cpu.resume()
+        self.pool.release(cpu)
+        self.assertEqual(cpu.registers["R0"], 0x00)
+        self.assertEqual(cpu.registers["SP"], 0xFF)
+        self.assertEqual(cpu.ram[0xFE], 0xFF)
+        self.assertEqual(cpu.instructionsCount, 0)
+        self.assertFalse(cpu.running)
+
+    def test_IfReleasedInstanceForgetsWhereItStopped(self):
+        cpu = self.pool.acquire([0x01, 0x00, 0xAB, 0x30, 0x00, 0xFF])
+        cpu.addBreakpoint(0x03)
+        cpu.resume()
+        self.assertIsNotNone(cpu.stopReason)
+        cpu.clearBreakpoints()
+        self.pool.release(cpu)
+        self.assertIsNone(cpu.stopReason)
+        self.assertIs(self.pool.acquire(), cpu)
+        self.assertIsNone(cpu.stopReason)
+
+    def test_IfValuesOutsideOfByteRangeCanBeStored(self):
+        cpu = self.pool.acquire([0x01, 0x00, 0x00, 0x01, 0x01, 0x01, 0x11, 0x00, 0x01,
+                                 0x30, 0x00, 0xFF])
+        cpu.resume()
+        self.assertEqual(cpu.ram[0xFE], 0x100)
+        self.pool.release(cpu)
+        self.assertEqual(cpu.ram[0xFE], 0xFF)
+
+    def test_IfNewInstancesAreCreatedWhenPoolIsEmpty(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire(input="abc")
+        self.assertIsNot(first, second)
+        self.assertEqual(second.terminal.readbuffer, "abc")
+        self.assertEqual(self.pool.created, 2)
+
+    def test_IfCpuOptionsArePassedToInstances(self):
+        pool = CpuPool(jit=True, strict=True)
+        self.assertTrue(pool.acquire().jit)
+        self.assertTrue(pool.acquire().strict)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import Mock
 from vm.port import Port
+from tests.cpu_tests import runCoroutine
 
 class PortTests(unittest.TestCase):
     def __init__(self, parameters):
@@ -27,4 +28,30 @@ class PortTests(unittest.TestCase):
         argument = 0xc00fee
         port = Port(None, mock)
         port.write(argument)
-        mock.assert_called_with(argument)
\ No newline at end of file
+        mock.assert_called_with(argument)
+
+    def test_IfReadWithoutHandleReturnsNothing(self):
+        port = Port(None, None)
+        self.assertEqual(port.read(), None)
+        port.write(0x01)
+        self.assertFalse(hasattr(port, "__dict__"))
+
+    def test_IfAsynchronousHandlesAreAwaitedOnlyThroughAsyncAccessors(self):
+        async def read():
+            return 0x41
+        async def write(value):
+            written.append(value)
+        written = []
+        port = Port(read, write)
+        self.assertRaises(Exception, port.read)
+        self.assertRaises(Exception, port.write, 0x42)
+        self.assertEqual(runCoroutine(port.readAsync()), 0x41)
+        runCoroutine(port.writeAsync(0x42))
+        self.assertEqual(written, [0x42])
+
+    def test_IfSynchronousPortHasNoAsyncAccessors(self):
+        port = Port(Mock(), None)
+        self.assertIsNone(port.readAsync)
+        self.assertIsNone(port.writeAsync)
+        self.assertFalse(port.status)
+        self.assertTrue(Port(Mock(), None, status=True).status)
@@ -0,0 +1,112 @@
+import unittest
+import json
+from compiler import Compiler
+from vm.cpu import Cpu
+from vm.profiler import Profiler, CallGraphProfiler
+from vm.terminal import ScriptedTerminal
+from tests.cpu_tests import TerminalFake
+
+class ProfilerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.profiler = Profiler()
+        self.cpu = Cpu([0x00] * 256, TerminalFake())
+        self.cpu.profiler = self.profiler
+        self.program = [0x01, 0x00, 0x05, 0x01, 0x01, 0x01, 0x01, 0x02, 0x00,
+                        0x11, 0x00, 0x01, 0x10, 0x03, 0x01, 0x20, 0x00, 0x02,
+                        0x22, 0xF5, 0xFF]
+
+    def test_IfExecutionsAreCountedPerOpcode(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.opcodes[0x01], 3)
+        self.assertEqual(self.profiler.opcodes[0x11], 5)
+        self.assertEqual(self.profiler.opcodes[0x22], 5)
+        self.assertEqual(self.profiler.opcodes[0xFF], 1)
+        self.assertEqual(self.profiler.instructions(), self.cpu.instructionsCount)
+
+    def test_IfExecutionsAreCountedPerAddress(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.addresses[0x00], 1)
+        self.assertEqual(self.profiler.addresses[0x09], 5)
+        self.assertEqual(self.profiler.addresses[0x14], 1)
+        self.assertEqual(self.profiler.addresses[0x0A], 0)
+        self.assertEqual(self.profiler.hotSpots()[0], (5, 0x09))
+
+    def test_IfConditionalJumpsAreSplitIntoTakenAndNotTaken(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.branches(), [(0x12, 0x22, 4, 1)])
+        results = json.loads(self.profiler.toJson())
+        self.assertEqual(results["handlers"], {"JNZ" : {"taken" : 4, "notTaken" : 1}})
+        self.assertEqual(results["branches"]["0x12"]["taken"], 4)
+        self.assertEqual(results["opcodes"]["SUB"], 5)
+        self.assertEqual(results["instructions"], 24)
+
+    def test_IfCountersAccumulateOverRunsOfTheSameProgram(self):
+        self.cpu.run(self.program)
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.addresses[0x09], 10)
+        self.cpu.run([0xFF])
+        self.assertEqual(self.profiler.instructions(), 1)
+
+    def test_IfTextReportUsesMnemonics(self):
+        self.cpu.run(self.program)
+        report = self.profiler.report()
+        self.assertIn("Instructions executed: 24", report)
+        self.assertIn("0x09    SUB", report)
+        self.assertIn("0x12    JNZ                4           1", report)
+
+    def test_IfProfilerWorksWithBudgetsAndCompiledMode(self):
+        self.cpu.jit = True
+        self.cpu.load(self.program)
+        self.assertEqual(self.cpu.runFor(10), 10)
+        self.cpu.resume()
+        self.assertEqual(self.profiler.instructions(), 24)
+        self.cpu.profiler = None
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.instructions(), 24)
+
+class CallGraphProfilerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        compiler = Compiler()
+        with open("examples/printInt.asm") as source:
+            self.program = compiler.compile(source.read())
+        self.profiler = CallGraphProfiler(compiler.labels)
+        self.terminal = ScriptedTerminal()
+        self.cpu = Cpu([0x00] * 256, self.terminal)
+        self.cpu.profiler = self.profiler
+
+    def test_IfInstructionsAreAttributedToCallStacks(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.terminal.output, "1337\n")
+        self.assertEqual(self.profiler.samples, {
+            (0x00,) : 15,
+            (0x00, 0x02) : 28,
+            (0x00, 0x12) : 3 })
+
+    def test_IfInclusiveAndExclusiveCountsAreComputed(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.exclusive(), {0x00 : 15, 0x02 : 28, 0x12 : 3})
+        self.assertEqual(self.profiler.inclusive(), {0x00 : 46, 0x02 : 28, 0x12 : 3})
+        self.assertIn("printdigit                    28          28", self.profiler.report())
+
+    def test_IfCollapsedStacksUseSymbols(self):
+        self.cpu.run(self.program)
+        self.assertEqual(self.profiler.collapsed().splitlines(), [
+            "0x00 15",
+            "0x00;printdigit 28",
+            "0x00;flushterminal 3"])
+
+    def test_IfCallStackIsResetOnNewRun(self):
+        self.cpu.run([0x42, 0x00, 0xFF])
+        self.assertEqual(self.profiler.stack, (0x00, 0x02))
+        self.cpu.run([0x42, 0x00, 0xFF])
+        self.assertEqual(self.profiler.samples, {(0x00,) : 2, (0x00, 0x02) : 2})
+
+    def test_IfRecursionIsCountedOnceInInclusiveCount(self):
+        self.profiler.samples = {(0x00,) : 1, (0x00, 0x10) : 2, (0x00, 0x10, 0x10) : 3}
+        self.assertEqual(self.profiler.inclusive(), {0x00 : 6, 0x10 : 5})
+        self.assertEqual(self.profiler.exclusive(), {0x00 : 1, 0x10 : 5})
+
+if __name__ == '__main__':
+    unittest.main()
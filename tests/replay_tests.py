@@ -0,0 +1,103 @@
+import unittest
+import contextlib
+import os
+import tempfile
+from io import StringIO
+from compiler import Compiler
+from vm.cpu import Cpu
+from vm.port import Port
+from vm.profiler import Profiler
+from vm.replay import IoRecorder, IoEvent, ReplayTerminal, readIoLog
+from vm.terminal import ScriptedTerminal
+from tests.cpu_tests import runCoroutine
+
+class ReplayTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        with open("examples/echo.asm") as source:
+            self.program = Compiler().compile(source.read())
+
+    def __record(self, input, **options):
+        cpu = Cpu([0x00] * 256, ScriptedTerminal(input), **options)
+        cpu.ioRecorder = IoRecorder()
+        cpu.run(self.program)
+        return cpu
+
+    def __replay(self, events, jit=False):
+        cpu = Cpu([0x00] * 256, ReplayTerminal(events), jit=jit)
+        with contextlib.redirect_stdout(StringIO()):
+            cpu.run(self.program)
+        return cpu
+
+    def test_IfPortReadsAndWritesAreRecordedWithInstructionCount(self):
+        cpu = self.__record("AB")
+        self.assertEqual(cpu.terminal.output, "AB\n")
+        self.assertEqual(cpu.ioRecorder.events[:4], [
+            IoEvent(1, 0, 0x01, 0x41),
+            IoEvent(2, 0, 0x00, 0x01),
+            IoEvent(4, 1, 0x02, 0x41),
+            IoEvent(7, 0, 0x01, 0x42)])
+        self.assertEqual(cpu.ioRecorder.events[-1], IoEvent(cpu.instructionsCount - 2, 1, 0x02, 10))
+
+    def test_IfRecordingReadsSameCountersInEveryMode(self):
+        events = self.__record("Hello").ioRecorder.events
+        self.assertEqual(self.__record("Hello", jit=True).ioRecorder.events, events)
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertEqual(self.__record("Hello", debug=True).ioRecorder.events, events)
+
+    def test_IfReplayReproducesSessionInEveryMode(self):
+        events = self.__record("Hello").ioRecorder.events
+        for jit in (False, True):
+            cpu = self.__replay(events, jit)
+            self.assertEqual(cpu.terminal.output, "Hello\n")
+            self.assertFalse(cpu.terminal.reads[0x01])
+
+    def test_IfLogIsStoredInCompactBinaryFormat(self):
+        recorder = self.__record("Hi").ioRecorder
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "io.bin")
+            recorder.save(path)
+            with open(path, 'rb') as log:
+                data = log.read()
+        self.assertEqual(len(data), 8 + 14 * len(recorder.events))
+        self.assertEqual(readIoLog(data), recorder.events)
+        self.assertRaises(Exception, readIoLog, b"NOPE" + bytes(4))
+
+    def test_IfReplayReportsDivergence(self):
+        events = self.__record("Hi").ioRecorder.events
+        diverged = [event._replace(value=0x58) if event.kind == 1 else event for event in events]
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, self.__replay, diverged)
+            self.assertRaises(Exception, self.__replay, events[:2])
+
+    def test_IfRecordingWorksWithOtherInstrumentsAndIsRemovable(self):
+        cpu = Cpu([0x00] * 256, ScriptedTerminal("A"))
+        cpu.ioRecorder = IoRecorder()
+        cpu.profiler = Profiler()
+        cpu.run(self.program)
+        self.assertEqual(len(cpu.ioRecorder.events), 4)
+        recorder = cpu.ioRecorder
+        cpu.ioRecorder = None
+        cpu.terminal.load("A")
+        cpu.run(self.program)
+        self.assertEqual(len(recorder.events), 4)
+        self.assertEqual(cpu.terminal.output, "A\n")
+
+    def test_IfAsynchronousPortsAreRecorded(self):
+        written = []
+        async def read():
+            return 0x41
+        async def write(value):
+            written.append(value)
+        class AsyncTerminal:
+            controlPort = Port(None, None)
+            dataInPort = Port(read, None)
+            dataOutPort = Port(None, write)
+        cpu = Cpu([0x00] * 256, AsyncTerminal())
+        cpu.ioRecorder = IoRecorder()
+        runCoroutine(cpu.runAsync([0x50, 0x01, 0x00, 0x51, 0x02, 0x00, 0xFF]))
+        self.assertEqual(written, [0x41])
+        self.assertEqual(cpu.ioRecorder.events, [IoEvent(0, 0, 0x01, 0x41), IoEvent(1, 1, 0x02, 0x41)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import contextlib
+from io import StringIO
+from compiler import Compiler
+from vm.cpu import Cpu
+from vm.scheduler import Scheduler
+from vm.terminal import ScriptedTerminal
+
+class SchedulerTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.scheduler = Scheduler(quantum=4)
+
+    def __load(self, source, input=''):
+        terminal = ScriptedTerminal()
+        terminal.load(input)
+        cpu = Cpu([0x00] * 256, terminal)
+        cpu.load(Compiler().compile(source))
+        return cpu
+
+    def __countdown(self, start):
+        return self.__load(
+            "SET R0, {0}\n"
+            "SET R1, 0x01\n"
+            "loop:\n"
+            "SUB R0, R1\n"
+            "CMP R0, R2\n"
+            "JNZ loop\n"
+            "HALT\n".format(start))
+
+    def test_IfTasksAreTimeSlicedInRoundRobinOrder(self):
+        first = self.scheduler.add(self.__countdown(0x10))
+        second = self.scheduler.add(self.__countdown(0x10))
+        self.assertIs(self.scheduler.runSlice(), first)
+        self.assertIs(self.scheduler.runSlice(), second)
+        self.assertIs(self.scheduler.runSlice(), first)
+        self.assertEqual(first.cycles, 8)
+        self.assertEqual(first.slices, 2)
+        self.assertEqual(second.cycles, 4)
+        self.assertEqual(self.scheduler.cycles, 12)
+
+    def test_IfCyclesAreAccountedPerTask(self):
+        short = self.scheduler.add(self.__countdown(0x02), "short")
+        long = self.scheduler.add(self.__countdown(0x20), "long")
+        self.scheduler.run()
+        self.assertEqual(short.state, "halted")
+        self.assertEqual(long.state, "halted")
+        self.assertEqual(short.cycles, 2 + 2 * 3 + 1)
+        self.assertEqual(long.cycles, 2 + 0x20 * 3 + 1)
+        self.assertEqual(short.cycles, short.cpu.instructionsCount)
+        self.assertEqual(long.slices, 25)
+        self.assertEqual(self.scheduler.cycles, short.cycles + long.cycles)
+
+    def test_IfTaskIsStoppedWhenCycleLimitExpires(self):
+        spinner = self.scheduler.add(self.__load("loop:\nSET R0, 0x01\nJMP loop\n"), cycleLimit=10)
+        worker = self.scheduler.add(self.__countdown(0x03))
+        self.scheduler.run()
+        self.assertEqual(spinner.state, "expired")
+        self.assertEqual(spinner.cycles, 10)
+        self.assertTrue(spinner.cpu.running)
+        self.assertEqual(worker.state, "halted")
+
+    def test_IfFailingTaskDoesNotStopOthers(self):
+        failing = self.scheduler.add(self.__load("IN 0x01, R0\nHALT\n"))
+        echo = self.scheduler.add(self.__load("IN 0x01, R0\nOUT 0x02, R0\nHALT\n", "A"))
+        with contextlib.redirect_stdout(StringIO()):
+            self.scheduler.run()
+        self.assertEqual(failing.state, "failed")
+        self.assertEqual(failing.error, "Terminal input exhausted")
+        self.assertFalse(failing.cpu.running)
+        self.assertEqual(echo.state, "halted")
+        self.assertEqual(echo.cpu.terminal.output, "A")
+
+    def test_IfIdleTaskIsParkedAndCountsSkippedCycles(self):
+        poller = self.scheduler.add(self.__load(
+            "wait:\n"
+            "IN 0x00, R0\n"
+            "CMP R0, R2\n"
+            "JZ wait\n"
+            "IN 0x01, R1\n"
+            "HALT\n"))
+        worker = self.scheduler.add(self.__countdown(0x08))
+        while worker.state == "ready":
+            self.scheduler.runSlice()
+        self.assertEqual(poller.state, "ready")
+        self.assertTrue(poller.cpu.idle)
+        self.assertEqual(poller.cycles + poller.skippedCycles, 4 * poller.slices)
+        self.assertGreater(poller.skippedCycles, 0)
+        poller.cpu.terminal.load("A")
+        self.scheduler.run()
+        self.assertEqual(poller.state, "halted")
+        self.assertEqual(poller.cpu.registers["R1"], 0x41)
+
+    def test_IfTaskStoppedOnBreakpointCanBeResumed(self):
+        cpu = self.__countdown(0x02)
+        cpu.addBreakpoint(0x06)
+        task = self.scheduler.add(cpu)
+        other = self.scheduler.add(self.__countdown(0x01))
+        self.scheduler.run()
+        self.assertEqual(task.state, "stopped")
+        self.assertEqual(other.state, "halted")
+        self.assertEqual(cpu.stopReason.pc, 0x06)
+        self.assertRaises(Exception, self.scheduler.resume, other)
+        cpu.clearBreakpoints()
+        self.scheduler.resume(task)
+        self.scheduler.run()
+        self.assertEqual(task.state, "halted")
+        self.assertEqual(cpu.registers["R0"], 0x00)
+
+    def test_IfHaltedCpuIsNotScheduled(self):
+        cpu = self.__countdown(0x01)
+        cpu.running = False
+        task = self.scheduler.add(cpu)
+        self.assertEqual(task.state, "halted")
+        self.assertEqual(self.scheduler.run(), [task])
+        self.assertEqual(task.slices, 0)
+
+if __name__ == '__main__':
+    unittest.main()
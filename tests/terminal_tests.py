@@ -1,8 +1,11 @@
 import unittest
+import asyncio
 import sys
 from io import StringIO
-from vm.terminal import Terminal
+from vm.terminal import Terminal, ScriptedTerminal, StreamTerminal
 from unittest.mock import Mock
+from vm.cpu import Cpu
+from tests.cpu_tests import runCoroutine
 
 class TerminalTests(unittest.TestCase):
     def __init__(self, parameters):
@@ -30,3 +33,83 @@ class TerminalTests(unittest.TestCase):
         self.terminal._getInput = Mock(return_value="SOME_TEXT")
         char = self.terminal.dataInPort.read()
         self.assertEqual(self.terminal.controlPort.read(), 0x1)
+
+
+class ScriptedTerminalTests(unittest.TestCase):
+    def test_IfItReadsScriptedInputAndCapturesOutput(self):
+        terminal = ScriptedTerminal("AB")
+        self.assertEqual(terminal.controlPort.read(), 0x1)
+        self.assertEqual(terminal.dataInPort.read(), ord("A"))
+        terminal.dataOutPort.write(ord("C"))
+        terminal.dataOutPort.write(10)
+        self.assertEqual(terminal.output, "C\n")
+
+    def test_IfItRaisesWhenInputIsExhausted(self):
+        terminal = ScriptedTerminal()
+        self.assertRaises(Exception, terminal.dataInPort.read)
+
+    def test_IfSnapshotKeepsTerminalBuffers(self):
+        terminal = ScriptedTerminal("INPUT")
+        terminal.dataOutPort.write(ord("X"))
+        terminal.writebuffer = "PENDING"
+        cpu = Cpu([0x00] * 256, terminal)
+        restored = ScriptedTerminal()
+        Cpu([0x00] * 256, restored).restore(cpu.snapshot())
+        self.assertEqual(restored.readbuffer, "INPUT")
+        self.assertEqual(restored.writebuffer, "PENDING")
+
+class WriterFake:
+    def __init__(self):
+        self.data = b''
+        self.drained = 0
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drained += 1
+
+class StreamTerminalTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.writer = WriterFake()
+
+    def __terminal(self, data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return StreamTerminal(reader, self.writer)
+
+    async def __readAll(self, data):
+        terminal = self.__terminal(data)
+        characters = []
+        try:
+            while True:
+                characters.append(await terminal.dataInPort.readAsync())
+                characters.append(terminal.controlPort.read())
+        except Exception as e:
+            return characters, str(e)
+
+    async def __writeAll(self, text):
+        terminal = self.__terminal(b"")
+        for character in text:
+            await terminal.dataOutPort.writeAsync(ord(character))
+
+    async def __runProgram(self, data, program):
+        await Cpu([0x00] * 256, self.__terminal(data)).runAsync(program)
+
+    def test_IfItReadsLinesFromStream(self):
+        characters, error = runCoroutine(self.__readAll(b"\nAB\n"))
+        self.assertEqual(characters, [ord("A"), 0x1, ord("B"), 0x0])
+        self.assertEqual(error, "Terminal input exhausted")
+
+    def test_IfItWritesLinesToStream(self):
+        runCoroutine(self.__writeAll("OK\n"))
+        self.assertEqual(self.writer.data, b"OK\n")
+        self.assertEqual(self.writer.drained, 1)
+
+    def test_IfCpuEchoesStreamAsynchronously(self):
+        program = [0x50, 0x01, 0x00, 0x51, 0x02, 0x00, 0x50, 0x01, 0x00, 0x51, 0x02, 0x00,
+                   0x01, 0x00, 0x0A, 0x51, 0x02, 0x00, 0xFF]
+        runCoroutine(self.__runProgram(b"Hi\n", program))
+        self.assertEqual(self.writer.data, b"Hi\n")
@@ -0,0 +1,97 @@
+import unittest
+import contextlib
+import os
+import tempfile
+from io import StringIO
+from vm.cpu import Cpu
+from vm.profiler import Profiler
+from vm.trace import (TraceRecorder, readTrace, formatTrace, NO_REGISTER, REGISTER_CHANGED,
+    STACK_POINTER_CHANGED, MEMORY_CHANGED)
+from tests.cpu_tests import TerminalFake
+
+class TraceTests(unittest.TestCase):
+    def __init__(self, parameters):
+        unittest.TestCase.__init__(self, parameters)
+        self.cpu = Cpu([0x00] * 256, TerminalFake())
+        self.program = [0x01, 0x00, 0xAB, 0x30, 0x00, 0x01, 0x01, 0x10, 0x03, 0x01, 0x00,
+                        0x40, 0x01, 0xFF, 0xFF]
+        self.callProgram = [0x01, 0x00, 0x00, 0x42, 0x01, 0xFF, 0x01, 0x01, 0x09, 0x30, 0x01,
+                            0x31, 0x02, 0x44]
+
+    def test_IfRecordsKeepInstructionEffects(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.run(self.program)
+        records = self.cpu.tracer.records()
+        self.assertEqual([record.pc for record in records], [0x00, 0x03, 0x05, 0x08, 0x0B, 0x0E])
+        push = records[1]
+        self.assertEqual((push.opcode, push.register, push.stackPointer), (0x30, NO_REGISTER, 0xFE))
+        self.assertEqual(push.changes, STACK_POINTER_CHANGED | MEMORY_CHANGED)
+        self.assertEqual((push.address, push.memoryValue), (0xFE, 0xAB))
+        self.assertEqual(records[4].nextPc, 0x0E)
+
+    def test_IfRingBufferKeepsLastInstructions(self):
+        self.cpu.tracer = TraceRecorder(capacity=4)
+        self.cpu.run([0x01, 0x00, 0x05, 0x01, 0x01, 0x01, 0x01, 0x02, 0x00,
+                      0x11, 0x00, 0x01, 0x10, 0x03, 0x01, 0x20, 0x00, 0x02,
+                      0x22, 0xF5, 0xFF])
+        records = self.cpu.tracer.records()
+        self.assertEqual(self.cpu.tracer.count, 24)
+        self.assertEqual([record.opcode for record in records], [0x10, 0x20, 0x22, 0xFF])
+
+    def test_IfPopRecordsRegisterAndStackPointer(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.run(self.callProgram)
+        pop = self.cpu.tracer.records()[4]
+        self.assertEqual(pop.changes, REGISTER_CHANGED | STACK_POINTER_CHANGED)
+        self.assertEqual((pop.register, pop.value, pop.stackPointer), (0x02, 0x09, 0xFE))
+        ret = self.cpu.tracer.records()[5]
+        self.assertEqual((ret.changes, ret.stackPointer, ret.nextPc), (STACK_POINTER_CHANGED, 0xFF, 0x05))
+
+    def test_IfUnchangedRegisterIsNotReported(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.run(self.callProgram)
+        self.assertEqual(self.cpu.tracer.records()[0].changes, 0)
+        self.assertEqual(formatTrace(self.cpu.tracer.records()[:1]),
+            ["PC:0x00 [DEBUG] Executing instruction: 0x01"])
+
+    def test_IfInstructionWhichRaisedIsRecorded(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.registers["SP"] = 0x00
+        with contextlib.redirect_stdout(StringIO()):
+            self.assertRaises(Exception, self.cpu.run, self.program)
+        records = self.cpu.tracer.records()
+        self.assertEqual([record.pc for record in records], [0x00, 0x03])
+        self.assertEqual((records[1].opcode, records[1].changes), (0x30, 0))
+
+    def test_IfDecodedTraceMatchesDebugOutput(self):
+        for program in (self.program, self.callProgram):
+            cpu = Cpu([0x00] * 256, TerminalFake())
+            cpu.tracer = TraceRecorder()
+            cpu.run(program)
+            debugCpu = Cpu([0x00] * 256, TerminalFake(), debug=True)
+            output = StringIO()
+            with contextlib.redirect_stdout(output):
+                debugCpu.run(program)
+            self.assertEqual(formatTrace(cpu.tracer.records()), output.getvalue().splitlines())
+
+    def test_IfTraceIsWrittenToMemoryMappedFile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.bin")
+            self.cpu.tracer = TraceRecorder(capacity=2, path=path)
+            self.cpu.run(self.program)
+            self.cpu.tracer.close()
+            with open(path, 'rb') as trace:
+                records = readTrace(trace.read())
+        self.assertEqual([record.pc for record in records], [0x0B, 0x0E])
+
+    def test_IfTracerWorksTogetherWithProfiler(self):
+        self.cpu.tracer = TraceRecorder()
+        self.cpu.profiler = Profiler()
+        self.cpu.run(self.program)
+        self.assertEqual(len(self.cpu.tracer.records()), self.cpu.profiler.instructions())
+
+    def test_IfReadingInvalidTraceRaises(self):
+        self.assertRaises(Exception, readTrace, b"NOPE" + bytes(12))
+
+if __name__ == '__main__':
+    unittest.main()
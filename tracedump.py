@@ -0,0 +1,39 @@
+import sys
+from debuginfo import loadDebugInfo
+from vm.trace import readTrace, formatTrace
+
+def help():  # pragma: no cover
+    helpText = ("Usage: tracedump.py trace.bin [count] [-s program.dbg]\n"
+                "\t trace.bin - trace file recorded with vm.py -t\n"
+                "\t count - optional number of last instructions to print\n"
+                "\t -s program.dbg - annotate instructions with source lines and labels\n")
+    print(helpText)
+
+def readSource():  # pragma: no cover
+    try:
+        with open(sys.argv[1], 'rb') as source:
+            return source.read()
+    except FileNotFoundError as e:
+        raise Exception ("Trace file " + sys.argv[1] + " not found")
+
+def main():  # pragma: no cover
+    arguments = sys.argv[1:]
+    debugInfo = None
+    if "-s" in arguments:
+        index = arguments.index("-s")
+        debugInfo = loadDebugInfo(arguments[index + 1])
+        del arguments[index : index + 2]
+    if len(arguments) < 1:
+        help()
+        return
+    records = readTrace(readSource())
+    if len(arguments) > 1:
+        records = records[-int(arguments[1]):]
+    for line in formatTrace(records, debugInfo):
+        print(line)
+
+if __name__ == '__main__':  # pragma: no cover
+    try:
+        main()
+    except Exception as e:
+        print(e)
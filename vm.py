@@ -1,33 +1,75 @@
+import os
 import sys
-import array
+import mmap
+from debuginfo import debugInfoPath, loadDebugInfo
 from vm.cpu import Cpu
+from vm.profiler import Profiler, CallGraphProfiler
+from vm.replay import IoRecorder, ReplayTerminal, readIoLog
 from vm.terminal import Terminal
+from vm.trace import TraceRecorder
 
 def help():  # pragma: no cover
-    helpText = ("Usage: vm.py program.bin [-d]\n"
-                "\t program.bin - program filename\n"
-                "\t -d - turn on debug prints\n")
+    helpText = ("Usage: vm.py program.bin [-d] [-j] [-s] [-p | -g] [-t trace.bin]\n"
+                "\t\t[-r io.bin | -R io.bin]\n"
+                "\t program.bin - program filename, source lines and labels for profiles\n"
+                "\t               are taken from program.dbg when it exists\n"
+                "\t -d - turn on debug prints\n"
+                "\t -j - translate program into compiled basic blocks\n"
+                "\t -s - check memory addresses on every access\n"
+                "\t -p - print execution profile at exit\n"
+                "\t -g - print call stacks in collapsed (flame graph) format at exit\n"
+                "\t -t trace.bin - record last executed instructions into trace file\n"
+                "\t -r io.bin - record values read from and written to ports into log file\n"
+                "\t -R io.bin - replay port reads from log file instead of terminal input\n")
     print(helpText)
 
 def readBinary():  # pragma: no cover
     try:
         source = open(sys.argv[1], 'rb')
-        return array.array('B', source.read()).tolist()
     except FileNotFoundError as e:
         raise Exception ("Program file " + sys.argv[1] + " not found")
+    try:
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:  # empty file can't be mapped
+        return source.read()
+
+def readDebugInfo():  # pragma: no cover
+    path = debugInfoPath(sys.argv[1])
+    return loadDebugInfo(path) if os.path.exists(path) else None
 
 def main():  # pragma: no cover
     if len(sys.argv) < 2:
         help()
         return
-    ram = [0xFF] * 256;
-    terminal = Terminal()
-    if "-d" in sys.argv:
-        cpu = Cpu(ram, terminal, debug=True)
+    ram = [0xFF] * 256
+    if "-R" in sys.argv:
+        with open(sys.argv[sys.argv.index("-R") + 1], 'rb') as log:
+            terminal = ReplayTerminal(readIoLog(log.read()))
     else:
-        cpu = Cpu(ram, terminal)
+        terminal = Terminal()
+    cpu = Cpu(ram, terminal, debug="-d" in sys.argv, jit="-j" in sys.argv,
+        strict="-s" in sys.argv)
+    cpu.debugInfo = readDebugInfo()
+    if "-p" in sys.argv:
+        cpu.profiler = Profiler()
+    elif "-g" in sys.argv:
+        cpu.profiler = CallGraphProfiler()
+    if "-r" in sys.argv:
+        cpu.ioRecorder = IoRecorder()
+    if "-t" in sys.argv:
+        cpu.tracer = TraceRecorder(path=sys.argv[sys.argv.index("-t") + 1])
     program = readBinary()
-    cpu.run(program)
+    try:
+        cpu.run(program)
+    finally:
+        if cpu.tracer is not None:
+            cpu.tracer.close()
+        if cpu.ioRecorder is not None:
+            cpu.ioRecorder.save(sys.argv[sys.argv.index("-r") + 1])
+        if isinstance(cpu.profiler, Profiler):
+            print(cpu.profiler.report())
+        elif isinstance(cpu.profiler, CallGraphProfiler):
+            print(cpu.profiler.collapsed())
 
 if __name__ == '__main__':  # pragma: no cover
     try:
@@ -0,0 +1,317 @@
+import numpy
+from vm.cpu import (FLAG_REGISTER, STACK_POINTER, PROGRAM_COUNTER,
+    registerIdToName, RegisterFileView, padProgram)
+
+class BatchCpu:
+    WORD_SIZE = 1 << 8
+    CARRY_FLAG = 1 << 1
+    ZERO_FLAG = 1 << 0
+
+    def _initRegisters(self):
+        self.registerFile = numpy.zeros((self.WORD_SIZE, self.count), dtype=numpy.int64)
+        self.registerFile[STACK_POINTER] = 0xFF
+        self.registers = RegisterFileView(self.registerFile)
+
+    def _getOpcodeToHandlerMapping(self):
+        return {
+            0x00 : (2, self.__MOV),
+            0x01 : (2, self.__SET),
+            0x02 : (2, self.__LOAD),
+            0x03 : (2, self.__STOR),
+            0x10 : (2, self.__ADD),
+            0x11 : (2, self.__SUB),
+            0x12 : (2, self.__MUL),
+            0x13 : (2, self.__DIV),
+            0x14 : (2, self.__MOD),
+            0x15 : (2, self.__OR),
+            0x16 : (2, self.__AND),
+            0x17 : (2, self.__XOR),
+            0x18 : (1, self.__NOT),
+            0x19 : (1, self.__SHL),
+            0x1A : (1, self.__SHR),
+            0x20 : (2, self.__CMP),
+            0x21 : (1, self.__JZ),
+            0x22 : (1, self.__JNZ),
+            0x23 : (1, self.__JC),
+            0x24 : (1, self.__JNC),
+            0x25 : (1, self.__JBE),
+            0x26 : (1, self.__JA),
+            0x30 : (1, self.__PUSH),
+            0x31 : (1, self.__POP),
+            0x40 : (1, self.__JMP),
+            0x41 : (1, self.__JMPR),
+            0x42 : (1, self.__CALL),
+            0x43 : (1, self.__CALR),
+            0x44 : (0, self.__RET),
+            0x50 : (2, self.__IN),
+            0x51 : (2, self.__OUT),
+            0xFF : (0, self.__HALT) }
+
+    # opcodes which operands are register ids, by operand index
+    registerOperands = {
+        0x00 : (0, 1), 0x01 : (0,), 0x02 : (0, 1), 0x03 : (0, 1),
+        0x10 : (0, 1), 0x11 : (0, 1), 0x12 : (0, 1), 0x13 : (0, 1),
+        0x14 : (0, 1), 0x15 : (0, 1), 0x16 : (0, 1), 0x17 : (0, 1),
+        0x18 : (0,), 0x19 : (0,), 0x1A : (0,), 0x20 : (0, 1),
+        0x30 : (0,), 0x31 : (0,), 0x41 : (0,), 0x43 : (0,),
+        0x50 : (1,), 0x51 : (1,) }
+
+    def __init__(self, count, ram=None, terminals=None):
+        self.count = count
+        self.ramSize = self.WORD_SIZE if ram is None else len(ram)
+        self.ram = numpy.zeros((count, self.ramSize), dtype=numpy.int64)
+        if ram is not None:
+            self.ram[:] = numpy.asarray(ram, dtype=numpy.int64)
+        self.rom = []
+        self.running = numpy.zeros(count, dtype=bool)
+        self.errors = {}
+        self.terminals = terminals
+        self._initRegisters()
+        self.opcodeToHandlerMapping = self._getOpcodeToHandlerMapping()
+        self.__decodedRom = []
+
+    def __decodeInstructionAt(self, address):
+        opcode = self.rom[address]
+        try:
+            operandsCount, handler = self.opcodeToHandlerMapping[opcode]
+        except KeyError:
+            return "Unknown instruction 0x{0:02X}".format(opcode)
+        nextPc = address + 1 + operandsCount
+        operands = self.rom[address + 1 : nextPc]
+        if len(operands) < operandsCount:
+            return "Instruction at 0x{0:02X} exceeds program memory".format(address)
+        for index in self.registerOperands.get(opcode, ()):
+            if operands[index] not in registerIdToName:
+                return "Unknown register " + str(operands[index])
+        return (handler, nextPc, operands)
+
+    def __fault(self, idx, message):
+        self.running[idx] = False
+        for instance in idx.tolist():
+            self.errors[instance] = message
+
+    def __checkAddress(self, idx, addresses):
+        invalid = (addresses >= self.ramSize) | (addresses < 0)
+        for address in numpy.unique(addresses[invalid]).tolist():
+            self.__fault(idx[invalid & (addresses == address)], "Address 0x{0:02X} points outside "
+                "memory address space (avail. 0x00-0x{1:02X})".format(address, self.ramSize - 1))
+        return ~invalid
+
+    def __checkDivisor(self, idx, divisor):
+        zero = divisor == 0
+        self.__fault(idx[zero], "Division by 0 error")
+        return ~zero
+
+    def __push(self, idx, values):
+        registers = self.registerFile
+        full = registers[STACK_POINTER, idx] == 0
+        self.__fault(idx[full], "Stack pointer is already at 0x00. Can't move it further back.")
+        idx, values = idx[~full], values[~full]
+        registers[STACK_POINTER, idx] -= 0x1
+        self.ram[idx, registers[STACK_POINTER, idx]] = values
+        return idx
+
+    def __pop(self, idx):
+        registers = self.registerFile
+        empty = registers[STACK_POINTER, idx] == 0xFF
+        self.__fault(idx[empty], "Stack pointer is already at 0xFF. Can't move it further.")
+        idx = idx[~empty]
+        values = self.ram[idx, registers[STACK_POINTER, idx]]
+        registers[STACK_POINTER, idx] += 0x1
+        return idx, values
+
+    def __ports(self, idx, address):
+        ports = []
+        names = {0x00 : "controlPort", 0x01 : "dataInPort", 0x02 : "dataOutPort"}
+        if self.terminals is None or address not in names:
+            self.__fault(idx, "Port with address 0x{0:02X} not found".format(address))
+            return ports
+        for instance in idx.tolist():
+            ports.append((instance, getattr(self.terminals[instance], names[address])))
+        return ports
+
+    def __MOV(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        self.registerFile[destinationRegisterId, idx] = self.registerFile[sourceRegisterId, idx]
+
+    def __SET(self, idx, nextPc, registerId, constValue):
+        self.registerFile[registerId, idx] = constValue
+
+    def __LOAD(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        addresses = self.registerFile[sourceRegisterId, idx]
+        valid = self.__checkAddress(idx, addresses)
+        self.registerFile[destinationRegisterId, idx[valid]] = self.ram[idx[valid], addresses[valid]]
+
+    def __STOR(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        addresses = self.registerFile[destinationRegisterId, idx]
+        valid = self.__checkAddress(idx, addresses)
+        self.ram[idx[valid], addresses[valid]] = self.registerFile[sourceRegisterId, idx[valid]]
+
+    def __setCarryWhere(self, idx, condition):
+        self.registerFile[FLAG_REGISTER, idx] |= numpy.where(condition, self.CARRY_FLAG, 0)
+
+    def __ADD(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        registers[FLAG_REGISTER, idx] &= ~self.CARRY_FLAG
+        result = registers[sourceRegisterId, idx] + registers[destinationRegisterId, idx]
+        self.__setCarryWhere(idx, result >= self.WORD_SIZE)
+        registers[destinationRegisterId, idx] = result % self.WORD_SIZE
+
+    def __SUB(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        registers[FLAG_REGISTER, idx] &= ~self.CARRY_FLAG
+        A = registers[sourceRegisterId, idx]
+        B = registers[destinationRegisterId, idx]
+        result = B - A
+        borrow = result < 0
+        self.__setCarryWhere(idx, borrow)
+        registers[destinationRegisterId, idx] = numpy.where(borrow, self.WORD_SIZE - B, result)
+
+    def __MUL(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        registers[FLAG_REGISTER, idx] &= ~self.CARRY_FLAG
+        result = registers[sourceRegisterId, idx] * registers[destinationRegisterId, idx]
+        self.__setCarryWhere(idx, result >= self.WORD_SIZE)
+        registers[destinationRegisterId, idx] = result % self.WORD_SIZE
+
+    def __DIV(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        registers[FLAG_REGISTER, idx] &= ~self.CARRY_FLAG
+        A = registers[sourceRegisterId, idx]
+        valid = self.__checkDivisor(idx, A)
+        idx = idx[valid]
+        registers[destinationRegisterId, idx] //= A[valid]
+
+    def __MOD(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        A = registers[sourceRegisterId, idx]
+        valid = self.__checkDivisor(idx, A)
+        idx = idx[valid]
+        registers[destinationRegisterId, idx] %= A[valid]
+
+    def __OR(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        self.registerFile[destinationRegisterId, idx] |= self.registerFile[sourceRegisterId, idx]
+
+    def __AND(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        self.registerFile[destinationRegisterId, idx] &= self.registerFile[sourceRegisterId, idx]
+
+    def __XOR(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        self.registerFile[destinationRegisterId, idx] ^= self.registerFile[sourceRegisterId, idx]
+
+    def __NOT(self, idx, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        registers[destinationRegisterId, idx] = (~ registers[destinationRegisterId, idx]) % self.WORD_SIZE
+
+    def __SHL(self, idx, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        result = registers[destinationRegisterId, idx] << 1
+        overflow = result >= self.WORD_SIZE
+        self.__setCarryWhere(idx, overflow)
+        registers[destinationRegisterId, idx] = numpy.where(overflow, result % self.WORD_SIZE, result)
+
+    def __SHR(self, idx, nextPc, destinationRegisterId):
+        self.registerFile[destinationRegisterId, idx] >>= 1
+
+    def __CMP(self, idx, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        registers[FLAG_REGISTER, idx] &= ~(self.CARRY_FLAG | self.ZERO_FLAG)
+        result = registers[destinationRegisterId, idx] - registers[sourceRegisterId, idx]
+        registers[FLAG_REGISTER, idx] |= numpy.where(result < 0, self.CARRY_FLAG,
+            numpy.where(result == 0, self.ZERO_FLAG, 0))
+
+    def __jumpWhere(self, idx, nextPc, jumpOffset, condition):
+        self.registerFile[PROGRAM_COUNTER, idx[condition]] = (nextPc + jumpOffset) % self.WORD_SIZE
+
+    def __JZ(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset, (flags & self.ZERO_FLAG) != 0)
+
+    def __JNZ(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset, (flags & self.ZERO_FLAG) == 0)
+
+    def __JC(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset, (flags & self.CARRY_FLAG) != 0)
+
+    def __JNC(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset, (flags & self.CARRY_FLAG) == 0)
+
+    def __JBE(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset,
+            (flags & (self.CARRY_FLAG | self.ZERO_FLAG)) != 0)
+
+    def __JA(self, idx, nextPc, jumpOffset):
+        flags = self.registerFile[FLAG_REGISTER, idx]
+        self.__jumpWhere(idx, nextPc, jumpOffset,
+            (flags & (self.CARRY_FLAG | self.ZERO_FLAG)) == self.CARRY_FLAG)
+
+    def __PUSH(self, idx, nextPc, sourceRegisterId):
+        self.__push(idx, self.registerFile[sourceRegisterId, idx])
+
+    def __POP(self, idx, nextPc, destinationRegisterId):
+        idx, values = self.__pop(idx)
+        self.registerFile[destinationRegisterId, idx] = values
+
+    def __JMP(self, idx, nextPc, jumpOffset):
+        self.registerFile[PROGRAM_COUNTER, idx] = (nextPc + jumpOffset) % self.WORD_SIZE
+
+    def __JMPR(self, idx, nextPc, sourceRegisterId):
+        self.registerFile[PROGRAM_COUNTER, idx] = self.registerFile[sourceRegisterId, idx]
+
+    def __CALL(self, idx, nextPc, functionPointerOffset):
+        idx = self.__push(idx, numpy.full(len(idx), nextPc, dtype=numpy.int64))
+        self.registerFile[PROGRAM_COUNTER, idx] = (nextPc + functionPointerOffset) % self.WORD_SIZE
+
+    def __CALR(self, idx, nextPc, sourceRegisterId):
+        functionPointers = self.registerFile[sourceRegisterId, idx]
+        pushed = self.__push(idx, numpy.full(len(idx), nextPc, dtype=numpy.int64))
+        self.registerFile[PROGRAM_COUNTER, pushed] = functionPointers[numpy.isin(idx, pushed)]
+
+    def __RET(self, idx, nextPc):
+        idx, values = self.__pop(idx)
+        self.registerFile[PROGRAM_COUNTER, idx] = values
+
+    def __IN(self, idx, nextPc, portAddress, destinationRegisterId):
+        for instance, port in self.__ports(idx, portAddress):
+            self.registerFile[destinationRegisterId, instance] = port.read()
+
+    def __OUT(self, idx, nextPc, portAddress, sourceRegisterId):
+        for instance, port in self.__ports(idx, portAddress):
+            port.write(int(self.registerFile[sourceRegisterId, instance]))
+
+    def __HALT(self, idx, nextPc):
+        self.running[idx] = False
+
+    def load(self, program):
+        self.rom = padProgram(program)
+        self.__decodedRom = [self.__decodeInstructionAt(address)
+            for address in range(len(self.rom))]
+        self.registerFile[PROGRAM_COUNTER] = 0x00
+        self.running[:] = True
+        self.errors = {}
+
+    def step(self):
+        active = numpy.flatnonzero(self.running)
+        if len(active) == 0:
+            return False
+        programCounters = self.registerFile[PROGRAM_COUNTER, active]
+        outOfRom = programCounters >= len(self.rom)
+        self.__fault(active[outOfRom], "Program counter points outside program memory")
+        active, programCounters = active[~outOfRom], programCounters[~outOfRom]
+        for pc in numpy.unique(programCounters).tolist():
+            idx = active[programCounters == pc]
+            decoded = self.__decodedRom[pc]
+            if isinstance(decoded, str):
+                self.__fault(idx, decoded)
+                continue
+            handler, nextPc, operands = decoded
+            self.registerFile[PROGRAM_COUNTER, idx] = nextPc
+            handler(idx, nextPc, *operands)
+        return True
+
+    def run(self, program):
+        self.load(program)
+        while self.step():
+            pass
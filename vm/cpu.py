@@ -1,83 +1,371 @@
-class Cpu:    
+import array
+import asyncio
+import copy
+import struct
+import sys
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+from vm.jit import BlockCompiler
+from vm.registers import (FLAG_REGISTER, STACK_POINTER, PROGRAM_COUNTER, registerIdToName,
+    registerNameToId)
+
+UNLIMITED = sys.maxsize
+FUSED_INSTRUCTIONS_LIMIT = 3
+IDLE_INTERVAL = 0.001
+OPERAND_1 = -1
+OPERAND_2 = -2
+
+def padProgram(program):
+    missing = 0xFF - len(program)
+    if missing <= 0:
+        return program
+    if isinstance(program, list):
+        return program + [0xFF] * missing
+    return bytes(program) + b"\xFF" * missing
+
+def programKey(program):
+    return tuple(program) if isinstance(program, list) else bytes(program)
+
+def copyMemory(memory):
+    return memory[:] if isinstance(memory, list) else bytearray(memory)
+
+BREAKPOINT = "breakpoint"
+REGISTER_CHANGE = "register"
+MEMORY_READ = "read"
+MEMORY_WRITE = "write"
+
+Stop = namedtuple("Stop", ("reason", "pc", "target", "value"))
+
+# opcode : operand with register written by instruction
+opcodeToWrittenRegister = {
+    0x00 : OPERAND_1,
+    0x01 : OPERAND_1,
+    0x02 : OPERAND_1,
+    0x10 : OPERAND_1,
+    0x11 : OPERAND_1,
+    0x12 : OPERAND_1,
+    0x13 : OPERAND_1,
+    0x14 : OPERAND_1,
+    0x15 : OPERAND_1,
+    0x16 : OPERAND_1,
+    0x17 : OPERAND_1,
+    0x18 : OPERAND_1,
+    0x19 : OPERAND_1,
+    0x1A : OPERAND_1,
+    0x31 : OPERAND_1,
+    0x50 : OPERAND_2
+}
+
+# devices may look at registers while their port is accessed
+ioOpcodes = (0x50, 0x51)
+
+# opcode : (register holding accessed address, address offset, access)
+opcodeToMemoryAccess = {
+    0x02 : (OPERAND_2, 0, MEMORY_READ),
+    0x03 : (OPERAND_1, 0, MEMORY_WRITE),
+    0x30 : (STACK_POINTER, -1, MEMORY_WRITE),
+    0x31 : (STACK_POINTER, 0, MEMORY_READ),
+    0x42 : (STACK_POINTER, -1, MEMORY_WRITE),
+    0x43 : (STACK_POINTER, -1, MEMORY_WRITE),
+    0x44 : (STACK_POINTER, 0, MEMORY_READ)
+}
+
+SNAPSHOT_MAGIC = b"VMS1"
+snapshotHeader = struct.Struct("<4sBQ")   # magic, running, instructions count
+memoryHeader = struct.Struct("<cI")       # array typecode, cells count
+bufferHeader = struct.Struct("<I")        # encoded buffer length
+
+class RegisterFileView(Mapping):
+    __slots__ = ("registerFile",)
+
+    def __init__(self, registerFile):
+        self.registerFile = registerFile
+
+    def __getitem__(self, name):
+        return self.registerFile[registerNameToId[name]]
+
+    def __setitem__(self, name, value):
+        self.registerFile[registerNameToId[name]] = value
+
+    def __iter__(self):
+        return iter(registerNameToId)
+
+    def __len__(self):
+        return len(registerNameToId)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class Cpu:
+    __slots__ = ("ram", "rom", "running", "idle", "stopReason", "debugInfo", "instructionsCount", "skippedCycles", "terminal", "registerFile", "registers",
+        "opcodeToDecoderMapping", "io_devices", "__debug", "__jit", "__executionLoop",
+        "__blockCompiler", "__compiledProgram", "__decodedRom", "__decodedProgram", "__decodedRam", "__fusedRom",
+        "__opcodePairToFuserMapping", "__asyncMode", "__pendingIo", "__profiler",
+        "__tracer", "__ioRecorder", "__strict", "__initialRegisters", "__initialRam", "__program",
+        "__breakpoints", "__watchedRegisters", "__watchedMemory", "__memoryAccesses", "__stoppedAt",
+        "__lastPoll", "__flags")
+
     WORD_SIZE = 1 << 8
     CARRY_FLAG = 1 << 1
     ZERO_FLAG = 1 << 0
 
+    # jump opcode : (flags mask, value, jump when masked flags are equal to value)
+    jumpConditions = {
+        0x21 : (ZERO_FLAG, 0, False),
+        0x22 : (ZERO_FLAG, 0, True),
+        0x23 : (CARRY_FLAG, 0, False),
+        0x24 : (CARRY_FLAG, 0, True),
+        0x25 : (CARRY_FLAG | ZERO_FLAG, 0, False),
+        0x26 : (CARRY_FLAG | ZERO_FLAG, CARRY_FLAG, True)
+    }
+
+    # opcode : flags cleared before instruction reads its operands
+    opcodeToClearedFlags = {
+        0x10 : CARRY_FLAG,
+        0x11 : CARRY_FLAG,
+        0x12 : CARRY_FLAG,
+        0x13 : CARRY_FLAG,
+        0x20 : CARRY_FLAG | ZERO_FLAG
+    }
+
     available_registers = {
     "R0", "R1", "R2", "R3", "R4", "R5", "R6", "R7",
     "FR", "SP", "PC"
     }
 
     def _initRegisters(self):
-        self.registers = {}
-        for register in self.available_registers:
-            self.registers[register] = 0;
-        self.registers["SP"] = 0xFF   
+        self.registerFile = [0] * self.WORD_SIZE
+        self.registerFile[STACK_POINTER] = 0xFF
+        self.registers = RegisterFileView(self.registerFile)
 
-    def _getOpcodeToHandlerMapping(self):
+    def _getOpcodeToDecoderMapping(self):
         return {
-            0x00 : self.__MOV,
-            0x01 : self.__SET,
-            0x02 : self.__LOAD,
-            0x03 : self.__STOR,
-            0x10 : self.__ADD,
-            0x11 : self.__SUB,
-            0x12 : self.__MUL,
-            0x13 : self.__DIV,
-            0x14 : self.__MOD,
-            0x15 : self.__OR,
-            0x16 : self.__AND,
-            0x17 : self.__XOR,
-            0x18 : self.__NOT,
-            0x19 : self.__SHL,
-            0x1A : self.__SHR,
-            0x20 : self.__CMP,
-            0x21 : self.__JZ,
-            0x22 : self.__JNZ,
-            0x23 : self.__JC,
-            0x24 : self.__JNC,
-            0x25 : self.__JBE,
-            0x26 : self.__JA,
-            0x30 : self.__PUSH,
-            0x31 : self.__POP,
-            0x40 : self.__JMP,
-            0x41 : self.__JMPR,
-            0x42 : self.__CALL,
-            0x43 : self.__CALR,
-            0x44 : self.__RET,
-            0x50 : self.__IN,
-            0x51 : self.__OUT,
-            0xFF : self.__HALT }
+            0x00 : (2, self.__decodeMOV),
+            0x01 : (2, self.__decodeSET),
+            0x02 : (2, self.__decodeLOAD),
+            0x03 : (2, self.__decodeSTOR),
+            0x10 : (2, self.__decodeADD),
+            0x11 : (2, self.__decodeSUB),
+            0x12 : (2, self.__decodeMUL),
+            0x13 : (2, self.__decodeDIV),
+            0x14 : (2, self.__decodeMOD),
+            0x15 : (2, self.__decodeOR),
+            0x16 : (2, self.__decodeAND),
+            0x17 : (2, self.__decodeXOR),
+            0x18 : (1, self.__decodeNOT),
+            0x19 : (1, self.__decodeSHL),
+            0x1A : (1, self.__decodeSHR),
+            0x20 : (2, self.__decodeCMP),
+            0x21 : (1, self.__decodeJZ),
+            0x22 : (1, self.__decodeJNZ),
+            0x23 : (1, self.__decodeJC),
+            0x24 : (1, self.__decodeJNC),
+            0x25 : (1, self.__decodeJBE),
+            0x26 : (1, self.__decodeJA),
+            0x30 : (1, self.__decodePUSH),
+            0x31 : (1, self.__decodePOP),
+            0x40 : (1, self.__decodeJMP),
+            0x41 : (1, self.__decodeJMPR),
+            0x42 : (1, self.__decodeCALL),
+            0x43 : (1, self.__decodeCALR),
+            0x44 : (0, self.__decodeRET),
+            0x50 : (2, self.__decodeIN),
+            0x51 : (2, self.__decodeOUT),
+            0xFF : (0, self.__decodeHALT) }
+
+    def _getOpcodePairToFuserMapping(self):
+        mapping = {
+            (0x01, 0x30) : self.__fuseSETPUSH,
+            (0x30, 0x42) : self.__fusePUSHCALL,
+            (0x01, 0x51) : self.__fuseSETOUT }
+        for jump in self.jumpConditions:
+            mapping[(0x20, jump)] = self.__fuseCMPJcc
+        return mapping
 
     @staticmethod
-    def __registerIdToName(registerId):
-        registerIdToName = {
-        0x00 : "R0",
-        0x01 : "R1",
-        0x02 : "R2",
-        0x03 : "R3",
-        0x04 : "R4",
-        0x05 : "R5",
-        0x06 : "R6",
-        0x07 : "R7",
-        0xFD : "FR",
-        0xFE : "SP",
-        0xFF : "PC",
-        }
-        try:
-            return registerIdToName[registerId]
-        except KeyError:
+    def __validateRegisterId(registerId):
+        if registerId not in registerIdToName:
             raise Exception("Unknown register " + str(registerId))
-    
-    def __init__(self, ram, terminal, debug=False):
+        return registerId
+
+    def __init__(self, ram, terminal, debug=False, jit=False, strict=False):
         self.ram = ram
         self.rom = []
         self.running = False
+        self.idle = False
+        self.instructionsCount = 0
+        self.skippedCycles = 0
         self.terminal = terminal
         self._initRegisters()
-        self.opcodeToHandlerMapping = self._getOpcodeToHandlerMapping()
+        self.stopReason = None
+        self.debugInfo = None
+        self.__initialRegisters = self.registerFile[:]
+        self.__initialRam = copyMemory(ram)
+        self.__program = None
+        self.opcodeToDecoderMapping = self._getOpcodeToDecoderMapping()
+        self.__ioRecorder = None
         self.io_devices = self.__initDevices()
-        self.debug = debug
+        self.__blockCompiler = None
+        self.__compiledProgram = None
+        self.__decodedRom = None
+        self.__fusedRom = None
+        self.__opcodePairToFuserMapping = self._getOpcodePairToFuserMapping()
+        self.__decodedProgram = None
+        self.__decodedRam = None
+        self.__asyncMode = False
+        self.__pendingIo = None
+        self.__profiler = None
+        self.__tracer = None
+        self.__breakpoints = set()
+        self.__watchedRegisters = set()
+        self.__watchedMemory = {MEMORY_READ : set(), MEMORY_WRITE : set()}
+        self.__memoryAccesses = None
+        self.__stoppedAt = None
+        self.__lastPoll = None
+        self.__flags = [0, 1]
+        self.__debug = debug
+        self.__jit = jit
+        self.__strict = strict
+        self.__selectExecutionLoop()
+
+    @property
+    def debug(self):
+        return self.__debug
+
+    @debug.setter
+    def debug(self, debug):
+        self.__debug = debug
+        self.__selectExecutionLoop()
+
+    @property
+    def jit(self):
+        return self.__jit
+
+    @jit.setter
+    def jit(self, jit):
+        self.__jit = jit
+        self.__selectExecutionLoop()
+
+    @property
+    def strict(self):
+        return self.__strict
+
+    @strict.setter
+    def strict(self, strict):
+        self.__strict = strict
+        self.__decodedProgram = None
+        self.__compiledProgram = None
+
+    def memoryMask(self):
+        if self.__strict or len(self.ram) != self.WORD_SIZE:
+            return None
+        return self.WORD_SIZE - 1
+
+    @property
+    def profiler(self):
+        return self.__profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self.__profiler = profiler
+        self.__selectExecutionLoop()
+
+    @property
+    def tracer(self):
+        return self.__tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self.__tracer = tracer
+        self.__selectExecutionLoop()
+
+    @property
+    def ioRecorder(self):
+        return self.__ioRecorder
+
+    @ioRecorder.setter
+    def ioRecorder(self, ioRecorder):
+        self.__ioRecorder = ioRecorder
+        self.io_devices = self.__initDevices()
+        self.__decodedProgram = None
+        self.__compiledProgram = None
+        self.__selectExecutionLoop()
+
+    def __codeAddress(self, address):
+        if not isinstance(address, str):
+            return address
+        if self.debugInfo is None:
+            raise Exception("Can't resolve " + address + " without debug info")
+        return self.debugInfo.address(address)
+
+    def addBreakpoint(self, address):
+        self.__breakpoints.add(self.__codeAddress(address))
+        self.__selectExecutionLoop()
+
+    def removeBreakpoint(self, address):
+        self.__breakpoints.discard(self.__codeAddress(address))
+        self.__selectExecutionLoop()
+
+    def watchRegister(self, name):
+        if name not in registerNameToId:
+            raise Exception("Unknown register " + str(name))
+        self.__watchedRegisters.add(registerNameToId[name])
+        self.__selectExecutionLoop()
+
+    def unwatchRegister(self, name):
+        self.__watchedRegisters.discard(registerNameToId.get(name))
+        self.__selectExecutionLoop()
+
+    def watchMemory(self, address, read=False, write=True):
+        if read:
+            self.__watchedMemory[MEMORY_READ].add(address)
+        if write:
+            self.__watchedMemory[MEMORY_WRITE].add(address)
+        self.__selectExecutionLoop()
+
+    def unwatchMemory(self, address):
+        for addresses in self.__watchedMemory.values():
+            addresses.discard(address)
+        self.__selectExecutionLoop()
+
+    def clearBreakpoints(self):
+        self.__breakpoints.clear()
+        self.__watchedRegisters.clear()
+        for addresses in self.__watchedMemory.values():
+            addresses.clear()
+        self.__selectExecutionLoop()
+
+    def __debugging(self):
+        return bool(self.__breakpoints or self.__watchedRegisters
+            or self.__watchedMemory[MEMORY_READ] or self.__watchedMemory[MEMORY_WRITE])
+
+    def __instruments(self):
+        return [instrument for instrument in (self.__profiler, self.__tracer)
+            if instrument is not None]
+
+    def __interpreterLoop(self):
+        if self.__debugging():
+            return self.__runDebugged
+        if self.__debug:
+            return self.__runTraced
+        if self.__instruments():
+            return self.__runInstrumented
+        return self.__predecodedLoop()
+
+    # fused handlers read ports before counting, so recorded runs skip fusion
+    def __predecodedLoop(self):
+        if self.__ioRecorder is not None:
+            return self.__runCounted
+        return self.__runPredecoded
+
+    def __selectExecutionLoop(self):
+        if self.__debug or self.__debugging() or self.__instruments():
+            self.__executionLoop = self.__interpreterLoop()
+        elif self.__jit:
+            self.__executionLoop = self.__runCompiled
+        else:
+            self.__executionLoop = self.__predecodedLoop()
 
     def __initDevices(self):
         devices = {
@@ -85,322 +373,975 @@ class Cpu:
         0x01 : self.terminal.dataInPort,
         0x02 : self.terminal.dataOutPort
         }
+        if self.__ioRecorder is not None:
+            return self.__ioRecorder.wrap(devices, self)
         return devices
 
-    def __fetchNextByteFromRom(self):
-        byte = self.rom[self.registers["PC"]]
-        self.registers["PC"] += 1
-        return byte
+    # handlers keep results of last operations instead of flags: carry is set when
+    # first value is negative, zero when second one is 0; FR is written only where seen
+    def __loadFlags(self):
+        flags = self.registerFile[FLAG_REGISTER]
+        self.__flags[0] = -1 if flags & self.CARRY_FLAG else 0
+        self.__flags[1] = 0 if flags & self.ZERO_FLAG else 1
+
+    def __storeFlags(self):
+        carry, zero = self.__flags
+        flags = self.registerFile[FLAG_REGISTER] & ~(self.CARRY_FLAG | self.ZERO_FLAG)
+        if carry < 0:
+            flags |= self.CARRY_FLAG
+        if not zero:
+            flags |= self.ZERO_FLAG
+        self.registerFile[FLAG_REGISTER] = flags
+
+    @staticmethod
+    def __writesFlags(instruction):
+        operand = opcodeToWrittenRegister.get(instruction[0])
+        return (operand is not None and len(instruction) > -operand
+            and instruction[-operand] == FLAG_REGISTER)
+
+    def __synchronizeFlags(self, handler, *instructions):
+        if not any(FLAG_REGISTER in instruction[1:] or instruction[0] in ioOpcodes
+                for instruction in instructions):
+            return handler
+        cpu = self
+        registers = self.registerFile
+        cleared = 0
+        for instruction in instructions:
+            if FLAG_REGISTER in instruction[1:]:
+                cleared |= self.opcodeToClearedFlags.get(instruction[0], 0)
+        if not any(self.__writesFlags(instruction) for instruction in instructions):
+            def READ_FLAGS():
+                cpu.__storeFlags()
+                registers[FLAG_REGISTER] &= ~cleared
+                handler()
+            return READ_FLAGS
+        def WRITE_FLAGS():
+            cpu.__storeFlags()
+            registers[FLAG_REGISTER] &= ~cleared
+            try:
+                handler()
+            finally:
+                cpu.__loadFlags()
+        return WRITE_FLAGS
+
+    @staticmethod
+    def __decodeFailure(exception):
+        def FAIL():
+            raise exception
+        return FAIL
+
+    def __checkedMemory(self):
+        ram = self.ram
+        def validateAddress(address):
+            if address >= len(ram) or address < 0:
+                raise Exception ("Address 0x{0:02X} points outside memory "
+                    "address space (avail. 0x00-0x{1:02X})".format(address, len(ram)-1))
+        return ram, validateAddress
+
+    def __stackAccessors(self):
+        ram = self.ram
+        registers = self.registerFile
+        def push(value):
+            if registers[STACK_POINTER] == 0:
+                raise Exception("Stack pointer is already at 0x00. Can't move it further back.")
+            registers[STACK_POINTER] -= 0x1
+            ram[registers[STACK_POINTER]] = value
+        def pop():
+            if registers[STACK_POINTER] == 0xFF:
+                raise Exception("Stack pointer is already at 0xFF. Can't move it further.")
+            value = ram[registers[STACK_POINTER]]
+            registers[STACK_POINTER] += 0x1
+            return value
+        return push, pop
+
+    def __port(self, address):
+        try:
+            return self.io_devices[address]
+        except KeyError:
+            raise Exception("Port with address 0x{0:02X} not found".format(address))
+
+    def __decodeMOV(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def MOV():
+            registers[destination] = registers[source]
+        return MOV
+
+    def __decodeSET(self, nextPc, registerId, constValue):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(registerId)
+        def SET():
+            registers[destination] = constValue
+        return SET
+
+    def __decodeLOAD(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        ram, validateAddress = self.__checkedMemory()
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        mask = self.memoryMask()
+        if mask is not None:
+            def LOAD():
+                registers[destination] = ram[registers[source] & mask]
+            return LOAD
+        def LOAD():
+            memoryAddress = registers[source]
+            validateAddress(memoryAddress)
+            registers[destination] = ram[memoryAddress]
+        return LOAD
+
+    def __decodeSTOR(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        ram, validateAddress = self.__checkedMemory()
+        destination = self.__validateRegisterId(destinationRegisterId)
+        source = self.__validateRegisterId(sourceRegisterId)
+        mask = self.memoryMask()
+        if mask is not None:
+            def STOR():
+                ram[registers[destination] & mask] = registers[source]
+            return STOR
+        def STOR():
+            memoryAddress = registers[destination]
+            validateAddress(memoryAddress)
+            ram[memoryAddress] = registers[source]
+        return STOR
+
+    def __decodeADD(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        WORD_SIZE, flags = self.WORD_SIZE, self.__flags
+        def ADD():
+            result = registers[source] + registers[destination]
+            flags[0] = WORD_SIZE - 1 - result
+            registers[destination] = result % WORD_SIZE
+        return ADD
+
+    def __decodeSUB(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        WORD_SIZE, flags = self.WORD_SIZE, self.__flags
+        def SUB():
+            A = registers[source]
+            B = registers[destination]
+            result = flags[0] = B - A
+            if result < 0:
+                result = WORD_SIZE - B
+            registers[destination] = result
+        return SUB
+
+    def __decodeMUL(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        WORD_SIZE, flags = self.WORD_SIZE, self.__flags
+        def MUL():
+            result = registers[source] * registers[destination]
+            flags[0] = WORD_SIZE - 1 - result
+            registers[destination] = result % WORD_SIZE
+        return MUL
+
+    def __decodeDIV(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        flags = self.__flags
+        def DIV():
+            flags[0] = 0
+            A = registers[source]
+            if A == 0:
+                raise Exception("Division by 0 error")
+            registers[destination] = registers[destination] // A
+        return DIV
+
+    def __decodeMOD(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def MOD():
+            A = registers[source]
+            if A == 0:
+                raise Exception("Division by 0 error")
+            registers[destination] = registers[destination] % A
+        return MOD
 
-    def __debugPrint(self, string):
-        if self.debug:
-            print("PC:0x{0:02X} [DEBUG] {1}".format(self.registers["PC"], string))
+    def __decodeOR(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def OR():
+            registers[destination] = registers[destination] | registers[source]
+        return OR
 
-    def __setRegisterValueById(self, id, value):
-        self.__debugPrint("Setting register 0x{0:02X}, with 0x{1:02X}".format(id,value))
-        self.registers[self.__registerIdToName(id)] = value
+    def __decodeAND(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def AND():
+            registers[destination] = registers[destination] & registers[source]
+        return AND
 
-    def __getRegisterValueById(self, id):
-        self.__debugPrint("Fetching register 0x{0:02X}".format(id))
-        return self.registers[self.__registerIdToName(id)]
+    def __decodeXOR(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def XOR():
+            registers[destination] = registers[destination] ^ registers[source]
+        return XOR
 
-    def __validateAddress(self, address):
-        if address >= len(self.ram) or address < 0:
-            raise Exception ("Address 0x{0:02X} points outside memory "
-                "address space (avail. 0x00-0x{1:02X})".format(address, len(self.ram)-1))    
+    def __decodeNOT(self, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(destinationRegisterId)
+        WORD_SIZE = self.WORD_SIZE
+        def NOT():
+            registers[destination] = (~ registers[destination]) % WORD_SIZE
+        return NOT
 
-    def __getMemoryValueAt(self, address):
-        self.__validateAddress(address)
-        return self.ram[address]
+    def __decodeSHL(self, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(destinationRegisterId)
+        WORD_SIZE, flags = self.WORD_SIZE, self.__flags
+        def SHL():
+            result = registers[destination] << 1
+            if result >= WORD_SIZE:
+                result %= WORD_SIZE
+                flags[0] = -1
+            registers[destination] = result
+        return SHL
 
-    def __setMemoryValueAt(self, address, value):
-        self.__validateAddress(address)
-        self.ram[address] = value
+    def __decodeSHR(self, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(destinationRegisterId)
+        def SHR():
+            registers[destination] = registers[destination] >> 1
+        return SHR
 
-    def __setCarryFlag(self):
-        self.registers["FR"] |= self.CARRY_FLAG
+    def __decodeCMP(self, nextPc, destinationRegisterId, sourceRegisterId):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(destinationRegisterId)
+        source = self.__validateRegisterId(sourceRegisterId)
+        flags = self.__flags
+        def CMP():
+            flags[0] = flags[1] = registers[destination] - registers[source]
+        return CMP
 
-    def __clearCarryFlag(self):
-        self.registers["FR"] &= (~self.CARRY_FLAG)
+    def __jumpTarget(self, nextPc, offset):
+        return (nextPc + offset) % self.WORD_SIZE
 
-    def __setZeroFlag(self):
-        self.registers["FR"] |= self.ZERO_FLAG
+    def __decodeJZ(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JZ():
+            if not flags[1]:
+                registers[PROGRAM_COUNTER] = target
+        return JZ
 
-    def __clearZeroFlag(self):
-        self.registers["FR"] &= (~self.ZERO_FLAG)
+    def __decodeJNZ(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JNZ():
+            if flags[1]:
+                registers[PROGRAM_COUNTER] = target
+        return JNZ
 
-    def __isZeroFlagSet(self):
-        return bool(self.registers["FR"] & self.ZERO_FLAG)
+    def __decodeJC(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JC():
+            if flags[0] < 0:
+                registers[PROGRAM_COUNTER] = target
+        return JC
 
-    def __isCarryFlagSet(self):
-        return bool(self.registers["FR"] & self.CARRY_FLAG)
+    def __decodeJNC(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JNC():
+            if flags[0] >= 0:
+                registers[PROGRAM_COUNTER] = target
+        return JNC
 
-    def __readByteFromPort(self, address):
+    def __decodeJBE(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JBE():
+            if flags[0] < 0 or not flags[1]:
+                registers[PROGRAM_COUNTER] = target
+        return JBE
+
+    def __decodeJA(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        flags = self.__flags
+        def JA():
+            if flags[0] < 0 and flags[1]:
+                registers[PROGRAM_COUNTER] = target
+        return JA
+
+    def __decodePUSH(self, nextPc, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        push, pop = self.__stackAccessors()
+        def PUSH():
+            push(registers[source])
+        return PUSH
+
+    def __decodePOP(self, nextPc, destinationRegisterId):
+        registers = self.registerFile
+        destination = self.__validateRegisterId(destinationRegisterId)
+        push, pop = self.__stackAccessors()
+        def POP():
+            registers[destination] = pop()
+        return POP
+
+    def __decodeJMP(self, nextPc, jumpOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        def JMP():
+            registers[PROGRAM_COUNTER] = target
+        return JMP
+
+    def __decodeJMPR(self, nextPc, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        def JMPR():
+            registers[PROGRAM_COUNTER] = registers[source]
+        return JMPR
+
+    def __decodeCALL(self, nextPc, functionPointerOffset):
+        registers = self.registerFile
+        target = self.__jumpTarget(nextPc, functionPointerOffset)
+        push, pop = self.__stackAccessors()
+        def CALL():
+            push(nextPc)
+            registers[PROGRAM_COUNTER] = target
+        return CALL
+
+    def __decodeCALR(self, nextPc, sourceRegisterId):
+        registers = self.registerFile
+        source = self.__validateRegisterId(sourceRegisterId)
+        push, pop = self.__stackAccessors()
+        def CALR():
+            functionPointer = registers[source]
+            push(nextPc)
+            registers[PROGRAM_COUNTER] = functionPointer
+        return CALR
+
+    def __decodeRET(self, nextPc):
+        registers = self.registerFile
+        push, pop = self.__stackAccessors()
+        def RET():
+            registers[PROGRAM_COUNTER] = pop()
+        return RET
+
+    def __suspend(self, coroutine, destinationRegisterId):
+        self.__pendingIo = (coroutine, destinationRegisterId)
+        self.running = False
+
+    def __decodeIN(self, nextPc, portAddress, destinationRegisterId):
+        registers = self.registerFile
+        port = self.__port(portAddress)
+        destination = self.__validateRegisterId(destinationRegisterId)
+        if port.readAsync is not None:
+            cpu = self
+            def IN():
+                if cpu.__asyncMode:
+                    cpu.__suspend(port.readAsync(), destination)
+                else:
+                    registers[destination] = port.read()
+            return IN
+        def IN():
+            registers[destination] = port.read()
+        return IN
+
+    def __decodeOUT(self, nextPc, portAddress, sourceRegisterId):
+        registers = self.registerFile
+        port = self.__port(portAddress)
+        source = self.__validateRegisterId(sourceRegisterId)
+        if port.writeAsync is not None:
+            cpu = self
+            def OUT():
+                if cpu.__asyncMode:
+                    cpu.__suspend(port.writeAsync(registers[source]), None)
+                else:
+                    port.write(registers[source])
+            return OUT
+        def OUT():
+            port.write(registers[source])
+        return OUT
+
+    def __decodeHALT(self, nextPc):
+        cpu = self
+        def HALT():
+            cpu.running = False
+        return HALT
+
+    def __validateFusedRegisterId(self, registerId):
+        if registerId == PROGRAM_COUNTER:
+            raise Exception("Program counter can't be used by fused instructions")
+        return self.__validateRegisterId(registerId)
+
+    def __fuseCMPJcc(self, middlePc, nextPc, first, second):
+        registers = self.registerFile
+        destination = self.__validateFusedRegisterId(first[1])
+        source = self.__validateFusedRegisterId(first[2])
+        target = self.__jumpTarget(nextPc, second[1])
+        mask, value, equal = self.jumpConditions[second[0]]
+        CARRY_FLAG, ZERO_FLAG, flags = self.CARRY_FLAG, self.ZERO_FLAG, self.__flags
+        def CMP_Jcc():
+            result = flags[0] = flags[1] = registers[destination] - registers[source]
+            compared = CARRY_FLAG if result < 0 else ZERO_FLAG if result == 0 else 0
+            if (compared & mask == value) == equal:
+                registers[PROGRAM_COUNTER] = target
+        return CMP_Jcc
+
+    def __fuseSETPUSH(self, middlePc, nextPc, first, second):
+        cpu = self
+        registers = self.registerFile
+        destination = self.__validateFusedRegisterId(first[1])
+        constValue = first[2]
+        source = self.__validateFusedRegisterId(second[1])
+        push, pop = self.__stackAccessors()
+        def SET_PUSH():
+            registers[destination] = constValue
+            try:
+                push(registers[source])
+            except Exception:
+                cpu.instructionsCount += 1
+                raise
+        return SET_PUSH
+
+    def __fusePUSHCALL(self, middlePc, nextPc, first, second):
+        cpu = self
+        registers = self.registerFile
+        source = self.__validateFusedRegisterId(first[1])
+        target = self.__jumpTarget(nextPc, second[1])
+        push, pop = self.__stackAccessors()
+        def PUSH_CALL():
+            try:
+                push(registers[source])
+            except Exception:
+                registers[PROGRAM_COUNTER] = middlePc
+                raise
+            try:
+                push(nextPc)
+            except Exception:
+                cpu.instructionsCount += 1
+                raise
+            registers[PROGRAM_COUNTER] = target
+        return PUSH_CALL
+
+    def __fuseSETOUT(self, middlePc, nextPc, first, second):
+        cpu = self
+        registers = self.registerFile
+        destination = self.__validateFusedRegisterId(first[1])
+        constValue = first[2]
+        port = self.__port(second[1])
+        source = self.__validateFusedRegisterId(second[2])
+        if port.writeAsync is not None:
+            raise Exception("Asynchronous port can't be used by fused instructions")
+        def SET_OUT():
+            registers[destination] = constValue
+            try:
+                port.write(registers[source])
+            except Exception:
+                cpu.instructionsCount += 1
+                raise
+        return SET_OUT
+
+    def __park(self):
+        self.idle = True
+        self.running = False
+
+    def __fusePollLoop(self, address, decodedRom):
+        cmpPc = decodedRom[address][1]
+        jumpPc = decodedRom[cmpPc][1] if cmpPc < len(decodedRom) else cmpPc
+        nextPc = decodedRom[jumpPc][1] if jumpPc < len(decodedRom) else jumpPc
+        poll = self.rom[address : cmpPc]
+        compare = self.rom[cmpPc : jumpPc]
+        jump = self.rom[jumpPc : nextPc]
+        if (len(poll) != 3 or len(compare) != 3 or len(jump) != 2 or compare[0] != 0x20
+                or jump[0] not in self.jumpConditions
+                or self.__jumpTarget(nextPc, jump[1]) != address):
+            return None
+        polled = poll[2]
+        if (polled >= 0x08 or polled not in (compare[1], compare[2])
+                or FLAG_REGISTER in compare[1:]):
+            return None
+        port = self.__port(poll[1])
+        if port.readAsync is not None:
+            return None
+        cpu = self
+        parks = port.status
+        registers = self.registerFile
+        destination = self.__validateFusedRegisterId(compare[1])
+        source = self.__validateFusedRegisterId(compare[2])
+        mask, value, equal = self.jumpConditions[jump[0]]
+        CARRY_FLAG, ZERO_FLAG, flags = self.CARRY_FLAG, self.ZERO_FLAG, self.__flags
+        def POLL():
+            try:
+                polledValue = port.read()
+            except Exception:
+                registers[PROGRAM_COUNTER] = cmpPc
+                raise
+            registers[polled] = polledValue
+            result = flags[0] = flags[1] = registers[destination] - registers[source]
+            compared = CARRY_FLAG if result < 0 else ZERO_FLAG if result == 0 else 0
+            if (compared & mask == value) == equal:
+                registers[PROGRAM_COUNTER] = address
+                if parks and cpu.__lastPoll == (address, polledValue):
+                    cpu.__park()
+                elif parks:
+                    cpu.__lastPoll = (address, polledValue)
+            else:
+                cpu.__lastPoll = None
+        return (self.__synchronizeFlags(POLL, poll, compare), nextPc, 3)
+
+    def __fuseInstructionsAt(self, address, decodedRom):
+        handler, middlePc = decodedRom[address]
+        if self.rom[address] == 0x50:
+            try:
+                pollLoop = self.__fusePollLoop(address, decodedRom)
+            except Exception:
+                pollLoop = None
+            if pollLoop is not None:
+                return pollLoop
+        if middlePc >= len(self.rom):
+            return (handler, middlePc, 1)
         try:
-            port = self.io_devices[address]
-            return port.read()
+            fuser = self.__opcodePairToFuserMapping[(self.rom[address], self.rom[middlePc])]
         except KeyError:
-            raise Exception("Port with address 0x{0:02X} not found".format(address))
+            return (handler, middlePc, 1)
+        nextPc = decodedRom[middlePc][1]
+        first = self.rom[address : middlePc]
+        second = self.rom[middlePc : nextPc]
+        if len(second) != nextPc - middlePc:
+            return (handler, middlePc, 1)
+        try:
+            return (self.__synchronizeFlags(fuser(middlePc, nextPc, first, second), first, second),
+                nextPc, 2)
+        except Exception:
+            return (handler, middlePc, 1)
 
-    def __writeByteToPort(self, address, value):
+    def __decodeInstructionAt(self, address):
+        opcode = self.rom[address]
         try:
-            port = self.io_devices[address]
-            return port.write(value)
+            operandsCount, decoder = self.opcodeToDecoderMapping[opcode]
         except KeyError:
-            raise Exception("Port with address 0x{0:02X} not found".format(address))
+            return (self.__decodeFailure(Exception("Unknown instruction 0x{0:02X}"
+                .format(opcode))), address + 1)
+        nextPc = address + 1 + operandsCount
+        operands = self.rom[address + 1 : nextPc]
+        if len(operands) < operandsCount:
+            return (self.__decodeFailure(Exception("Instruction at 0x{0:02X} exceeds "
+                "program memory".format(address))), len(self.rom))
+        try:
+            return (self.__synchronizeFlags(decoder(nextPc, *operands),
+                self.rom[address : nextPc]), nextPc)
+        except Exception as e:
+            return (self.__decodeFailure(e), nextPc)
+
+    def __decodeRom(self):
+        program = programKey(self.rom)
+        if self.__decodedProgram != program or self.__decodedRam is not self.ram:
+            self.__decodedRom = [self.__decodeInstructionAt(address)
+                for address in range(len(self.rom))]
+            self.__decodedProgram = program
+            self.__decodedRam = self.ram
+            self.__fusedRom = None
+            self.__memoryAccesses = None
+        return self.__decodedRom
+
+    def __fuseRom(self):
+        decodedRom = self.__decodeRom()
+        if self.__fusedRom is None:
+            self.__fusedRom = [self.__fuseInstructionsAt(address, decodedRom)
+                for address in range(len(decodedRom))]
+        return self.__fusedRom
+
+    def __runPredecoded(self, budget):
+        fusedRom = self.__fuseRom()
+        registers = self.registerFile
+        pc = PROGRAM_COUNTER
+        executed = 0
+        limit = budget - FUSED_INSTRUCTIONS_LIMIT + 1
+        self.__loadFlags()
+        try:
+            while self.running and executed < limit:
+                handler, registers[pc], count = fusedRom[registers[pc]]
+                handler()
+                executed += count
+            decodedRom = self.__decodedRom
+            while self.running and executed < budget:
+                handler, registers[pc] = decodedRom[registers[pc]]
+                handler()
+                executed += 1
+        except Exception as e:
+            print (e)
+            raise Exception(e)
+        finally:
+            self.__storeFlags()
+            self.instructionsCount += executed
+
+    def __runCounted(self, budget):
+        decodedRom = self.__decodeRom()
+        registers = self.registerFile
+        pc = PROGRAM_COUNTER
+        budget += self.instructionsCount
+        self.__loadFlags()
+        try:
+            while self.running and self.instructionsCount < budget:
+                handler, registers[pc] = decodedRom[registers[pc]]
+                handler()
+                self.instructionsCount += 1
+        except Exception as e:
+            print (e)
+            raise Exception(e)
+        finally:
+            self.__storeFlags()
 
+    def __recorder(self):
+        records = [instrument.prepare(self) for instrument in self.__instruments()]
+        if len(records) == 1:
+            return records[0]
+        def record(address, nextPc, pc):
+            for instrumentRecord in records:
+                instrumentRecord(address, nextPc, pc)
+        return record
 
-    def __MOV(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        value = self.__getRegisterValueById(sourceRegisterId)
-        self.__setRegisterValueById(destinationRegisterId, value)
-
-    def __SET(self):
-        registerId = self.__fetchNextByteFromRom()
-        constValue = self.__fetchNextByteFromRom()
-        self.__setRegisterValueById(registerId, constValue)
-
-    def __LOAD(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        memoryAddress = self.__getRegisterValueById(sourceRegisterId)
-        memoryValue = self.__getMemoryValueAt(memoryAddress)
-        self.__setRegisterValueById(destinationRegisterId, memoryValue)
-
-    def __STOR(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        memoryAddress = self.__getRegisterValueById(destinationRegisterId)
-        memoryValue = self.__getRegisterValueById(sourceRegisterId)
-        self.__setMemoryValueAt(memoryAddress, memoryValue)
-
-    def __ADD(self):
-        self.__clearCarryFlag()
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        if A + B >= self.WORD_SIZE:
-            self.__setCarryFlag()
-        result = (A + B) % self.WORD_SIZE
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __SUB(self):
-        self.__clearCarryFlag()
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        result = B - A
-        if result < 0:
-            self.__setCarryFlag()
-            result = self.WORD_SIZE - B
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __MUL(self):
-        self.__clearCarryFlag()
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        if A * B >= self.WORD_SIZE:
-            self.__setCarryFlag()
-        result = (A * B) % self.WORD_SIZE
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __DIV(self):
-        self.__clearCarryFlag()
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        if A == 0:
-            raise Exception("Division by 0 error")
-        result = B // A
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __MOD(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        if A == 0:
-            raise Exception("Division by 0 error")
-        result = B % A
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __OR(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        result = (B | A)
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __AND(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        result = (B & A)
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __XOR(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        B = self.__getRegisterValueById(destinationRegisterId)
-        result = (B ^ A)
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __NOT(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(destinationRegisterId)
-        result = (~ A) % self.WORD_SIZE
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __SHL(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(destinationRegisterId)
-        result = (A << 1) 
-        if result >= self.WORD_SIZE :
-            result %= self.WORD_SIZE
-            self.__setCarryFlag()
-        self.__setRegisterValueById(destinationRegisterId, result)
-
-    def __SHR(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(destinationRegisterId)
-        result = (A >> 1) 
-        self.__setRegisterValueById(destinationRegisterId, result)
-        
-    def __CMP(self):
-        self.__clearCarryFlag()
-        self.__clearZeroFlag()
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        B = self.__getRegisterValueById(destinationRegisterId)
-        A = self.__getRegisterValueById(sourceRegisterId)
-        result = B - A
-        if result < 0:
-            self.__setCarryFlag()
-            result = self.WORD_SIZE - B
-        elif result == 0:
-            self.__setZeroFlag()
-
-    def __jumpOf(self, offset):
-        self.__debugPrint("Jumping of 0x{0:02X}, to 0x{1:02X}".format(offset,
-            (self.registers["PC"] + offset)% self.WORD_SIZE ))
-        self.registers["PC"] = (self.registers["PC"] + offset) % self.WORD_SIZE 
-
-    def __JZ(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if self.__isZeroFlagSet():
-            self.__jumpOf(jumpOffset) 
-
-    def __JNZ(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if not self.__isZeroFlagSet():
-            self.__jumpOf(jumpOffset) 
-
-    def __JC(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if self.__isCarryFlagSet():
-            self.__jumpOf(jumpOffset) 
-
-    def __JNC(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if not self.__isCarryFlagSet():
-            self.__jumpOf(jumpOffset)
-
-    def __JBE(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if (self.__isCarryFlagSet() or self.__isZeroFlagSet()):
-            self.__jumpOf(jumpOffset)
-
-    def __JA(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        if (self.__isCarryFlagSet() and (not self.__isZeroFlagSet())):
-            self.__jumpOf(jumpOffset)
-
-    def __pushToStack(self, value):
-        if(self.registers["SP"] == 0):
-            raise Exception("Stack pointer is already at 0x00. Can't move it further back.")
-        self.registers["SP"] -= 0x1
-        self.ram[self.registers["SP"]] = value
-        self.__debugPrint("Pushing to stack 0x{0:02X}, SP=0x{1:02X}".format(value,
-            self.registers["SP"]))
-
-    def __popFromStack(self):
-        if(self.registers["SP"] == 0xFF):
-            raise Exception("Stack pointer is already at 0xFF. Can't move it further.")
-        A = self.ram[self.registers["SP"]]
-        self.registers["SP"] += 0x1
-        self.__debugPrint("Poping from stack 0x{0:02X}, SP=0x{1:02X}".format(A, self.registers["SP"]))
-        return A        
-
-    def __PUSH (self):
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        A = self.__getRegisterValueById(sourceRegisterId)
-        self.__pushToStack(A)
-
-    def __POP(self):
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        A = self.__popFromStack()
-        self.__setRegisterValueById(destinationRegisterId, A)
-
-    def __JMP(self):
-        jumpOffset = self.__fetchNextByteFromRom()
-        self.__jumpOf(jumpOffset)
-
-    def __JMPR(self):
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        jumpAddress = self.__getRegisterValueById(sourceRegisterId)
-        self.registers["PC"] = jumpAddress
-
-    def __CALL(self):
-        functionPointerOffset = self.__fetchNextByteFromRom()
-        self.__debugPrint("Calling function ahead: 0x{0:02X}".format(functionPointerOffset))
-        self.__pushToStack(self.registers["PC"])
-        self.__jumpOf(functionPointerOffset)
-
-    def __CALR(self):
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        functionPointer = self.__getRegisterValueById(sourceRegisterId)
-        self.__pushToStack(self.registers["PC"])
-        self.registers["PC"] = functionPointer
-
-    def __RET(self):
-        functionPointer = self.__popFromStack()
-        self.__debugPrint("Returning from function to PC = : 0x{0:02X}".format(functionPointer))
-        self.registers["PC"] = functionPointer
-
-    def __IN(self):
-        portAddress = self.__fetchNextByteFromRom()
-        value = self.__readByteFromPort(portAddress)
-        destinationRegisterId = self.__fetchNextByteFromRom()
-        self.__setRegisterValueById(destinationRegisterId, value)
-
-    def __OUT(self):
-        portAddress = self.__fetchNextByteFromRom()
-        sourceRegisterId = self.__fetchNextByteFromRom()
-        value = self.__getRegisterValueById(sourceRegisterId)
-        self.__writeByteToPort(portAddress, value)
-
-    def __HALT(self):
+    def __fail(self):
+        self.__storeFlags()
+        for instrument in self.__instruments():
+            instrument.fail()
+
+    def __runInstrumented(self, budget):
+        decodedRom = self.__decodeRom()
+        record = self.__recorder()
+        registers = self.registerFile
+        pc = PROGRAM_COUNTER
+        budget += self.instructionsCount
+        self.__loadFlags()
+        try:
+            while self.running and self.instructionsCount < budget:
+                address = registers[pc]
+                handler, nextPc = decodedRom[address]
+                registers[pc] = nextPc
+                handler()
+                self.instructionsCount += 1
+                self.__storeFlags()
+                record(address, nextPc, registers[pc])
+        except Exception as e:
+            self.__fail()
+            print (e)
+            raise Exception(e)
+        finally:
+            self.__storeFlags()
+
+    def __memoryAccessAt(self, address):
+        try:
+            source, offset, access = opcodeToMemoryAccess[self.rom[address]]
+        except KeyError:
+            return None
+        if source < 0:
+            if address - source >= len(self.rom):
+                return None
+            source = self.rom[address - source]
+        return source, offset, access
+
+    def __decodeMemoryAccesses(self):
+        self.__decodeRom()
+        if self.__memoryAccesses is None:
+            self.__memoryAccesses = [self.__memoryAccessAt(address)
+                for address in range(len(self.rom))]
+        return self.__memoryAccesses
+
+    def __runDebugged(self, budget):
+        decodedRom = self.__decodeRom()
+        memoryAccesses = self.__decodeMemoryAccesses()
+        record = self.__recorder() if self.__instruments() else None
+        registers = self.registerFile
+        pc = PROGRAM_COUNTER
+        breakpoints = self.__breakpoints
+        watchedRegisters = sorted(self.__watchedRegisters)
+        watchedMemory = self.__watchedMemory
+        mask = self.WORD_SIZE - 1
+        traced = self.__debug
+        resumedAt = self.__stoppedAt
+        self.__stoppedAt = None
+        budget += self.instructionsCount
+        self.__loadFlags()
+        try:
+            while self.running and self.instructionsCount < budget:
+                address = registers[pc]
+                if address in breakpoints and address != resumedAt:
+                    self.__stoppedAt = address
+                    self.__stop(BREAKPOINT, address, address, None)
+                    break
+                resumedAt = None
+                access = memoryAccesses[address]
+                if access is not None:
+                    source, offset, kind = access
+                    memoryAddress = (registers[source] + offset) & mask
+                    if memoryAddress not in watchedMemory[kind]:
+                        access = None
+                values = [registers[registerId] for registerId in watchedRegisters]
+                handler, nextPc = decodedRom[address]
+                if traced:
+                    self.__debugPrint(address, "Executing instruction: 0x{0:02X}".format(self.rom[address]))
+                    registersBefore = registers[:]
+                    ramBefore = list(self.ram)
+                registers[pc] = nextPc
+                handler()
+                self.instructionsCount += 1
+                self.__storeFlags()
+                if traced:
+                    self.__traceChanges(address, nextPc, registersBefore, ramBefore)
+                if record is not None:
+                    record(address, nextPc, registers[pc])
+                if access is not None:
+                    self.__stop(kind, address, memoryAddress, self.ram[memoryAddress])
+                for registerId, value in zip(watchedRegisters, values):
+                    if registers[registerId] != value:
+                        self.__stop(REGISTER_CHANGE, address, registerIdToName[registerId],
+                            registers[registerId])
+                        break
+        except Exception as e:
+            self.__fail()
+            print (e)
+            raise Exception(e)
+        finally:
+            self.__storeFlags()
+
+    def __stop(self, reason, pc, target, value):
+        if self.running:
+            self.running = False
+            self.stopReason = Stop(reason, pc, target, value)
+
+    @staticmethod
+    def __debugPrint(pc, string):
+        print("PC:0x{0:02X} [DEBUG] {1}".format(pc, string))
+
+    def __traceChanges(self, pc, nextPc, registersBefore, ramBefore):
+        registers = self.registerFile
+        for registerId, name in registerIdToName.items():
+            if registerId != PROGRAM_COUNTER and registers[registerId] != registersBefore[registerId]:
+                self.__debugPrint(pc, "Setting register {0}, with 0x{1:02X}"
+                    .format(name, registers[registerId]))
+        for address, value in enumerate(self.ram):
+            if value != ramBefore[address]:
+                self.__debugPrint(pc, "Writing memory 0x{0:02X}, with 0x{1:02X}"
+                    .format(address, value))
+        if registers[PROGRAM_COUNTER] != nextPc:
+            self.__debugPrint(pc, "Jumping to 0x{0:02X}".format(registers[PROGRAM_COUNTER]))
+
+    def __runTraced(self, budget):
+        decodedRom = self.__decodeRom()
+        registers = self.registerFile
+        budget += self.instructionsCount
+        self.__loadFlags()
+        try:
+            while self.running and self.instructionsCount < budget:
+                pc = registers[PROGRAM_COUNTER]
+                handler, nextPc = decodedRom[pc]
+                self.__debugPrint(pc, "Executing instruction: 0x{0:02X}".format(self.rom[pc]))
+                registersBefore = registers[:]
+                ramBefore = list(self.ram)
+                registers[PROGRAM_COUNTER] = nextPc
+                handler()
+                self.instructionsCount += 1
+                self.__storeFlags()
+                self.__traceChanges(pc, nextPc, registersBefore, ramBefore)
+        except Exception as e:
+            print (e)
+            raise Exception(e)
+        finally:
+            self.__storeFlags()
+
+    def __runCompiled(self, budget):
+        program = programKey(self.rom)
+        compiler = self.__blockCompiler
+        if self.__compiledProgram != program or compiler.namespace["ram"] is not self.ram:
+            compiler = self.__blockCompiler = BlockCompiler(self, self.rom)
+            self.__compiledProgram = program
+        budget += self.instructionsCount
+        compiler.run(budget - self.instructionsCount)
+        if self.running and self.instructionsCount < budget:
+            self.__predecodedLoop()(budget - self.instructionsCount)
+
+    def reset(self):
+        self.registerFile[:] = self.__initialRegisters
+        self.ram[:] = self.__initialRam
         self.running = False
+        self.idle = False
+        self.instructionsCount = 0
+        self.skippedCycles = 0
+        self.stopReason = None
+        self.__stoppedAt = None
+        self.__lastPoll = None
+        self.__pendingIo = None
+
+    def load(self, program):
+        self.registerFile[PROGRAM_COUNTER] = 0x00
+        self.instructionsCount = 0
+        self.__stoppedAt = None
+        self.__lastPoll = None
+        if program is not self.__program or not isinstance(program, bytes):
+            self.rom = padProgram(program)
+            self.__program = program
+        self.running = True
+        for instrument in self.__instruments():
+            instrument.start()
+        if self.__ioRecorder is not None:
+            self.__ioRecorder.start()
+
+    def __execute(self, executionLoop, budget):
+        self.idle = False
+        self.stopReason = None
+        executed = self.instructionsCount
+        executionLoop(budget)
+        if self.idle:
+            self.running = True
+            if budget != UNLIMITED:
+                self.skippedCycles += budget - (self.instructionsCount - executed)
+
+    def __runUntilHalt(self):
+        self.__execute(self.__executionLoop, UNLIMITED)
+        while self.idle:
+            time.sleep(IDLE_INTERVAL)
+            self.__execute(self.__executionLoop, UNLIMITED)
 
     def run(self, program):
-        self.registers["PC"] = 0x00
-        self.rom = program
-        self.rom = self.rom + [0xFF]*(0xFF - len(self.rom))
+        self.load(program)
+        self.__runUntilHalt()
+
+    def resume(self):
+        self.running = True
+        self.__runUntilHalt()
+
+    def runFor(self, budget):
+        executed = self.instructionsCount
+        if self.stopReason is not None:
+            self.running = True
+        if self.running:
+            self.__execute(self.__executionLoop, budget)
+        return self.instructionsCount - executed
+
+    def step(self, count=1):
+        return self.runFor(count)
+
+    async def __runAsync(self, quantum):
+        executionLoop = self.__interpreterLoop()
+        self.__asyncMode = True
+        try:
+            while True:
+                self.__execute(executionLoop, quantum)
+                if self.__pendingIo is not None:
+                    coroutine, destination = self.__pendingIo
+                    self.__pendingIo = None
+                    try:
+                        value = await coroutine
+                    except Exception as e:
+                        print (e)
+                        raise Exception(e)
+                    if destination is not None:
+                        self.registerFile[destination] = value
+                    self.running = True
+                elif self.idle:
+                    await asyncio.sleep(IDLE_INTERVAL)
+                elif self.running:
+                    await asyncio.sleep(0)
+                else:
+                    break
+        finally:
+            self.__asyncMode = False
+
+    async def runAsync(self, program, quantum=1000):
+        self.load(program)
+        await self.__runAsync(quantum)
+
+    async def resumeAsync(self, quantum=1000):
         self.running = True
-        while self.running: 
-            instruction = self.__fetchNextByteFromRom()
-            self.__debugPrint("Executing instruction: 0x{0:02X}".format(instruction))
+        await self.__runAsync(quantum)
+
+    @staticmethod
+    def __packMemory(memory):
+        try:
+            return memoryHeader.pack(b"B", len(memory)) + bytes(memory)
+        except (ValueError, TypeError):
+            return memoryHeader.pack(b"i", len(memory)) + array.array("i", memory).tobytes()
+
+    @staticmethod
+    def __unpackMemory(blob, offset):
+        typecode, length = memoryHeader.unpack_from(blob, offset)
+        offset += memoryHeader.size
+        memory = array.array(typecode.decode())
+        end = offset + length * memory.itemsize
+        memory.frombytes(blob[offset:end])
+        return memory, end
+
+    @staticmethod
+    def __unpackBuffer(blob, offset):
+        length, = bufferHeader.unpack_from(blob, offset)
+        offset += bufferHeader.size
+        return bytes(blob[offset:offset + length]).decode(), offset + length
+
+    def snapshot(self):
+        registers = array.array("i", [self.registerFile[registerId] for registerId in registerIdToName])
+        chunks = [snapshotHeader.pack(SNAPSHOT_MAGIC, self.running, self.instructionsCount),
+            registers.tobytes(), self.__packMemory(self.ram), self.__packMemory(self.rom)]
+        for name in ("readbuffer", "writebuffer"):
+            buffer = getattr(self.terminal, name, "").encode()
+            chunks.append(bufferHeader.pack(len(buffer)) + buffer)
+        return b"".join(chunks)
+
+    def restore(self, blob):
+        blob = memoryview(blob)
+        magic, running, instructionsCount = snapshotHeader.unpack_from(blob)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception("Data is not a CPU snapshot")
+        offset = snapshotHeader.size
+        registers = array.array("i")
+        registersEnd = offset + len(registerIdToName) * registers.itemsize
+        registers.frombytes(blob[offset:registersEnd])
+        ram, offset = self.__unpackMemory(blob, registersEnd)
+        rom, offset = self.__unpackMemory(blob, offset)
+        if len(ram) != len(self.ram):
+            raise Exception("Snapshot RAM size 0x{0:02X} does not match CPU RAM size 0x{1:02X}"
+                .format(len(ram), len(self.ram)))
+        for registerId, value in zip(registerIdToName, registers):
+            self.registerFile[registerId] = value
+        if isinstance(self.ram, list):
+            self.ram[:] = ram.tolist()
+        else:
             try:
-                self.opcodeToHandlerMapping[instruction]() 
-            except Exception as e:
-                print (e)
-                raise Exception(e)
+                self.ram[:] = bytes(ram.tolist())
+            except ValueError:
+                raise Exception("Snapshot RAM holds values which don't fit in byte memory") from None
+        self.rom = rom.tobytes() if rom.typecode == "B" else rom.tolist()
+        self.__program = None
+        self.running = bool(running)
+        self.stopReason = None
+        self.__stoppedAt = None
+        self.__lastPoll = None
+        self.instructionsCount = instructionsCount
+        for name in ("readbuffer", "writebuffer"):
+            buffer, offset = self.__unpackBuffer(blob, offset)
+            if hasattr(self.terminal, name):
+                setattr(self.terminal, name, buffer)
+
+    def clone(self, terminal=None):
+        if terminal is None:
+            terminal = copy.deepcopy(self.terminal)
+        clone = Cpu(copyMemory(self.ram), terminal, self.__debug, self.__jit, self.__strict)
+        clone.registerFile[:] = self.registerFile
+        clone.rom = self.rom
+        clone.debugInfo = self.debugInfo
+        clone.running = self.running
+        clone.instructionsCount = self.instructionsCount
+        return clone
@@ -0,0 +1,61 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from vm.cpu import Cpu
+from vm.terminal import ScriptedTerminal
+
+RAM_SIZE = 256
+INITIAL_RAM = b"\xFF" * RAM_SIZE
+
+class Job:
+    def __init__(self, program, input=''):
+        self.program = program
+        self.input = input
+
+class FleetWorker:
+    def __init__(self):
+        self.ram = list(INITIAL_RAM)
+        self.terminal = ScriptedTerminal()
+        self.cpu = Cpu(self.ram, self.terminal)
+
+    def __reset(self, input):
+        self.cpu.reset()
+        self.terminal.load(input)
+
+    @staticmethod
+    def readProgram(path):
+        with open(path, 'rb') as source:
+            return source.read()
+
+    def run(self, job):
+        result = {"program" : job.program}
+        try:
+            program = self.readProgram(job.program)
+        except OSError as e:
+            result.update(state="failed", error=str(e))
+            return result
+        self.__reset(job.input)
+        try:
+            self.cpu.run(program)
+            result.update(state="halted", error=None)
+        except Exception as e:
+            result.update(state="failed", error=str(e))
+        result.update(
+            registers=dict(self.cpu.registers),
+            output=self.terminal.output,
+            instructions=self.cpu.instructionsCount)
+        return result
+
+_worker = None
+
+def _runJob(job):
+    global _worker
+    if _worker is None:
+        sys.stdout = open(os.devnull, 'w')   # guest errors are reported in results
+        _worker = FleetWorker()
+    return _worker.run(job)
+
+def runFleet(jobs, workers=None, chunksize=16):
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for result in executor.map(_runJob, jobs, chunksize=chunksize):
+            yield result
@@ -0,0 +1,499 @@
+from vm.registers import PROGRAM_COUNTER, registerIdToName
+
+WORD_SIZE = 1 << 8
+
+# condition evaluated on local flag register for each conditional jump
+conditionalJumps = {
+    0x21 : "fr & 0x01",
+    0x22 : "not fr & 0x01",
+    0x23 : "fr & 0x02",
+    0x24 : "not fr & 0x02",
+    0x25 : "fr & 0x03",
+    0x26 : "fr & 0x03 == 0x02"
+}
+
+# instructions that can't raise or leave the block unless they write PC
+pureOpcodes = {0x00, 0x01, 0x10, 0x11, 0x12, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x20}
+
+class FlagUpdate:
+    def __init__(self, mask, setOnly, lines):
+        self.mask = mask
+        self.setOnly = setOnly
+        self.lines = lines
+
+class Block:
+    def __init__(self, entry, function, instructionsCount, source, faults):
+        self.entry = entry
+        self.function = function
+        self.instructionsCount = instructionsCount
+        self.source = source
+        self.faults = faults
+
+class BlockTranslationEx(Exception):
+    pass
+
+class BlockTranslator:
+    def __init__(self, entry):
+        self.entry = entry
+        self.instructions = []
+        self.faults = {}
+        self.used = set()
+        self.dirty = set()
+        self.loops = False
+        self.counted = False
+
+    @staticmethod
+    def __local(registerId):
+        try:
+            return registerIdToName[registerId].lower()
+        except KeyError:
+            raise BlockTranslationEx("Unknown register " + str(registerId)) from None
+
+    def begin(self, opcode, nextPc):
+        self.instructions.append([opcode not in pureOpcodes, [], nextPc])
+
+    def observe(self):
+        self.instructions[-1][0] = True
+
+    def read(self, registerId, nextPc):
+        if registerId == PROGRAM_COUNTER:
+            return "0x{0:02X}".format(nextPc)
+        if registerId == 0xFD:
+            self.observe()
+        local = self.__local(registerId)
+        self.used.add(registerId)
+        return local
+
+    def write(self, registerId):
+        local = self.__local(registerId)
+        if registerId != PROGRAM_COUNTER:
+            self.used.add(registerId)
+            self.dirty.add(registerId)
+        return local
+
+    def emit(self, *lines):
+        self.instructions[-1][1].extend(lines)
+
+    def flags(self, mask, setOnly, *lines):
+        self.write(0xFD)
+        self.instructions[-1][1].append(FlagUpdate(mask, setOnly, lines))
+
+    def lines(self):
+        live = 0x03
+        lines = []
+        for index in reversed(range(len(self.instructions))):
+            observes, items, nextPc = self.instructions[index]
+            if observes:
+                live = 0x03
+            for item in reversed(items):
+                if not isinstance(item, FlagUpdate):
+                    lines.append((index, item))
+                elif observes or live & item.mask:
+                    lines.extend((index, line) for line in reversed(item.lines))
+                    if not item.setOnly:
+                        live &= ~item.mask
+            if observes:
+                live = 0x03
+        lines.reverse()
+        return lines
+
+    def goto(self, target):
+        if target == self.entry:
+            self.loops = True
+            return ["if iterations < limit:",
+                "    iterations += 1",
+                "    continue",
+                "return 0x{0:02X}".format(target)]
+        return ["return 0x{0:02X}".format(target)]
+
+    def writeBack(self, registers):
+        return ["registers[0x{0:02X}] = {1}".format(registerId,
+            registerIdToName[registerId].lower()) for registerId in sorted(registers)]
+
+    def flush(self):
+        self.emit(*self.writeBack(self.dirty))
+
+    # keeps cpu.instructionsCount exact while statement runs, for observers of ports
+    def counting(self, statement):
+        self.counted = True
+        progress = "iterations * block + {0}".format(len(self.instructions) - 1)
+        return ["cpu.instructionsCount += " + progress,
+            "try:",
+            "    " + statement,
+            "finally:",
+            "    cpu.instructionsCount -= " + progress]
+
+    def source(self, instructionsCount):
+        name = "block_0x{0:02X}".format(self.entry)
+        source = ["def {0}(registers, limit):".format(name)]
+        if self.loops or self.counted:
+            source.append("    iterations = 0")
+        if self.counted:
+            source.append("    block = {0}".format(instructionsCount))
+        for registerId in sorted(self.used):
+            source.append("    {0} = registers[0x{1:02X}]".format(
+                registerIdToName[registerId].lower(), registerId))
+        source.append("    try:")
+        indent = "        "
+        if self.loops:
+            source.append(indent + "while True:")
+            indent += "    "
+        # maps line numbers of generated source to (completed instructions, PC after fault)
+        for index, line in self.lines():
+            source.append(indent + line)
+            self.faults[len(source)] = (index, self.instructions[index][2])
+        source.append("    finally:")
+        if self.loops:
+            source.append("        cpu.instructionsCount += iterations * {0}".format(instructionsCount))
+        source.extend("        " + line for line in self.writeBack(self.dirty) or ["pass"])
+        return name, "\n".join(source) + "\n"
+
+class BlockCompiler:
+    def __init__(self, cpu, rom):
+        self.cpu = cpu
+        self.rom = rom
+        self.blocks = [None] * len(rom)
+        self.opcodeToEmitterMapping = self._getOpcodeToEmitterMapping()
+        self.counted = cpu.ioRecorder is not None
+        self.namespace = self.__initNamespace()
+
+    def _getOpcodeToEmitterMapping(self):
+        return {
+            0x00 : (2, self.__emitMOV),
+            0x01 : (2, self.__emitSET),
+            0x02 : (2, self.__emitLOAD),
+            0x03 : (2, self.__emitSTOR),
+            0x10 : (2, self.__emitADD),
+            0x11 : (2, self.__emitSUB),
+            0x12 : (2, self.__emitMUL),
+            0x13 : (2, self.__emitDIV),
+            0x14 : (2, self.__emitMOD),
+            0x15 : (2, self.__emitOR),
+            0x16 : (2, self.__emitAND),
+            0x17 : (2, self.__emitXOR),
+            0x18 : (1, self.__emitNOT),
+            0x19 : (1, self.__emitSHL),
+            0x1A : (1, self.__emitSHR),
+            0x20 : (2, self.__emitCMP),
+            0x21 : (1, self.__emitConditionalJump),
+            0x22 : (1, self.__emitConditionalJump),
+            0x23 : (1, self.__emitConditionalJump),
+            0x24 : (1, self.__emitConditionalJump),
+            0x25 : (1, self.__emitConditionalJump),
+            0x26 : (1, self.__emitConditionalJump),
+            0x30 : (1, self.__emitPUSH),
+            0x31 : (1, self.__emitPOP),
+            0x40 : (1, self.__emitJMP),
+            0x41 : (1, self.__emitJMPR),
+            0x42 : (1, self.__emitCALL),
+            0x43 : (1, self.__emitCALR),
+            0x44 : (0, self.__emitRET),
+            0x50 : (2, self.__emitIN),
+            0x51 : (2, self.__emitOUT),
+            0xFF : (0, self.__emitHALT) }
+
+    def __initNamespace(self):
+        ram = self.cpu.ram
+        def invalidAddress(address):
+            return Exception ("Address 0x{0:02X} points outside memory "
+                "address space (avail. 0x00-0x{1:02X})".format(address, len(ram)-1))
+        namespace = {
+            "cpu" : self.cpu,
+            "ram" : ram,
+            "ramSize" : len(ram),
+            "ramMask" : self.cpu.memoryMask(),
+            "invalidAddress" : invalidAddress }
+        for address, port in self.cpu.io_devices.items():
+            namespace["port_0x{0:02X}".format(address)] = port
+        return namespace
+
+    @staticmethod
+    def __jumpTarget(nextPc, offset):
+        return (nextPc + offset) % WORD_SIZE
+
+    @staticmethod
+    def __raise(translator, message):
+        translator.observe()
+        translator.emit("raise Exception({0!r})".format(message))
+        return True
+
+    def __assign(self, translator, destinationRegisterId, expression):
+        destination = translator.write(destinationRegisterId)
+        translator.emit("{0} = {1}".format(destination, expression))
+        if destinationRegisterId == PROGRAM_COUNTER:
+            translator.observe()
+            translator.emit("return pc")
+            return True
+        return False
+
+    def __emitMOV(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        source = translator.read(sourceRegisterId, nextPc)
+        return self.__assign(translator, destinationRegisterId, source)
+
+    def __emitSET(self, translator, opcode, nextPc, registerId, constValue):
+        return self.__assign(translator, registerId, "0x{0:02X}".format(constValue))
+
+    def __address(self, expression):
+        if self.namespace["ramMask"] is not None:
+            return ("a = {0} & ramMask".format(expression),)
+        return ("a = " + expression, "if a >= ramSize or a < 0: raise invalidAddress(a)")
+
+    def __emitLOAD(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        source = translator.read(sourceRegisterId, nextPc)
+        translator.emit(*self.__address(source))
+        return self.__assign(translator, destinationRegisterId, "ram[a]")
+
+    def __emitSTOR(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        destination = translator.read(destinationRegisterId, nextPc)
+        source = translator.read(sourceRegisterId, nextPc)
+        translator.emit(*self.__address(destination), "ram[a] = " + source)
+        return False
+
+    def __emitArithmetic(self, translator, opcode, nextPc, destinationRegisterId,
+            sourceRegisterId, operator):
+        source = translator.read(sourceRegisterId, nextPc)
+        destination = translator.read(destinationRegisterId, nextPc)
+        translator.flags(0x02, False, "fr &= ~0x02")
+        translator.emit("a = {0} {1} {2}".format(source, operator, destination))
+        translator.flags(0x02, True, "if a >= 0x100: fr |= 0x02")
+        return self.__assign(translator, destinationRegisterId, "a % 0x100")
+
+    def __emitADD(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitArithmetic(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "+")
+
+    def __emitMUL(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitArithmetic(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "*")
+
+    def __emitSUB(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        source = translator.read(sourceRegisterId, nextPc)
+        destination = translator.read(destinationRegisterId, nextPc)
+        translator.flags(0x02, False, "fr &= ~0x02")
+        translator.emit("a = " + source,
+            "b = " + destination,
+            "c = b - a")
+        translator.flags(0x02, True, "if c < 0: fr |= 0x02")
+        translator.emit("if c < 0: c = 0x100 - b")
+        return self.__assign(translator, destinationRegisterId, "c")
+
+    def __emitDivision(self, translator, opcode, nextPc, destinationRegisterId,
+            sourceRegisterId, operator):
+        source = translator.read(sourceRegisterId, nextPc)
+        destination = translator.read(destinationRegisterId, nextPc)
+        translator.emit("a = " + source,
+            "if a == 0: raise Exception('Division by 0 error')")
+        return self.__assign(translator, destinationRegisterId,
+            "{0} {1} a".format(destination, operator))
+
+    def __emitDIV(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        translator.flags(0x02, False, "fr &= ~0x02")
+        return self.__emitDivision(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "//")
+
+    def __emitMOD(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitDivision(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "%")
+
+    def __emitLogical(self, translator, opcode, nextPc, destinationRegisterId,
+            sourceRegisterId, operator):
+        source = translator.read(sourceRegisterId, nextPc)
+        destination = translator.read(destinationRegisterId, nextPc)
+        return self.__assign(translator, destinationRegisterId,
+            "{0} {1} {2}".format(destination, operator, source))
+
+    def __emitOR(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitLogical(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "|")
+
+    def __emitAND(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitLogical(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "&")
+
+    def __emitXOR(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        return self.__emitLogical(translator, opcode, nextPc,
+            destinationRegisterId, sourceRegisterId, "^")
+
+    def __emitNOT(self, translator, opcode, nextPc, destinationRegisterId):
+        destination = translator.read(destinationRegisterId, nextPc)
+        return self.__assign(translator, destinationRegisterId,
+            "(~ {0}) % 0x100".format(destination))
+
+    def __emitSHL(self, translator, opcode, nextPc, destinationRegisterId):
+        destination = translator.read(destinationRegisterId, nextPc)
+        translator.emit("a = {0} << 1".format(destination))
+        translator.flags(0x02, True, "if a >= 0x100: fr |= 0x02")
+        translator.emit("if a >= 0x100: a %= 0x100")
+        return self.__assign(translator, destinationRegisterId, "a")
+
+    def __emitSHR(self, translator, opcode, nextPc, destinationRegisterId):
+        destination = translator.read(destinationRegisterId, nextPc)
+        return self.__assign(translator, destinationRegisterId,
+            "{0} >> 1".format(destination))
+
+    def __emitCMP(self, translator, opcode, nextPc, destinationRegisterId, sourceRegisterId):
+        destination = translator.read(destinationRegisterId, nextPc)
+        source = translator.read(sourceRegisterId, nextPc)
+        translator.flags(0x03, False, "fr &= ~0x03")
+        translator.emit("a = {0} - {1}".format(destination, source))
+        translator.flags(0x03, True, "if a < 0: fr |= 0x02",
+            "elif a == 0: fr |= 0x01")
+        return False
+
+    def __emitConditionalJump(self, translator, opcode, nextPc, jumpOffset):
+        translator.read(0xFD, nextPc)
+        target = self.__jumpTarget(nextPc, jumpOffset)
+        translator.emit("if {0}:".format(conditionalJumps[opcode]))
+        translator.emit(*("    " + line for line in translator.goto(target)))
+        translator.emit(*translator.goto(nextPc))
+        return True
+
+    @staticmethod
+    def __emitPush(translator, value):
+        translator.write(0xFE)
+        translator.emit("a = " + value,
+            "if sp == 0: raise Exception(\"Stack pointer is already at 0x00. "
+                "Can't move it further back.\")",
+            "sp -= 1",
+            "ram[sp] = a")
+
+    @staticmethod
+    def __emitPop(translator):
+        translator.write(0xFE)
+        translator.emit("if sp == 0xFF: raise Exception(\"Stack pointer is already at 0xFF. "
+                "Can't move it further.\")",
+            "a = ram[sp]",
+            "sp += 1")
+
+    def __emitPUSH(self, translator, opcode, nextPc, sourceRegisterId):
+        self.__emitPush(translator, translator.read(sourceRegisterId, nextPc))
+        return False
+
+    def __emitPOP(self, translator, opcode, nextPc, destinationRegisterId):
+        translator.write(destinationRegisterId)
+        self.__emitPop(translator)
+        return self.__assign(translator, destinationRegisterId, "a")
+
+    def __emitJMP(self, translator, opcode, nextPc, jumpOffset):
+        translator.emit(*translator.goto(self.__jumpTarget(nextPc, jumpOffset)))
+        return True
+
+    def __emitJMPR(self, translator, opcode, nextPc, sourceRegisterId):
+        translator.emit("return " + translator.read(sourceRegisterId, nextPc))
+        return True
+
+    def __emitCALL(self, translator, opcode, nextPc, functionPointerOffset):
+        self.__emitPush(translator, "0x{0:02X}".format(nextPc))
+        translator.emit(*translator.goto(self.__jumpTarget(nextPc, functionPointerOffset)))
+        return True
+
+    def __emitCALR(self, translator, opcode, nextPc, sourceRegisterId):
+        translator.emit("b = " + translator.read(sourceRegisterId, nextPc))
+        self.__emitPush(translator, "0x{0:02X}".format(nextPc))
+        translator.emit("return b")
+        return True
+
+    def __emitRET(self, translator, opcode, nextPc):
+        self.__emitPop(translator)
+        translator.emit("return a")
+        return True
+
+    def __port(self, translator, portAddress):
+        if portAddress not in self.cpu.io_devices:
+            raise BlockTranslationEx("Port with address 0x{0:02X} not found".format(portAddress))
+        return "port_0x{0:02X}".format(portAddress)
+
+    def __emitIN(self, translator, opcode, nextPc, portAddress, destinationRegisterId):
+        port = self.__port(translator, portAddress)
+        translator.write(destinationRegisterId)
+        translator.flush()
+        if not self.counted:
+            return self.__assign(translator, destinationRegisterId, port + ".read()")
+        translator.emit(*translator.counting("a = {0}.read()".format(port)))
+        return self.__assign(translator, destinationRegisterId, "a")
+
+    def __emitOUT(self, translator, opcode, nextPc, portAddress, sourceRegisterId):
+        port = self.__port(translator, portAddress)
+        source = translator.read(sourceRegisterId, nextPc)
+        translator.flush()
+        statement = "{0}.write({1})".format(port, source)
+        translator.emit(*translator.counting(statement) if self.counted else [statement])
+        return False
+
+    def __emitHALT(self, translator, opcode, nextPc):
+        translator.emit("cpu.running = False",
+            "return 0x{0:02X}".format(nextPc))
+        return True
+
+    def translate(self, entry):
+        translator = BlockTranslator(entry)
+        address = entry
+        instructionsCount = 0
+        terminated = False
+        while not terminated:
+            instructionsCount += 1
+            opcode = self.rom[address]
+            try:
+                operandsCount, emitter = self.opcodeToEmitterMapping[opcode]
+            except KeyError:
+                translator.begin(opcode, address + 1)
+                terminated = self.__raise(translator,
+                    "Unknown instruction 0x{0:02X}".format(opcode))
+                continue
+            nextPc = address + 1 + operandsCount
+            translator.begin(opcode, min(nextPc, len(self.rom)))
+            operands = self.rom[address + 1 : nextPc]
+            if len(operands) < operandsCount:
+                terminated = self.__raise(translator,
+                    "Instruction at 0x{0:02X} exceeds program memory".format(address))
+                continue
+            try:
+                terminated = emitter(translator, opcode, nextPc, *operands)
+            except BlockTranslationEx as e:
+                terminated = self.__raise(translator, str(e))
+            address = nextPc
+            if not terminated and address >= len(self.rom):
+                translator.observe()
+                translator.emit("return 0x{0:02X}".format(address))
+                terminated = True
+        name, source = translator.source(instructionsCount)
+        code = compile(source, "<jit {0}>".format(name), "exec")
+        exec(code, self.namespace)
+        return Block(entry, self.namespace[name], instructionsCount, source, translator.faults)
+
+    def getBlock(self, address):
+        block = self.blocks[address]
+        if block is None:
+            block = self.blocks[address] = self.translate(address)
+        return block
+
+    def run(self, budget):
+        cpu = self.cpu
+        registers = cpu.registerFile
+        blocks = self.blocks
+        budget += cpu.instructionsCount
+        try:
+            while cpu.running:
+                block = blocks[registers[PROGRAM_COUNTER]] or self.getBlock(registers[PROGRAM_COUNTER])
+                remaining = budget - cpu.instructionsCount
+                if block.instructionsCount > remaining:
+                    break
+                registers[PROGRAM_COUNTER] = block.function(registers,
+                    remaining // block.instructionsCount - 1)
+                cpu.instructionsCount += block.instructionsCount
+        except Exception as e:
+            if registers[PROGRAM_COUNTER] < len(blocks):
+                self.__recover(blocks[registers[PROGRAM_COUNTER]], e.__traceback__)
+            print (e)
+            raise Exception(e)
+
+    def __recover(self, block, traceback):
+        if block is None:
+            return
+        while traceback is not None and traceback.tb_frame.f_code is not block.function.__code__:
+            traceback = traceback.tb_next
+        if traceback is None:
+            return
+        completed, nextPc = block.faults[traceback.tb_lineno]
+        self.cpu.registerFile[PROGRAM_COUNTER] = nextPc
+        self.cpu.instructionsCount += completed
@@ -0,0 +1,39 @@
+import contextlib
+from vm.cpu import Cpu
+from vm.terminal import ScriptedTerminal
+
+RAM_SIZE = 256
+INITIAL_RAM = b"\xFF" * RAM_SIZE
+
+class CpuPool:
+    def __init__(self, size=0, ram=INITIAL_RAM, **options):
+        self.ram = bytes(ram)
+        self.options = options
+        self.free = [self.__create() for _ in range(size)]
+        self.created = size
+
+    def __create(self):
+        return Cpu(list(self.ram), ScriptedTerminal(), **self.options)
+
+    def acquire(self, program=None, input=''):
+        if self.free:
+            cpu = self.free.pop()
+        else:
+            cpu = self.__create()
+            self.created += 1
+        cpu.terminal.load(input)
+        if program is not None:
+            cpu.load(program)
+        return cpu
+
+    def release(self, cpu):
+        cpu.reset()
+        self.free.append(cpu)
+
+    @contextlib.contextmanager
+    def instance(self, program=None, input=''):
+        cpu = self.acquire(program, input)
+        try:
+            yield cpu
+        finally:
+            self.release(cpu)
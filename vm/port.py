@@ -1,16 +1,43 @@
+from inspect import iscoroutinefunction
+
 class Port:
-    def __init__(self, readHandle, writeHandle):
+    __slots__ = ("readHandle", "writeHandle", "read", "write", "readAsync", "writeAsync", "status")
+
+    def __init__(self, readHandle, writeHandle, status=False):
         self.readHandle = readHandle
         self.writeHandle = writeHandle
+        self.status = status
         if not hasattr(self.readHandle, '__call__') and not readHandle == None:
             raise Exception("Read handle is not callable!")
         if not hasattr(self.writeHandle, '__call__') and not writeHandle == None:
             raise Exception("Write handle is not callable!")
+        self.readAsync = readHandle if iscoroutinefunction(readHandle) else None
+        self.writeAsync = writeHandle if iscoroutinefunction(writeHandle) else None
+        if readHandle == None:
+            self.read = self.__readNothing
+        elif self.readAsync is not None:
+            self.read = self.__readAsyncOnly
+        else:
+            self.read = readHandle
+        if writeHandle == None:
+            self.write = self.__writeNothing
+        elif self.writeAsync is not None:
+            self.write = self.__writeAsyncOnly
+        else:
+            self.write = writeHandle
+
+    @staticmethod
+    def __readNothing():
+        return None
+
+    @staticmethod
+    def __writeNothing(value):
+        pass
 
-    def read(self):
-        if not self.readHandle == None:
-            return self.readHandle()
+    @staticmethod
+    def __readAsyncOnly():
+        raise Exception("Port read handle is asynchronous, use Cpu.runAsync")
 
-    def write(self, value):
-        if not self.writeHandle == None:    
-            self.writeHandle(value)
\ No newline at end of file
+    @staticmethod
+    def __writeAsyncOnly(value):
+        raise Exception("Port write handle is asynchronous, use Cpu.runAsync")
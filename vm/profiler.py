@@ -0,0 +1,209 @@
+import array
+import json
+from debuginfo import DebugInfo
+from decompiler import opcodeToMnemonic
+from vm.cpu import programKey
+
+conditionalJumps = (0x21, 0x22, 0x23, 0x24, 0x25, 0x26)
+calls = (0x42, 0x43)
+RET = 0x44
+
+def counters(size):
+    return array.array('Q', bytes(8 * size))
+
+class Profiler:
+    def __init__(self, debugInfo=None):
+        self.__debugInfo = debugInfo
+        self.debugInfo = debugInfo
+        self.program = None
+        self.rom = b''
+        self.reset()
+
+    def reset(self):
+        self.opcodes = counters(256)
+        self.addresses = counters(len(self.rom))
+        self.jumps = counters(len(self.rom))
+
+    def start(self):
+        pass
+
+    def fail(self):
+        pass
+
+    def prepare(self, cpu):
+        self.debugInfo = self.__debugInfo if cpu.debugInfo is None else cpu.debugInfo
+        program = programKey(cpu.rom)
+        if program != self.program:
+            self.program = program
+            self.rom = bytes(cpu.rom)
+            self.reset()
+        opcodes = self.opcodes
+        addresses = self.addresses
+        jumps = self.jumps
+        rom = self.rom
+        def record(address, nextPc, pc):
+            opcodes[rom[address]] += 1
+            addresses[address] += 1
+            if pc != nextPc:
+                jumps[address] += 1
+        return record
+
+    @staticmethod
+    def mnemonic(opcode):
+        try:
+            return opcodeToMnemonic[opcode][0]
+        except KeyError:
+            return "0x{0:02X}".format(opcode)
+
+    def instructions(self):
+        return sum(self.opcodes)
+
+    def hotSpots(self):
+        return sorted(((count, address) for address, count in enumerate(self.addresses) if count),
+            key=lambda entry: (-entry[0], entry[1]))
+
+    def sourceLines(self):
+        if self.debugInfo is None:
+            return []
+        counts = {}
+        for count, address in self.hotSpots():
+            location = self.debugInfo.location(address)
+            if location is not None:
+                counts[location] = counts.get(location, 0) + count
+        return sorted(((count, location) for location, count in counts.items()),
+            key=lambda entry: (-entry[0], entry[1]))
+
+    def symbols(self):
+        if self.debugInfo is None:
+            return {}
+        counts = {}
+        for count, address in self.hotSpots():
+            symbol = self.debugInfo.symbol(address)
+            if symbol is not None:
+                counts[symbol] = counts.get(symbol, 0) + count
+        return counts
+
+    def branches(self):
+        return [(address, self.rom[address], self.jumps[address], count - self.jumps[address])
+            for address, count in enumerate(self.addresses)
+            if count and self.rom[address] in conditionalJumps]
+
+    def results(self):
+        handlers = {}
+        for address, opcode, taken, notTaken in self.branches():
+            counts = handlers.setdefault(self.mnemonic(opcode), {"taken" : 0, "notTaken" : 0})
+            counts["taken"] += taken
+            counts["notTaken"] += notTaken
+        results = {
+            "instructions" : self.instructions(),
+            "opcodes" : {self.mnemonic(opcode) : count
+                for opcode, count in enumerate(self.opcodes) if count},
+            "addresses" : {"0x{0:02X}".format(address) : count
+                for count, address in self.hotSpots()},
+            "branches" : {"0x{0:02X}".format(address) :
+                {"mnemonic" : self.mnemonic(opcode), "taken" : taken, "notTaken" : notTaken}
+                for address, opcode, taken, notTaken in self.branches()},
+            "handlers" : handlers }
+        if self.debugInfo is not None:
+            results["lines"] = {"{0}:{1}".format(*location) : count
+                for count, location in self.sourceLines()}
+            results["symbols"] = self.symbols()
+        return results
+
+    def toJson(self):
+        return json.dumps(self.results(), indent=2)
+
+    def report(self, limit=10):
+        total = self.instructions() or 1
+        lines = ["Instructions executed: {0}".format(self.instructions()), "",
+            "{0:<8}{1:>12}{2:>9}".format("Opcode", "Count", "%")]
+        for count, opcode in sorted(((count, opcode) for opcode, count
+                in enumerate(self.opcodes) if count), key=lambda entry: (-entry[0], entry[1])):
+            lines.append("{0:<8}{1:>12}{2:>8.2f}%".format(self.mnemonic(opcode), count,
+                100.0 * count / total))
+        lines.extend(["", "{0:<8}{1:<8}{2:>12}{3:>9}".format("Address", "Opcode", "Count", "%")])
+        for count, address in self.hotSpots()[:limit]:
+            line = "0x{0:02X}    {1:<8}{2:>12}{3:>8.2f}%".format(address,
+                self.mnemonic(self.rom[address]), count, 100.0 * count / total)
+            if self.debugInfo is not None:
+                line += "  " + self.debugInfo.describe(address)
+            lines.append(line.rstrip())
+        if self.debugInfo is not None:
+            lines.extend(["", "{0:<24}{1:>12}{2:>9}".format("Line", "Count", "%")])
+            for count, location in self.sourceLines()[:limit]:
+                lines.append("{0:<24}{1:>12}{2:>8.2f}%".format("{0}:{1}".format(*location), count,
+                    100.0 * count / total))
+        branches = self.branches()
+        if branches:
+            lines.extend(["", "{0:<8}{1:<8}{2:>12}{3:>12}".format("Address", "Jump", "Taken",
+                "Not taken")])
+            for address, opcode, taken, notTaken in branches:
+                lines.append("0x{0:02X}    {1:<8}{2:>12}{3:>12}".format(address,
+                    self.mnemonic(opcode), taken, notTaken))
+        return "\n".join(lines)
+
+class CallGraphProfiler:
+    def __init__(self, symbols=None):
+        if isinstance(symbols, DebugInfo):
+            symbols = symbols.labels
+        self.__symbols = {address : name for name, address in (symbols or {}).items()}
+        self.symbols = self.__symbols
+        self.program = None
+        self.reset()
+
+    def reset(self):
+        self.samples = {}
+        self.start()
+
+    def start(self):
+        self.stack = (0x00,)
+
+    def fail(self):
+        pass
+
+    def prepare(self, cpu):
+        self.symbols = self.__symbols if cpu.debugInfo is None else cpu.debugInfo.labelAt
+        program = programKey(cpu.rom)
+        if program != self.program:
+            self.program = program
+            self.reset()
+        rom = bytes(cpu.rom)
+        samples = self.samples
+        def record(address, nextPc, pc):
+            stack = self.stack
+            samples[stack] = samples.get(stack, 0) + 1
+            opcode = rom[address]
+            if opcode in calls:
+                self.stack = stack + (pc,)
+            elif opcode == RET and len(stack) > 1:
+                self.stack = stack[:-1]
+        return record
+
+    def name(self, address):
+        return self.symbols.get(address, "0x{0:02X}".format(address))
+
+    def exclusive(self):
+        counts = {}
+        for stack, count in self.samples.items():
+            counts[stack[-1]] = counts.get(stack[-1], 0) + count
+        return counts
+
+    def inclusive(self):
+        counts = {}
+        for stack, count in self.samples.items():
+            for address in set(stack):
+                counts[address] = counts.get(address, 0) + count
+        return counts
+
+    def collapsed(self):
+        return "\n".join("{0} {1}".format(";".join(self.name(address) for address in stack), count)
+            for stack, count in sorted(self.samples.items()))
+
+    def report(self):
+        exclusive = self.exclusive()
+        lines = ["{0:<20}{1:>12}{2:>12}".format("Function", "Inclusive", "Exclusive")]
+        for count, address in sorted(((count, address) for address, count
+                in self.inclusive().items()), key=lambda entry: (-entry[0], entry[1])):
+            lines.append("{0:<20}{1:>12}{2:>12}".format(self.name(address), count,
+                exclusive.get(address, 0)))
+        return "\n".join(lines)
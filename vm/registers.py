@@ -0,0 +1,19 @@
+FLAG_REGISTER = 0xFD
+STACK_POINTER = 0xFE
+PROGRAM_COUNTER = 0xFF
+
+registerIdToName = {
+    0x00 : "R0",
+    0x01 : "R1",
+    0x02 : "R2",
+    0x03 : "R3",
+    0x04 : "R4",
+    0x05 : "R5",
+    0x06 : "R6",
+    0x07 : "R7",
+    0xFD : "FR",
+    0xFE : "SP",
+    0xFF : "PC"
+}
+
+registerNameToId = {name : registerId for registerId, name in registerIdToName.items()}
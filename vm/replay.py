@@ -0,0 +1,111 @@
+import struct
+from collections import deque, namedtuple
+from vm.port import Port
+from vm.terminal import Terminal
+
+IO_LOG_MAGIC = b"VMI1"
+READ = 0
+WRITE = 1
+NO_VALUE = -1
+
+ioLogHeader = struct.Struct("<4sI")
+ioEventRecord = struct.Struct("<QBBi")
+
+IoEvent = namedtuple("IoEvent", ("instructions", "kind", "port", "value"))
+
+class IoRecorder:
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.events = []
+
+    def __log(self, kind, address, value, instructions):
+        self.events.append(IoEvent(instructions, kind, address, value))
+        return value
+
+    # cpu counts instruction after its handler returns, so counter is read as is
+    def __recordingPort(self, address, port, cpu):
+        # asynchronous handles are awaited after suspending instruction is counted
+        if port.readAsync is not None:
+            async def read():
+                return self.__log(READ, address, await port.readAsync(), cpu.instructionsCount - 1)
+        else:
+            def read():
+                return self.__log(READ, address, port.read(), cpu.instructionsCount)
+        if port.writeAsync is not None:
+            async def write(value):
+                self.__log(WRITE, address, value, cpu.instructionsCount - 1)
+                await port.writeAsync(value)
+        else:
+            def write(value):
+                self.__log(WRITE, address, value, cpu.instructionsCount)
+                port.write(value)
+        return Port(read, write, port.status)
+
+    def wrap(self, devices, cpu):
+        return {address : self.__recordingPort(address, port, cpu) for address, port in devices.items()}
+
+    def toBytes(self):
+        chunks = [ioLogHeader.pack(IO_LOG_MAGIC, len(self.events))]
+        for event in self.events:
+            chunks.append(ioEventRecord.pack(event.instructions, event.kind, event.port,
+                NO_VALUE if event.value is None else event.value))
+        return b"".join(chunks)
+
+    def save(self, path):
+        with open(path, 'wb') as log:
+            log.write(self.toBytes())
+
+def readIoLog(buffer):
+    magic, count = ioLogHeader.unpack_from(buffer, 0)
+    if magic != IO_LOG_MAGIC:
+        raise Exception("Not an I/O log file")
+    if len(buffer) < ioLogHeader.size + count * ioEventRecord.size:
+        raise Exception("I/O log file is truncated")
+    events = []
+    for index in range(count):
+        instructions, kind, port, value = ioEventRecord.unpack_from(buffer,
+            ioLogHeader.size + index * ioEventRecord.size)
+        events.append(IoEvent(instructions, kind, port, None if value == NO_VALUE else value))
+    return events
+
+class ReplayTerminal(Terminal):
+    def __init__(self, events):
+        Terminal.__init__(self)
+        self.reads = {}
+        self.writes = {}
+        for event in events:
+            queue = self.reads if event.kind == READ else self.writes
+            queue.setdefault(event.port, deque()).append(event.value)
+        self.output = ''
+
+    def __read(self, address):
+        try:
+            return self.reads[address].popleft()
+        except (KeyError, IndexError):
+            raise Exception("Replay log has no more reads from port 0x{0:02X}".format(address))
+
+    def __write(self, address, value):
+        try:
+            expected = self.writes[address].popleft()
+        except (KeyError, IndexError):
+            raise Exception("Replay diverged, unexpected write 0x{0:02X} to port 0x{1:02X}"
+                .format(value, address))
+        if value != expected:
+            raise Exception("Replay diverged, write 0x{0:02X} to port 0x{1:02X} was recorded "
+                "as 0x{2:02X}".format(value, address, expected))
+
+    def _controlPortRead(self):
+        return self.__read(0x00)
+
+    def _controlPortWrite(self, value):
+        self.__write(0x00, value)
+
+    def _dataInPortRead(self):
+        return self.__read(0x01)
+
+    def _dataOutPortWrite(self, value):
+        self.__write(0x02, value)
+        self.output += chr(value)
+        Terminal._dataOutPortWrite(self, value)
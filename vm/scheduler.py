@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from vm.cpu import IDLE_INTERVAL
+
+READY = "ready"
+HALTED = "halted"
+FAILED = "failed"
+EXPIRED = "expired"
+STOPPED = "stopped"
+
+class Task:
+    __slots__ = ("cpu", "name", "cycleLimit", "cycles", "skippedCycles", "slices", "state", "error")
+
+    def __init__(self, cpu, name, cycleLimit=None):
+        self.cpu = cpu
+        self.name = name
+        self.cycleLimit = cycleLimit
+        self.cycles = 0
+        self.skippedCycles = 0
+        self.slices = 0
+        self.state = READY if cpu.running else HALTED
+        self.error = None
+
+    def __repr__(self):
+        return "Task({0!r}, {1}, cycles={2})".format(self.name, self.state, self.cycles)
+
+class Scheduler:
+    def __init__(self, quantum=1000):
+        if quantum < 1:
+            raise Exception("Quantum has to be at least one instruction")
+        self.quantum = quantum
+        self.tasks = []
+        self.ready = deque()
+        self.cycles = 0
+
+    def add(self, cpu, name=None, cycleLimit=None):
+        task = Task(cpu, len(self.tasks) if name is None else name, cycleLimit)
+        self.tasks.append(task)
+        if task.state == READY:
+            self.ready.append(task)
+        return task
+
+    def __budget(self, task):
+        if task.cycleLimit is None:
+            return self.quantum
+        return min(self.quantum, task.cycleLimit - task.cycles)
+
+    def runSlice(self):
+        task = self.ready.popleft()
+        cpu = task.cpu
+        executed = cpu.instructionsCount
+        skipped = cpu.skippedCycles
+        try:
+            cpu.runFor(self.__budget(task))
+        except Exception as e:
+            cpu.running = False
+            task.state = FAILED
+            task.error = str(e)
+        executed = cpu.instructionsCount - executed
+        task.cycles += executed
+        task.skippedCycles += cpu.skippedCycles - skipped
+        task.slices += 1
+        self.cycles += executed
+        if task.state == FAILED:
+            return task
+        if not cpu.running and cpu.stopReason is not None:
+            task.state = STOPPED
+        elif not cpu.running:
+            task.state = HALTED
+        elif task.cycleLimit is not None and task.cycles >= task.cycleLimit:
+            task.state = EXPIRED
+        else:
+            self.ready.append(task)
+        return task
+
+    def resume(self, task):
+        if task.state != STOPPED:
+            raise Exception("Only task stopped by breakpoint or watchpoint can be resumed")
+        task.state = READY
+        self.ready.append(task)
+
+    def run(self):
+        idleSlices = 0
+        while self.ready:
+            task = self.runSlice()
+            idleSlices = idleSlices + 1 if task.state == READY and task.cpu.idle else 0
+            if idleSlices and idleSlices >= len(self.ready):
+                time.sleep(IDLE_INTERVAL)
+                idleSlices = 0
+        return self.tasks
@@ -5,7 +5,7 @@ class Terminal:
         self.readbuffer = ''
         self.writebuffer = ''
 
-        self.controlPort = Port(self._controlPortRead, self._controlPortWrite)
+        self.controlPort = Port(self._controlPortRead, self._controlPortWrite, status=True)
         self.dataInPort  = Port(self._dataInPortRead, None)
         self.dataOutPort = Port(None, self._dataOutPortWrite)
 
@@ -34,4 +34,45 @@ class Terminal:
             print(self.writebuffer)
             self.writebuffer = ''
         else:
-            self.writebuffer += chr(value)
\ No newline at end of file
+            self.writebuffer += chr(value)
+
+class ScriptedTerminal(Terminal):
+    def __init__(self, input=''):
+        Terminal.__init__(self)
+        self.load(input)
+
+    def load(self, input):
+        self.readbuffer = input
+        self.writebuffer = ''
+        self.output = ''
+
+    def _getInput(self):
+        raise Exception("Terminal input exhausted")
+
+    def _dataOutPortWrite(self, value):
+        self.output += chr(value)
+
+class StreamTerminal(Terminal):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        Terminal.__init__(self)
+
+    async def _dataInPortRead(self):
+        while len(self.readbuffer) == 0:
+            line = await self.reader.readline()
+            if not line:
+                raise Exception("Terminal input exhausted")
+            self.readbuffer = line.decode().rstrip("\r\n")
+
+        nextCharacter = self.readbuffer[0]
+        self.readbuffer = self.readbuffer[1:]
+        return ord(nextCharacter)
+
+    async def _dataOutPortWrite(self, value):
+        if value == 10:
+            self.writer.write((self.writebuffer + "\n").encode())
+            self.writebuffer = ''
+            await self.writer.drain()
+        else:
+            self.writebuffer += chr(value)
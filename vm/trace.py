@@ -0,0 +1,164 @@
+import mmap
+import struct
+from collections import namedtuple
+from decompiler import opcodeToMnemonic
+from vm.cpu import (programKey, registerIdToName, opcodeToMemoryAccess, opcodeToWrittenRegister,
+    MEMORY_WRITE, FLAG_REGISTER, STACK_POINTER, PROGRAM_COUNTER)
+
+TRACE_MAGIC = b"VMT2"
+NO_REGISTER = 0xFF
+NO_ADDRESS = 0xFFFF
+
+REGISTER_CHANGED = 0x01
+FLAGS_CHANGED = 0x02
+STACK_POINTER_CHANGED = 0x04
+MEMORY_CHANGED = 0x08
+
+traceHeader = struct.Struct("<4sIQ")
+traceCount = struct.Struct("<Q")
+traceRecord = struct.Struct("<HHBBBBBBBHii")
+
+TraceRecord = namedtuple("TraceRecord", ("pc", "nextPc", "opcode", "operand1", "operand2",
+    "changes", "register", "flags", "stackPointer", "address", "value", "memoryValue"))
+
+def instructionLength(opcode):
+    return len(opcodeToMnemonic.get(opcode, ("",)))
+
+class TraceRecorder:
+    def __init__(self, capacity=4096, path=None):
+        self.capacity = capacity
+        self.count = 0
+        self.program = None
+        self.instructions = None
+        self.__pending = None
+        size = traceHeader.size + capacity * traceRecord.size
+        if path is None:
+            self.file = None
+            self.buffer = bytearray(size)
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+        traceHeader.pack_into(self.buffer, 0, TRACE_MAGIC, capacity, 0)
+
+    def close(self):
+        if self.file is not None:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+
+    def start(self):
+        pass
+
+    def __decodeInstructions(self, rom):
+        instructions = []
+        for address, opcode in enumerate(rom):
+            operands = (list(rom[address + 1 : address + 3]) + [0, 0])[:2]
+            register = opcodeToWrittenRegister.get(opcode)
+            register = operands[-register - 1] if register is not None else NO_REGISTER
+            if register > 0x07:
+                register = NO_REGISTER
+            memory, offset, access = opcodeToMemoryAccess.get(opcode, (None, 0, None))
+            if access != MEMORY_WRITE:
+                memory = None
+            elif memory < 0:
+                memory = operands[-memory - 1]
+            instructions.append((opcode, operands[0], operands[1], register, memory, offset))
+        return instructions
+
+    def prepare(self, cpu):
+        program = programKey(cpu.rom)
+        if program != self.program:
+            self.program = program
+            self.instructions = self.__decodeInstructions(cpu.rom)
+        self.__registers = cpu.registerFile
+        self.__ram = cpu.ram
+        self.__mask = cpu.memoryMask()
+        self.__expect()
+        def record(address, nextPc, pc):
+            self.__write(pc)
+            self.__expect()
+        return record
+
+    def fail(self):
+        if self.__pending is not None:
+            self.__write(self.__registers[PROGRAM_COUNTER])
+            self.__pending = None
+
+    # keeps state before instruction at PC, so its record holds only values it changed
+    def __expect(self):
+        registers = self.__registers
+        ram = self.__ram
+        pc = registers[PROGRAM_COUNTER]
+        if pc >= len(self.instructions):
+            self.__pending = None
+            return
+        opcode, operand1, operand2, register, memory, offset = self.instructions[pc]
+        address = NO_ADDRESS
+        if memory is not None:
+            address = registers[memory] + offset
+            if self.__mask is not None:
+                address &= self.__mask
+            if address < 0 or address >= len(ram):
+                address = NO_ADDRESS
+        self.__pending = (pc, registers[register] if register != NO_REGISTER else 0,
+            registers[FLAG_REGISTER], registers[STACK_POINTER], address,
+            ram[address] if address != NO_ADDRESS else 0)
+
+    def __write(self, nextPc):
+        pc, value, flags, stackPointer, address, memoryValue = self.__pending
+        opcode, operand1, operand2, register, memory, offset = self.instructions[pc]
+        registers = self.__registers
+        changes = 0
+        if register != NO_REGISTER and registers[register] != value:
+            changes |= REGISTER_CHANGED
+            value = registers[register]
+        if registers[FLAG_REGISTER] != flags:
+            changes |= FLAGS_CHANGED
+        if registers[STACK_POINTER] != stackPointer:
+            changes |= STACK_POINTER_CHANGED
+        if address != NO_ADDRESS and self.__ram[address] != memoryValue:
+            changes |= MEMORY_CHANGED
+            memoryValue = self.__ram[address]
+        count = self.count
+        traceRecord.pack_into(self.buffer,
+            traceHeader.size + (count % self.capacity) * traceRecord.size,
+            pc, nextPc, opcode, operand1, operand2, changes, register,
+            registers[FLAG_REGISTER], registers[STACK_POINTER], address, value, memoryValue)
+        self.count = count + 1
+        traceCount.pack_into(self.buffer, 8, count + 1)
+
+    def records(self):
+        return readTrace(self.buffer)
+
+def readTrace(buffer):
+    magic, capacity, count = traceHeader.unpack_from(buffer, 0)
+    if magic != TRACE_MAGIC:
+        raise Exception("Not a trace file")
+    if len(buffer) < traceHeader.size + capacity * traceRecord.size:
+        raise Exception("Trace file is truncated")
+    return [TraceRecord(*traceRecord.unpack_from(buffer,
+            traceHeader.size + (index % capacity) * traceRecord.size))
+        for index in range(max(0, count - capacity), count)]
+
+def formatTrace(records, debugInfo=None):
+    lines = []
+    for record in records:
+        prefix = "PC:0x{0:02X} [DEBUG] ".format(record.pc)
+        line = prefix + "Executing instruction: 0x{0:02X}".format(record.opcode)
+        if debugInfo is not None:
+            line = (line + " " + debugInfo.describe(record.pc)).rstrip()
+        lines.append(line)
+        if record.changes & REGISTER_CHANGED:
+            lines.append(prefix + "Setting register {0}, with 0x{1:02X}".format(
+                registerIdToName[record.register], record.value))
+        if record.changes & FLAGS_CHANGED:
+            lines.append(prefix + "Setting register FR, with 0x{0:02X}".format(record.flags))
+        if record.changes & STACK_POINTER_CHANGED:
+            lines.append(prefix + "Setting register SP, with 0x{0:02X}".format(record.stackPointer))
+        if record.changes & MEMORY_CHANGED:
+            lines.append(prefix + "Writing memory 0x{0:02X}, with 0x{1:02X}".format(
+                record.address, record.memoryValue))
+        if record.nextPc != record.pc + instructionLength(record.opcode):
+            lines.append(prefix + "Jumping to 0x{0:02X}".format(record.nextPc))
+    return lines